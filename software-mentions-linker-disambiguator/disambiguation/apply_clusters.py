@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+"""Applies the predicted clusters to the full software mentions file
+
+Usage:
+    python apply_clusters.py --input_file <input_file> --clusters-file <clusters_file> --output_file <output_file>
+
+Details:
+    Streams the mentions file in chunks (--chunk-size records), and adds a 'predicted_cluster' field to every mention,
+    by joining its ID against the mention ID -> cluster ID table saved by clustering.py (mention_clusters.npz).
+    Mentions without a predicted cluster are their own cluster. Each chunk is written to the gzipped output as soon as it is processed,
+    so memory is bounded by the chunk size, whatever the size of the mentions file.
+    Only the 'ID' and 'software' fields are parsed: records are copied to the output as is, instead of being serialized again.
+
+Author:
+    Ana-Maria Istrate
+"""
+
+import argparse
+import csv
+import gzip
+import io
+import time
+import numpy as np
+import pandas as pd
+from synonym_graph import encode_names, decode_names
+from utils_disambiguation import ID_PREFIX
+
+ROOT_DIR = "../data/"
+
+# Number of rows of the mentions file processed at a time
+CHUNK_SIZE = 1000000
+
+# Gzip compression level of the output; low levels keep the output stage close to disk speed
+COMPRESS_LEVEL = 1
+
+def save_mention_clusters(filename, mention_labels, cluster_names):
+  """
+  Saves the predicted clusters as a compact mention ID -> cluster ID table
+
+  :param filename: .npz file to save the table to
+  :param mention_labels: array indexed by integer mention ID, with the index of the cluster of each mention in cluster_names (-1 if none)
+  :param cluster_names: array of cluster names
+  """
+  names_data, names_offsets = encode_names(list(cluster_names))
+  np.savez(filename, mention_labels = np.asarray(mention_labels, dtype = np.int32), names_data = names_data, names_offsets = names_offsets)
+
+def load_mention_clusters(filename):
+  """
+  Loads a table saved by save_mention_clusters
+
+  :param filename: .npz file containing the table
+
+  :return mention_labels, cluster_names
+  """
+  with np.load(filename) as clusters:
+    return clusters['mention_labels'], decode_names(clusters['names_data'], clusters['names_offsets'])
+
+def get_predicted_clusters(IDs, software_mentions, mention_labels, cluster_names):
+  """
+  Joins mention IDs against the mention ID -> cluster ID table
+
+  :param IDs: array of mention IDs (e.g. 'SM123')
+  :param software_mentions: array of the corresponding mentions
+  :param mention_labels: array indexed by integer mention ID, with the index of the cluster of each mention in cluster_names (-1 if none)
+  :param cluster_names: array of cluster names
+
+  :return array of predicted clusters; mentions without a cluster (or with a malformed ID) are their own cluster
+  """
+  int_IDs = pd.to_numeric(pd.Series(IDs, dtype = object).str[len(ID_PREFIX):], errors = 'coerce').fillna(-1).astype(np.int64).values
+  in_range = (int_IDs >= 0) & (int_IDs < len(mention_labels))
+  labels = np.full(len(int_IDs), -1, dtype = np.int64)
+  labels[in_range] = mention_labels[int_IDs[in_range]]
+  predicted_clusters = np.array(software_mentions, dtype = object)
+  found = labels >= 0
+  predicted_clusters[found] = cluster_names[labels[found]]
+  return predicted_clusters
+
+def iter_record_chunks(f, chunk_size):
+  """
+  Reads the records of a tsv file, chunk_size records at a time.
+  A record spans several lines if a quoted value contains a newline, i.e. while its number of quotes is odd.
+
+  :param f: text file, positioned after the header
+  :param chunk_size: number of records per chunk
+
+  :return iterator over lists of records, each record being its raw text ending with a newline
+  """
+  records = []
+  pending = ''
+  for line in f:
+    pending += line
+    if pending.count('"') % 2 == 0:
+      records.append(pending)
+      pending = ''
+      if len(records) == chunk_size:
+        yield records
+        records = []
+  if pending:
+    records.append(pending)
+  if records:
+    if not records[-1].endswith('\n'):
+      records[-1] += '\n'
+    yield records
+
+def quote_field(value):
+  """
+  :param value: value of a tsv field
+
+  :return value, quoted if it contains a tab, a quote or a newline
+  """
+  if '\t' in value or '"' in value or '\n' in value or '\r' in value:
+    return '"' + value.replace('"', '""') + '"'
+  return value
+
+def apply_clusters(input_file, clusters_file, output_file, chunk_size = CHUNK_SIZE, compress_level = COMPRESS_LEVEL):
+  """
+  Streams the mentions file, and writes it with the 'predicted_cluster' field to a gzipped tsv file.
+  Only the 'ID' and 'software' fields are parsed; the raw text of every record is copied to the output, with the predicted cluster appended.
+
+  :param input_file: gzipped mentions file (e.g. comm_IDs.tsv.gz)
+  :param clusters_file: table saved by save_mention_clusters
+  :param output_file: gzipped output file
+  :param chunk_size: number of records processed at a time
+  :param compress_level: gzip compression level of the output
+
+  :return number of mentions, number of mentions with a predicted cluster other than themselves
+  """
+  mention_labels, cluster_names = load_mention_clusters(clusters_file)
+  num_rows = 0
+  num_changed = 0
+  with gzip.open(input_file, 'rt', encoding = 'utf-8', newline = '') as f_in, gzip.open(output_file, 'wt', compresslevel = compress_level, encoding = 'utf-8', newline = '') as f_out:
+    header = f_in.readline()
+    columns = next(csv.reader([header], delimiter = '\t'))
+    f_out.write(header.rstrip('\r\n') + '\tpredicted_cluster\n')
+    for records in iter_record_chunks(f_in, chunk_size):
+      chunk = pd.read_csv(io.StringIO(''.join(records)), sep = '\t', header = None, names = columns, usecols = ['ID', 'software'], dtype = object, na_filter = False)
+      if len(chunk) != len(records):
+        raise ValueError('Could not split ' + input_file + ' into records, after record ' + str(num_rows))
+      predicted_clusters = get_predicted_clusters(chunk['ID'].values, chunk['software'].values, mention_labels, cluster_names)
+      f_out.write(''.join([record.rstrip('\r\n') + '\t' + quote_field(x) + '\n' for record, x in zip(records, predicted_clusters)]))
+      num_rows += len(records)
+      num_changed += int(np.count_nonzero(predicted_clusters != chunk['software'].values))
+  return num_rows, num_changed
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+
+  parser.add_argument('--input_file', type=str, default = ROOT_DIR + 'input_files/comm_IDs.tsv.gz')
+  parser.add_argument('--clusters-file', type=str, help="Mention ID -> cluster table saved by clustering.py", default = ROOT_DIR + 'disambiguation_files/mention_clusters.npz')
+  parser.add_argument('--output_file', type=str, default = ROOT_DIR + 'output_files/comm_IDs_disambiguated.tsv.gz')
+  parser.add_argument('--chunk-size', type=int, help="Number of rows processed at a time", default = CHUNK_SIZE)
+  parser.add_argument('--compress-level', type=int, help="Gzip compression level of the output", default = COMPRESS_LEVEL)
+
+  args, _ = parser.parse_known_args()
+
+  t0 = time.time()
+  num_rows, num_changed = apply_clusters(args.input_file, args.clusters_file, args.output_file, args.chunk_size, args.compress_level)
+  print('- Saved', num_rows, 'mentions to', args.output_file + ',', num_changed, 'of them mapped to another mention')
+  print('Took', "{:.3f}".format(time.time()-t0), 's')
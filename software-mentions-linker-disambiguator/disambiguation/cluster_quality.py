@@ -0,0 +1,187 @@
+"""Cluster quality scores that scale to large connected components
+
+Details:
+    silhouette: silhouette coefficient over a fixed-seed sample of the mentions, so only a sample_size x sample_size distance matrix is built.
+    modularity, conductance: computed from the sparse similarity matrix (the synonym graph), in time linear in the number of edges.
+    cohesion: per-cluster stats (size, internal edges, density, mean internal similarity, conductance).
+    Noise points (label -1) are scored as singleton clusters by the graph scores, and as their own cluster by the silhouette, as in sklearn.
+
+Author:
+    Ana-Maria Istrate
+"""
+
+import numpy as np
+import pandas as pd
+from sklearn import metrics
+
+# Default number of mentions sampled for the silhouette coefficient
+SILHOUETTE_SAMPLE_SIZE = 2000
+
+# Seed of the silhouette sample, so scores are reproducible
+RANDOM_STATE = 0
+
+def get_silhouette_sample(labels, sample_size = SILHOUETTE_SAMPLE_SIZE, random_state = RANDOM_STATE):
+  """
+  Samples mentions for the silhouette coefficient, so that every label is represented:
+  up to two mentions of each label are drawn first, then the rest of the sample is drawn from the remaining mentions.
+  A uniform sample of a component with a dominant cluster could otherwise contain a single label.
+
+  :param labels: cluster label of each mention
+  :param sample_size: number of mentions sampled; all mentions if there are fewer
+  :param random_state: seed of the sample
+
+  :return sorted indices of the sampled mentions
+  """
+  labels = np.asarray(labels)
+  if len(labels) <= sample_size:
+    return np.arange(len(labels))
+  order = np.random.RandomState(random_state).permutation(len(labels))
+  # Rank of each mention among the mentions of its label, in the random order
+  by_label = np.argsort(labels[order], kind = 'stable')
+  sorted_labels = labels[order][by_label]
+  starts = np.flatnonzero(np.r_[True, sorted_labels[1:] != sorted_labels[:-1]])
+  ranks = np.empty(len(labels), dtype = np.int64)
+  ranks[by_label] = np.arange(len(labels)) - np.repeat(starts, np.diff(np.r_[starts, len(labels)]))
+  return np.sort(order[np.argsort(ranks >= 2, kind = 'stable')][:sample_size])
+
+def sampled_silhouette_score(sim_matrix, labels, sample_size = SILHOUETTE_SAMPLE_SIZE, random_state = RANDOM_STATE):
+  """
+  Computes the silhouette coefficient of a clustering over a sample of the mentions (see get_silhouette_sample), using 1 - similarity as distance
+
+  :param sim_matrix: sparse similarity matrix of the mentions, with ones on the diagonal
+  :param labels: cluster label of each mention
+  :param sample_size: number of mentions sampled; all mentions if there are fewer
+  :param random_state: seed of the sample
+
+  :return silhouette coefficient, or nan if the sample has a single label (or one label per mention)
+  """
+  labels = np.asarray(labels)
+  indices = get_silhouette_sample(labels, sample_size, random_state)
+  sample_labels = labels[indices]
+  num_labels = len(np.unique(sample_labels))
+  if num_labels < 2 or num_labels > len(indices) - 1:
+    return float('nan')
+  distance_matrix = 1 - sim_matrix[indices][:, indices].toarray()
+  np.fill_diagonal(distance_matrix, 0)
+  return metrics.silhouette_score(distance_matrix, sample_labels, metric = 'precomputed')
+
+def get_community_labels(labels):
+  """
+  Turns noise points (label -1) into singleton clusters, and relabels clusters as 0..num_clusters-1
+
+  :param labels: cluster label of each mention
+
+  :return community labels, num_communities
+  """
+  labels = np.asarray(labels).copy()
+  if len(labels) == 0:
+    return labels, 0
+  noise = labels == -1
+  labels[noise] = labels.max() + 1 + np.arange(np.count_nonzero(noise))
+  communities, labels = np.unique(labels, return_inverse = True)
+  return labels, len(communities)
+
+def get_graph_stats(sim_matrix, labels):
+  """
+  Sums the edge weights of the similarity graph per cluster, ignoring the diagonal
+
+  :param sim_matrix: sparse similarity matrix of the mentions (symmetric)
+  :param labels: community labels (see get_community_labels)
+
+  :return internal, volume, total: weight of the internal edges of each cluster (counted in both directions),
+  sum of the degrees of each cluster, and sum of all degrees
+  """
+  m = sim_matrix.tocoo()
+  off_diagonal = m.row != m.col
+  rows, cols, weights = m.row[off_diagonal], m.col[off_diagonal], m.data[off_diagonal].astype(np.float64)
+  num_communities = labels.max() + 1 if len(labels) > 0 else 0
+  same = labels[rows] == labels[cols]
+  internal = np.bincount(labels[rows[same]], weights = weights[same], minlength = num_communities)
+  volume = np.bincount(labels[rows], weights = weights, minlength = num_communities)
+  return internal, volume, weights.sum()
+
+def modularity(sim_matrix, labels):
+  """
+  Computes the modularity of a clustering over the weighted similarity graph
+
+  :param sim_matrix: sparse similarity matrix of the mentions (symmetric)
+  :param labels: cluster label of each mention
+
+  :return modularity, in [-0.5, 1]; 0 for a graph without edges
+  """
+  labels, _ = get_community_labels(labels)
+  internal, volume, total = get_graph_stats(sim_matrix, labels)
+  if total == 0:
+    return 0.0
+  return float(internal.sum() / total - ((volume / total) ** 2).sum())
+
+def get_conductance(internal, volume, total):
+  """
+  :param internal, volume, total: graph stats of the communities (see get_graph_stats)
+
+  :return conductance of each community
+  """
+  denominator = np.minimum(volume, total - volume)
+  cut = volume - internal
+  return np.divide(cut, denominator, out = np.zeros_like(cut), where = denominator > 0)
+
+def conductance(sim_matrix, labels):
+  """
+  Computes the conductance of each cluster over the weighted similarity graph:
+  weight of the edges leaving the cluster, divided by the smallest of the volumes of the cluster and of the rest of the graph
+
+  :param sim_matrix: sparse similarity matrix of the mentions (symmetric)
+  :param labels: cluster label of each mention
+
+  :return conductance of each community (see get_community_labels), in [0, 1]; 0 for clusters without edges
+  """
+  labels, _ = get_community_labels(labels)
+  return get_conductance(*get_graph_stats(sim_matrix, labels))
+
+def cohesion_stats(sim_matrix, labels):
+  """
+  Computes per-cluster cohesion stats over the weighted similarity graph
+
+  :param sim_matrix: sparse similarity matrix of the mentions (symmetric)
+  :param labels: cluster label of each mention
+
+  :return df with one row per cluster (noise points excluded), with fields
+  ['label', 'size', 'internal_edges', 'density', 'mean_similarity', 'conductance']
+  """
+  labels = np.asarray(labels)
+  community_labels, num_communities = get_community_labels(labels)
+  internal, volume, total = get_graph_stats(sim_matrix, community_labels)
+  m = sim_matrix.tocoo()
+  internal_pairs = (m.row != m.col) & (community_labels[m.row] == community_labels[m.col])
+  internal_edges = np.bincount(community_labels[m.row[internal_pairs]], minlength = num_communities) / 2
+  internal_weights = internal / 2
+  _, first, sizes = np.unique(community_labels, return_index = True, return_counts = True)
+  max_edges = sizes * (sizes - 1) / 2
+  df = pd.DataFrame({
+    'label' : labels[first],
+    'size' : sizes,
+    'internal_edges' : internal_edges.astype(np.int64),
+    'density' : np.divide(internal_edges, max_edges, out = np.ones(num_communities), where = max_edges > 0),
+    'mean_similarity' : np.divide(internal_weights, internal_edges, out = np.full(num_communities, np.nan), where = internal_edges > 0),
+    'conductance' : get_conductance(internal, volume, total)})
+  return df[df['label'] != -1].sort_values(by = 'label').reset_index(drop = True)
+
+def score_clustering(sim_matrix, labels, sample_size = SILHOUETTE_SAMPLE_SIZE, random_state = RANDOM_STATE):
+  """
+  Scores a clustering of a component
+
+  :param sim_matrix: sparse similarity matrix of the mentions of the component, with ones on the diagonal
+  :param labels: cluster label of each mention
+  :param sample_size: number of mentions sampled for the silhouette coefficient
+  :param random_state: seed of the silhouette sample
+
+  :return dict with 'num_clusters', 'num_noise', 'silhouette', 'modularity' and 'mean_conductance' (weighted by cluster size)
+  """
+  labels = np.asarray(labels)
+  stats = cohesion_stats(sim_matrix, labels)
+  return {
+    'num_clusters' : len(stats),
+    'num_noise' : int(np.count_nonzero(labels == -1)),
+    'silhouette' : sampled_silhouette_score(sim_matrix, labels, sample_size, random_state),
+    'modularity' : modularity(sim_matrix, labels),
+    'mean_conductance' : float(np.average(stats['conductance'], weights = stats['size'])) if len(stats) > 0 else float('nan')}
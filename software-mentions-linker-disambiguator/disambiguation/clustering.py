@@ -3,13 +3,17 @@
 """Clusters plain text software mentions using DBSCAN or HDBSCAN
 
 Usage:
-    python clustering.py --input-file <input_file>
+    python clustering.py --synonym-graph-file <synonym_graph_file>
 
 Details:
     Builds a similarity matrix based on synonym data.
     Finds connected components in similarity matrix.
-    Uses DBSCAN to cluster a number of connected components into smaller clusters.
+    Uses DBSCAN to cluster a number of connected components into smaller clusters: the largest one by default,
+    or every component of at least --min-component-size mentions, in parallel across --num-processes processes.
     Assigns the cluster name to the mention with the highest frequency according to a given freq_dict.
+    Saves a mention ID -> cluster table (mention_clusters.npz), which apply_clusters.py applies to the full mentions file.
+    Saves the state of the run (clustering_state.npz, see clustering_state.py). With --previous-state-file, runs incrementally:
+    only the connected components that changed since the previous run are clustered again, and the other ones keep their clusters and cluster names.
 
 Author:
     Ana-Maria Istrate
@@ -18,107 +22,95 @@ Author:
 import pandas as pd
 import pickle
 from sklearn.cluster import DBSCAN
-from scipy.sparse import csr_matrix
+from scipy.sparse import csr_matrix, identity
 import numpy as np
 from sklearn.decomposition import TruncatedSVD
 # import hdbscan
 from scipy.sparse.csgraph import connected_components
 import argparse
+import os
+import tempfile
 import time
+from concurrent.futures import ProcessPoolExecutor
+from synonym_graph import SynonymGraph
+from apply_clusters import save_mention_clusters
+from cluster_quality import SILHOUETTE_SAMPLE_SIZE, score_clustering, cohesion_stats, modularity
+from clustering_state import save_clustering_state, load_clustering_state, match_nodes, get_changed_components, count_changed_mentions
 
 ROOT_DIR = "../data/"
 
-def get_clusters(df):
-  """
-  Parses clusters and confidence scores from a given df containing pairs of synonyms and confidence scores
-
-  :param df: dataframe containing pairs of synonyms and similarity confidence scores
-
-  :return clusters: mapping from software mention to a dictionary containing {synonym : synonym_confidence}
-  """
-  clusters = {}
-  for software_mention, synonyms, synonyms_confs in zip(df['software_mention'].values, df['synonym'].values, df['synonym_conf'].values):
-    software_mention_mapping = {}
-    for synonym, synonym_conf in zip(synonyms, synonyms_confs):
-      if synonym in software_mention_mapping:
-        if synonym_conf > software_mention_mapping[synonym]:
-          software_mention_mapping[synonym] = synonym_conf
-      else:
-        software_mention_mapping[synonym] = synonym_conf
-    clusters[software_mention] = software_mention_mapping
-  return clusters
+# Distance stored for pairs at distance 0 in sparse distance matrices, since sparse matrices drop explicit zeros
+MIN_DISTANCE = 1e-10
 
-def get_sim_matrix(words, clusters):
+def get_sim_matrix(words, adjacency):
   """
-  Builds a similarity matrix for a given array of words, based on similarity scores found in initial_clusters 
+  Builds a similarity matrix for a given array of words, based on similarity scores found in the synonym graph.
+  Synonym pairs are mapped to matrix indices with vectorized lookups; a pair listed in both directions gets the highest of its two confidences.
 
-  :param words: array of words to build similarity matrix for
-  :param initial_clusters: mapping from software mention to a dictionary containing {synonym : synonym_confidence}
+  :param words: array of node IDs of the words to build similarity matrix for
+  :param adjacency: CSR adjacency of the synonym graph (see SynonymGraph.to_csr_matrix)
 
-  :return m: similarity_matrix
+  :return m: similarity_matrix, with ones on the diagonal
   """
-  words_unique = set(words)
+  words = np.asarray(words)
   num_words = len(words)
-  row = []
-  col = []
-  data = []
-
-  word2idx = {word : idx for idx, word in enumerate(words)}
-  keys = clusters.keys()
-  seen = set()
-  for i, w1 in enumerate(words):
-    row.append(i)
-    col.append(i)
-    data.append(1.0)
-    if w1 in clusters:
-      synonyms = clusters[w1]
-      
-      for w2, w1w2_conf in synonyms.items():
-        if w1 != w2 and w2 in words_unique and (w1, w2) not in seen:
-          seen.add((w1, w2))
-          w2_idx = word2idx[w2]
-          row.extend([i])
-          col.extend([w2_idx])
-          d = w1w2_conf
-          data.extend([d])
-          
-        if w1 != w2 and w2 in words_unique and (w2, w1) not in seen:
-          seen.add((w2, w1))
-          row.extend([w2_idx])
-          col.extend([i])
-          data.extend([d])
-  m = csr_matrix((np.array(data), (np.array(row), np.array(col))))
+  pairs = adjacency[words].tocoo()
+  col = pd.Index(words).get_indexer(pairs.col)
+  keep = (col >= 0) & (col != pairs.row)
+  m = csr_matrix((pairs.data[keep].astype(np.float64), (pairs.row[keep], col[keep])), shape = (num_words, num_words))
+  m = m.maximum(m.T) + identity(num_words, format = 'csr')
   return m
 
-def get_connected_components(n_components, labels, words):
+def get_connected_components(n_components, labels, words, graph):
   """
-  Retrieves connected components and associated distance matrices for a given array of words 
+  Retrieves connected components for a given array of words.
+  Distance matrices are not materialized here, but only for the components that get clustered (see get_distance_matrix).
 
   :param n_components: total number of connected components (cc)
   :param labels: array containing cc mappings; e.g. words[i] is part of the labels[i]'th cc
-  :param words: array of words to get connected components for
+  :param words: array of node IDs of the words to get connected components for
+  :param graph: SynonymGraph, to look up the names of the words
 
   :return components: mapping from {n_component: words}
-  :return matrices: mapping from {n_component: distance_matrix corresponding to words}
+  :return component_indices: mapping from {n_component: indices of the words of the component, i.e. rows of the similarity matrix}
   """
   components = {}
-  matrices = {}
+  component_indices = {}
   labels = np.array(labels)
   words = np.array(words)
+  order = np.argsort(labels, kind = 'stable')
+  bounds = np.concatenate([[0], np.cumsum(np.bincount(labels, minlength = n_components))])
   for n_component in range(n_components):
-    indices = np.where(labels == n_component)[0]
-    cc = words[indices]
-    components[n_component] = cc
-    matrix = get_sim_matrix(cc, clusters)
-    matrices[n_component] =   1 - matrix.toarray()
-  return components, matrices
-
-def get_predictions_cc_n(matrices, components, eps, n, verbose, min_samples, freq_dict, metric = 'precomputed', threshold = 1.0, hdbscan_flag = True):
+    indices = order[bounds[n_component]:bounds[n_component + 1]]
+    components[n_component] = graph.get_names(words[indices])
+    component_indices[n_component] = indices
+  return components, component_indices
+
+def get_distance_matrix(sim_matrix, indices, eps):
   """
-  Clusters given distance matrices using DBSCAN or HDBSCAN
+  Builds the sparse distance matrix (1 - similarity) of a component, for DBSCAN with metric = 'precomputed'.
+  Only pairs within distance eps are stored, since DBSCAN only looks at neighbors within eps; 
+  pairs that aren't stored are not neighbors. Zero distances (e.g. the diagonal) are stored as MIN_DISTANCE, so they aren't dropped as zeros.
 
-  :param matrices: distance matrices
+  :param sim_matrix: similarity matrix of all words (see get_sim_matrix)
+  :param indices: indices of the words of the component
+  :param eps: eps value for DBSCAN
+
+  :return distance_matrix: CSR matrix of shape (len(indices), len(indices))
+  """
+  m = sim_matrix[indices][:, indices].tocoo()
+  distances = 1 - m.data
+  keep = distances <= eps
+  distances = np.maximum(distances[keep], MIN_DISTANCE)
+  return csr_matrix((distances, (m.row[keep], m.col[keep])), shape = m.shape)
+
+def get_predictions_cc_n(sim_matrix, components, component_indices, eps, n, verbose, min_samples, freq_dict, metric = 'precomputed', threshold = 1.0, hdbscan_flag = True):
+  """
+  Clusters the n'th component using DBSCAN (on its sparse distance matrix) or HDBSCAN (on its dense distance matrix)
+
+  :param sim_matrix: similarity matrix of all words
   :param components: connected components
+  :param component_indices: indices of the words of each component in sim_matrix
   :param eps: eps value for DBSCAN
   :param n: the index of the component to get predictions for
   :param min_samples: min_samples value for DBSCAN; also used as min_cluster_size for HDBSCAN
@@ -133,19 +125,102 @@ def get_predictions_cc_n(matrices, components, eps, n, verbose, min_samples, fre
   :return labels: cluster labels for words in the n'th component
   """
   t1 = time.time()
-  sim_matrix = matrices[n]
+  indices = component_indices[n]
 
   if hdbscan_flag:
-    clusterer = hdbscan.HDBSCAN(min_cluster_size = min_samples,  min_samples = 1, metric = metric).fit(sim_matrix) 
+    distance_matrix = 1 - sim_matrix[indices][:, indices].toarray()
+    clusterer = hdbscan.HDBSCAN(min_cluster_size = min_samples,  min_samples = 1, metric = metric).fit(distance_matrix) 
     labels = clusterer.labels_
     probabilities = clusterer.probabilities_
   else:
+    distance_matrix = get_distance_matrix(sim_matrix, indices, eps)
     dbscan = DBSCAN(min_samples=min_samples, eps = eps, metric = metric)
-    labels = dbscan.fit_predict(sim_matrix)
+    labels = dbscan.fit_predict(distance_matrix)
     probabilities = []
   pred_clusters = print_clusters(components[n], labels, probabilities, freq_dict, verbose, threshold)
   return pred_clusters, labels
 
+def save_component_matrices(sim_matrix, component_indices, arr, directory):
+  """
+  Saves the similarity matrices of the components in arr as a single block-diagonal CSR matrix,
+  with its indptr, indices and data in .npy files, so worker processes can memory-map them instead of receiving copies
+
+  :param sim_matrix: similarity matrix of all words
+  :param component_indices: indices of the words of each component in sim_matrix
+  :param arr: components to save
+  :param directory: directory to save the .npy files to
+
+  :return bounds: mapping from {n_component: (start, end)}, the rows (and columns) of the component in the saved matrix
+  """
+  sizes = [len(component_indices[n]) for n in arr]
+  starts = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+  indices = np.concatenate([component_indices[n] for n in arr]) if len(arr) > 0 else np.array([], dtype = np.int64)
+  # Components are not connected to each other, so the matrix is block diagonal
+  m = sim_matrix[indices][:, indices].tocsr()
+  np.save(os.path.join(directory, 'indptr.npy'), m.indptr.astype(np.int64))
+  np.save(os.path.join(directory, 'indices.npy'), m.indices)
+  np.save(os.path.join(directory, 'data.npy'), m.data)
+  return {n : (starts[i], starts[i + 1]) for i, n in enumerate(arr)}
+
+def load_component_matrix(directory, start, end):
+  """
+  Loads the similarity matrix of a component saved by save_component_matrices, reading only its rows from the memory-mapped files
+
+  :param directory: directory of the .npy files
+  :param start, end: rows of the component in the saved matrix
+
+  :return sim_matrix: CSR matrix of shape (end - start, end - start)
+  """
+  indptr = np.array(np.load(os.path.join(directory, 'indptr.npy'), mmap_mode = 'r')[start:end + 1])
+  indices = np.array(np.load(os.path.join(directory, 'indices.npy'), mmap_mode = 'r')[indptr[0]:indptr[-1]]) - start
+  data = np.array(np.load(os.path.join(directory, 'data.npy'), mmap_mode = 'r')[indptr[0]:indptr[-1]])
+  return csr_matrix((data, indices, indptr - indptr[0]), shape = (end - start, end - start))
+
+def cluster_component(directory, n, start, end, eps, min_samples, silhouette_sample_size):
+  """
+  Clusters a component saved by save_component_matrices using DBSCAN, and scores the clustering; runs in a worker process
+
+  :param directory: directory of the .npy files
+  :param n: the index of the component
+  :param start, end: rows of the component in the saved matrix
+  :param eps: eps value for DBSCAN
+  :param min_samples: min_samples value for DBSCAN
+  :param silhouette_sample_size: number of mentions sampled to compute the silhouette coefficient
+
+  :return n, labels, scores: cluster labels of the words of the component, and its scores (None if DBSCAN found a single label)
+  """
+  sim_matrix = load_component_matrix(directory, start, end)
+  distance_matrix = get_distance_matrix(sim_matrix, np.arange(end - start), eps)
+  labels = DBSCAN(min_samples = min_samples, eps = eps, metric = 'precomputed').fit_predict(distance_matrix)
+  scores = score_clustering(sim_matrix, labels, silhouette_sample_size) if len(set(labels)) > 1 else None
+  return n, labels, scores
+
+def get_component_labels_parallel(sim_matrix, component_indices, arr, eps, min_samples, silhouette_sample_size, num_processes):
+  """
+  Clusters the components in arr with DBSCAN across a pool of processes.
+  Component matrices are shared through memory-mapped files in a temporary directory, and the largest components are submitted first.
+
+  :param sim_matrix: similarity matrix of all words
+  :param component_indices: indices of the words of each component in sim_matrix
+  :param arr: components to cluster
+  :param eps: eps value for DBSCAN
+  :param min_samples: min_samples value for DBSCAN
+  :param silhouette_sample_size: number of mentions sampled to compute the silhouette coefficient of a component
+  :param num_processes: number of worker processes
+
+  :return results: mapping from {n_component: (labels, scores)} (see cluster_component)
+  """
+  results = {}
+  with tempfile.TemporaryDirectory() as directory:
+    bounds = save_component_matrices(sim_matrix, component_indices, arr, directory)
+    with ProcessPoolExecutor(max_workers = num_processes) as executor:
+      futures = [executor.submit(cluster_component, directory, n, start, end, eps, min_samples, silhouette_sample_size)
+                 for n, (start, end) in sorted(bounds.items(), key = lambda x: x[1][0] - x[1][1])]
+      for future in futures:
+        n, labels, scores = future.result()
+        results[n] = (labels, scores)
+  return results
+
 def get_main_cluster(sorted_dict, samples):
   """
   Get main cluster for a list of samples. Chooses the sample with the highest frequency in sorted_dict
@@ -169,7 +244,7 @@ def get_main_cluster(sorted_dict, samples):
 
 def print_clusters(words, labels, probabilities, sorted_dict, verbose = True, threshold = 1.0):
   """
-  Maps words to predicted clusters 
+  Maps words to predicted clusters. The members of all clusters are grouped with a single argsort of labels.
 
   :param words: words to map
   :param labels: array containing word mappings; e.g. words[i] is part of cluster labels[i]
@@ -181,67 +256,74 @@ def print_clusters(words, labels, probabilities, sorted_dict, verbose = True, th
   :return clusters: 
   """ 
   clusters = {}
-  for c in set(labels):
-    c_words = np.array(words)[np.where(np.array(labels) == c)[0]]
-    if c != -1: 
-      if len(probabilities) > 0:
-        c_probs = np.array(probabilities)[np.where(np.array(labels) == c)[0]]
-        c_new_words = []
-        for x, y in zip(c_words, c_probs):
-          if y >= threshold:
-            c_new_words.append(x)
-        cluster_name = get_main_cluster(sorted_dict, c_new_words)
-      else:
-        cluster_name = get_main_cluster(sorted_dict, c_words)
-      clusters[cluster_name] = c_words
-      if verbose:
-        print('Cluster', c, cluster_name)
-        print('*' * 10)
-        print(c_words)
-        print('\n')
+  words = np.asarray(words)
+  labels = np.asarray(labels)
+  probabilities = np.asarray(probabilities)
+  order = np.argsort(labels, kind = 'stable')
+  unique_labels, starts = np.unique(labels[order], return_index = True)
+  ends = np.append(starts[1:], len(order))
+  for c, start, end in zip(unique_labels, starts, ends):
+    if c == -1:
+      continue
+    members = order[start:end]
+    c_words = words[members]
+    if len(probabilities) > 0:
+      c_new_words = c_words[probabilities[members] >= threshold]
+      cluster_name = get_main_cluster(sorted_dict, c_new_words)
+    else:
+      cluster_name = get_main_cluster(sorted_dict, c_words)
+    clusters[cluster_name] = c_words
+    if verbose:
+      print('Cluster', c, cluster_name)
+      print('*' * 10)
+      print(c_words)
+      print('\n')
   return clusters
 
-def find_cluster(x, clusters):
+def get_predicted_clusters(sim_matrix, components, component_indices, arr, dbscan_eps, dbscan_min_samples, freq_dict, silhouette_sample_size = SILHOUETTE_SAMPLE_SIZE, num_processes = 1):
   """
-  Returns the cluster for a given software mention x
-
-  :param x: mention to get the cluster for
-  :param clusters: predicted clusters
+  Gets predicted clusters for the connected components of a similarity matrix.
+  With num_processes > 1, the components in arr are clustered in parallel (see get_component_labels_parallel);
+  their clusters are then merged in component order, as in the serial loop, so the result doesn't depend on the order in which workers finish.
 
-  :return k: cluster for mention x
-  """
-  for k, v in clusters.items():
-    v_set = set(v)
-    if x in v_set:
-      return k
-  return x
-    
-def get_predicted_clusters(matrices, components, arr, dbscan_eps, dbscan_min_samples, freq_dict):
-  """
-  Gets predicted clusters for an array of given distance matrices corresponding to components
-
-  :param matrices: array of distance matrices
+  :param sim_matrix: similarity matrix of all words
   :param components: connected components
+  :param component_indices: indices of the words of each component in sim_matrix
   :param arr: components in this array will be clustered further using DBSCAN/HDBSCAN
   :param dbscan_eps: epsilon value to use for DBSCAN/HDBSCAN clustering
   :param dbscan_min_samples: min_samples value for DBSCAN; also used as min_cluster_size for HDBSCAN
   :param freq_dict: mapping from mention to frequency
+  :param silhouette_sample_size: number of mentions sampled to compute the silhouette coefficient of a component (see cluster_quality.py)
+  :param num_processes: number of processes clustering the components in arr
 
   :return all_clusters: final predicted clusters, mapping from {cluster: cluster_entries}
   """
   all_clusters = {}
   threshold = 0.0
-  m = {}
   metric = 'precomputed'
   num_components = len(components)
+  results = {}
+  if num_processes > 1:
+    results = get_component_labels_parallel(sim_matrix, component_indices, arr, dbscan_eps, dbscan_min_samples, silhouette_sample_size, num_processes)
+  arr = set(arr)
   for n in range(num_components):
     if n in arr:
-      pred_c_n, labels = get_predictions_cc_n(matrices, components, dbscan_eps, n, False, dbscan_min_samples, freq_dict, metric, 0.3, hdbscan_flag = False)
-      if len(set(labels)) > 1:
-        silhouette_threshold = metrics.silhouette_score(matrices[n], labels, metric = metric)
-        m[n] = (silhouette_threshold, pred_c_n)
-        print("Component", n, "Silhouette Coefficient: %0.3f" % silhouette_threshold)
-        if silhouette_threshold > threshold:
+      if n in results:
+        labels, scores = results[n]
+        pred_c_n = print_clusters(components[n], labels, [], freq_dict, False, 0.3)
+      else:
+        pred_c_n, labels = get_predictions_cc_n(sim_matrix, components, component_indices, dbscan_eps, n, False, dbscan_min_samples, freq_dict, metric, 0.3, hdbscan_flag = False)
+        scores = score_clustering(sim_matrix[component_indices[n]][:, component_indices[n]], labels, silhouette_sample_size) if len(set(labels)) > 1 else None
+      if scores is not None:
+        silhouette_threshold = scores['silhouette']
+        print("Component", n, "Silhouette Coefficient: %0.3f" % silhouette_threshold, "Modularity: %0.3f" % scores['modularity'], 
+              "Mean conductance: %0.3f" % scores['mean_conductance'])
+        if np.isnan(silhouette_threshold):
+          # The silhouette is undefined (e.g. every sampled mention has its own label): judge the clusters by their modularity instead
+          keep_clusters = scores['modularity'] > threshold
+        else:
+          keep_clusters = silhouette_threshold > threshold
+        if keep_clusters:
           for k, v in pred_c_n.items():
              all_clusters[k] = v
         else:
@@ -252,32 +334,93 @@ def get_predicted_clusters(matrices, components, arr, dbscan_eps, dbscan_min_sam
       all_clusters[cluster_name] = components[n]
   return all_clusters
  
-def get_mention2cluster(all_clusters):
+def get_cluster_labels(all_clusters, word_index):
   """
-  Returns mention2cluster mapping
+  Builds a label array over words from predicted clusters
 
   :param all_clusters: predicted clusters, mapping from {cluster: cluster_entries}
+  :param word_index: pd.Index of the words
 
-  :return mention2cluster: mapping from {mention: cluster_name}
+  :return labels: index in cluster_names of the cluster of each word; -1 for words without a cluster
+  :return cluster_names: array of cluster names
   """
-  mention2cluster = {}
-  for k, v in all_clusters.items():
-    for v1 in v: 
-      mention2cluster[v1] = k
-  return mention2cluster
+  labels = np.full(len(word_index), -1, dtype = np.int64)
+  cluster_names = np.empty(len(all_clusters), dtype = object)
+  for label, (k, v) in enumerate(all_clusters.items()):
+    cluster_names[label] = k
+    positions = word_index.get_indexer(v)
+    labels[positions[positions >= 0]] = label
+  return labels, cluster_names
+
+def update_cluster_labels(previous_state, old2new, changed, predicted_clusters, word_index):
+  """
+  Builds the label array over words of an incremental run: words of unchanged components keep their previous cluster and cluster name,
+  and words of changed components get the clusters predicted for them. Cluster names without words left are dropped.
+
+  :param previous_state: state of the previous run (see load_clustering_state)
+  :param old2new: position of each previous word in the current words (see match_nodes)
+  :param changed: boolean array, True for the words of changed components (see get_changed_components)
+  :param predicted_clusters: predicted clusters of the changed components, mapping from {cluster: cluster_entries}
+  :param word_index: pd.Index of the words
+
+  :return labels: index in cluster_names of the cluster of each word; -1 for words without a cluster
+  :return cluster_names: array of cluster names
+  """
+  matched = old2new >= 0
+  labels = np.full(len(word_index), -1, dtype = np.int64)
+  labels[old2new[matched]] = previous_state['cluster_labels'][matched]
+  labels[changed] = -1
+  cluster_names = list(previous_state['cluster_names'])
+  name2label = {name : label for label, name in enumerate(cluster_names)}
+  for k, v in predicted_clusters.items():
+    if k not in name2label:
+      name2label[k] = len(cluster_names)
+      cluster_names.append(k)
+    positions = word_index.get_indexer(v)
+    labels[positions[positions >= 0]] = name2label[k]
+
+  used = np.unique(labels[labels >= 0])
+  # The extra last entry maps label -1 to itself
+  new_labels = np.full(len(cluster_names) + 1, -1, dtype = np.int64)
+  new_labels[used] = np.arange(len(used))
+  return new_labels[labels], np.array(cluster_names, dtype = object)[used]
+
+def map_clusters(mentions, word_index, labels, cluster_names):
+  """
+  Maps an array of mentions to their predicted clusters, with vectorized lookups; mentions without a cluster are mapped to themselves
+
+  :param mentions: array of mentions
+  :param word_index: pd.Index of the words
+  :param labels: cluster label of each word (see get_cluster_labels)
+  :param cluster_names: array of cluster names
+
+  :return array of predicted clusters
+  """
+  predicted_clusters = np.asarray(mentions, dtype = object).copy()
+  positions = word_index.get_indexer(predicted_clusters)
+  mention_labels = np.where(positions >= 0, labels[positions], -1)
+  found = mention_labels >= 0
+  predicted_clusters[found] = cluster_names[mention_labels[found]]
+  return predicted_clusters
 
 if __name__ == '__main__':
   parser = argparse.ArgumentParser()
 
   parser.add_argument('--synonyms-file', type=str, default = ROOT_DIR + 'disambiguated_files/synonyms.csv')
+  parser.add_argument('--synonym-graph-file', type=str, help="Synonym graph saved by combine_all_synonyms.py", default = ROOT_DIR + 'disambiguation_files/synonym_graph.npz')
   parser.add_argument('--output-disambiguated-file', type=str, default = ROOT_DIR + 'output_files/mentions_disambiguated.tsv')
   parser.add_argument('--freq_dict', type=str, default = ROOT_DIR + 'intermediate_files/freq_dict.pkl')
-  parser.add_argument('--input_file', type=str, default = ROOT_DIR + 'input_files/comm_IDs.tsv.gz')
-  parser.add_argument('--output_file', type=str, default = ROOT_DIR + 'output_files/comm_IDs_disambiguated.tsv')
+  parser.add_argument('--clusters-file', type=str, help="Mention ID -> cluster table, applied to the mentions file by apply_clusters.py", default = ROOT_DIR + 'disambiguation_files/mention_clusters.npz')
+  parser.add_argument('--silhouette-sample-size', type=int, help="Number of mentions sampled to compute silhouette coefficients", default = SILHOUETTE_SAMPLE_SIZE)
+  parser.add_argument('--cluster-quality-file', type=str, help="If given, save cohesion stats of every predicted cluster to this file", default = None)
+  parser.add_argument('--min-component-size', type=int, help="If given, cluster every connected component with at least this many mentions, instead of only the largest one", default = None)
+  parser.add_argument('--num-processes', type=int, help="Number of processes clustering connected components", default = 1)
+  parser.add_argument('--state-file', type=str, help="File to save the state of this run to, for later incremental runs", default = ROOT_DIR + 'disambiguation_files/clustering_state.npz')
+  parser.add_argument('--previous-state-file', type=str, help="If given, only cluster again the connected components that changed since the run that saved this state", default = None)
 
   args, _ = parser.parse_known_args()
 
-  synonyms_df = pd.read_csv(args.synonyms_file)
+  graph = SynonymGraph.load(args.synonym_graph_file)
   freq_dict = pickle.load(open(args.freq_dict, 'rb'))
   # sample mentions for sanity checking
   sample_mentions = ['LIMMA', 'limma', 'Limma R package', 'Python', 'SciPy', 'scipy', 'stats', 'scikit-learn', 'sklearn', 'matplotlib', 'plotly', 'pandas', 'numpy', 'IMAGER', 'ImageJ', 'Image J', 'NIH ImageJ', 'ImageJ2', 'Fiji', 'NeuronJ', 'NeuronJ ImageJ', 'neuron', 'NEURON', 'BoneJ', 'SimPlot', 'Jupyter Notebook', 'Jupyter', 'iPython', 'iPython Notebook', 'ArcGIS', 'Stata', 'SAS', 'Affymetrix', 'Ringo', 'edgeR', 'Keras', 'CNN', 'AlexNet', 'ResNet', 'pytorch', 'DBSCAN', 'SPSS', 'SPSS®', 'BLAST', 'R Core Team', 'DAVID', 'GEPIA', 'GSEA', 'ggplot2', 'gplots', 'SVA', 'sva', 'SHELXTL', 'Stata', 'SAS', 'seqc', 'MAFFT', 'ClustalX', 'affy', 'glmer', 'Berkeley Madonna', 'Basic Local Alignment Search Tool (BLAST)', '(Basic Local Alignment Search Tool', 'MATLAB', 'DESeq2', 'codelink', 'beadarray', 'Lumi', 'car', 'Minimac', 'minimap2', 'Minim', 'statsmodels', 'seaborn', 'clusterProfiler', 'Chicago', 'ReactomeGSA', 'ReactomePA', 'Analysis', 'FASTX-Toolkit', 'FASTQC', 'GSVA', 'GOseq R package']
@@ -285,51 +428,91 @@ if __name__ == '__main__':
   dbscan_eps = 0.1
   dbscan_min_samples = 30
 
-  print(synonyms_df.head())
-  synonyms_df_aggregated = synonyms_df.groupby(['ID', 'software_mention']).agg(list).reset_index()
-  clusters = get_clusters(synonyms_df_aggregated)
-  clusters_arr = list(clusters.keys())
-  print('There are', len(clusters_arr), 'clusters')
+  adjacency = graph.to_csr_matrix()
+  print('There are', np.count_nonzero(np.diff(graph.indptr)), 'clusters')
+
+  words = graph.get_nodes()
+  sim_matrix = get_sim_matrix(words, adjacency)
+  word_index = pd.Index(graph.get_names(words))
+
+  if args.previous_state_file:
+    # Incremental mode: only the connected components that changed since the previous run are clustered again
+    previous_state = load_clustering_state(args.previous_state_file)
+    old2new = match_nodes(previous_state, words, word_index.values, graph.num_mentions)
+    changed, labels, stats = get_changed_components(previous_state, old2new, sim_matrix)
+    print('Since the previous run:', stats['num_new_edges'], 'new or updated edges,', stats['num_removed_edges'], 'removed edges,', 
+          stats['num_new_words'], 'new words,', stats['num_removed_words'], 'removed words;', stats['num_changed_components'], 'connected components changed')
+    changed_positions = np.flatnonzero(changed)
+    _, changed_labels = np.unique(labels[changed_positions], return_inverse = True)
+    components, component_indices = get_connected_components(changed_labels.max() + 1 if len(changed_labels) > 0 else 0, changed_labels, words[changed_positions], graph)
+    component_indices = {n : changed_positions[indices] for n, indices in component_indices.items()}
+    print('There are', labels.max() + 1, 'connected components,', len(components), 'of them new or changed')
+
+    # Same components as a full run: those with at least --min-component-size mentions, or else the largest one
+    min_component_size = args.min_component_size if args.min_component_size else np.bincount(labels).max()
+    arr = [comp_id for comp_id, indices in component_indices.items() if len(indices) >= min_component_size]
+  else:
+    n_components, labels = connected_components(csgraph=sim_matrix, directed=False, return_labels=True)
+    components, component_indices = get_connected_components(n_components, labels, words, graph)
+    num_components = len(components)
+    print('There are', num_components, 'connected components!')
 
-  words = []
-  for w in clusters:
-    words.extend(set([w] + list(clusters[w].keys())))
-  words = list(set(words))
-  sim_matrix = get_sim_matrix(words, clusters)
+    comp2len = {}
+    for comp_id, arr in components.items():
+      comp2len[(comp_id, get_main_cluster(freq_dict, arr))] = len(arr)
 
-  n_components, labels = connected_components(csgraph=sim_matrix, directed=False, return_labels=True)
-  components, matrices = get_connected_components(n_components, labels, words)
-  num_components = len(components)
-  print('There are', num_components, 'connected components!')
+    comp2entries = {}
+    for comp_id, arr in components.items():
+      comp2entries[(comp_id, get_main_cluster(freq_dict, arr))] = arr
 
-  comp2len = {}
-  for comp_id, arr in components.items():
-    comp2len[(comp_id, get_main_cluster(freq_dict, arr))] = len(arr)
+    sorted_comp2len = sorted(comp2len.items(), key = lambda x: -x[1])
 
-  comp2entries = {}
-  for comp_id, arr in components.items():
-    comp2entries[(comp_id, get_main_cluster(freq_dict, arr))] = arr
+    print('Here are the top 10 connected components:')
+    print(sorted_comp2len[:10])
 
-  sorted_comp2len = sorted(comp2len.items(), key = lambda x: -x[1])
+    if args.min_component_size:
+      arr = [comp_id for comp_id, indices in component_indices.items() if len(indices) >= args.min_component_size]
+    else:
+      # we are only using DBSCAN to cluster the first connected component
+      arr = [sorted_comp2len[0][0][0]]
 
-  print('Here are the top 10 connected components:')
-  print(sorted_comp2len[:10])
+  print('Clustering', len(arr), 'connected components with DBSCAN, across', args.num_processes, 'processes')
+  t0 = time.time()
+  predicted_clusters = get_predicted_clusters(sim_matrix, components, component_indices, arr, dbscan_eps, dbscan_min_samples, freq_dict, args.silhouette_sample_size, args.num_processes)
+  print('Took', "{:.3f}".format(time.time()-t0), 's clustering connected components')
 
-  # we are only using DBSCAN to cluster the first connected component
-  arr = [sorted_comp2len[0][0][0]]
-  print(arr)
-  predicted_clusters = get_predicted_clusters(matrices, components, arr, dbscan_eps, dbscan_min_samples, freq_dict)
-  mention2cluster = get_mention2cluster(predicted_clusters)
+  if args.previous_state_file:
+    word_labels, predicted_cluster_names = update_cluster_labels(previous_state, old2new, changed, predicted_clusters, word_index)
+  else:
+    word_labels, predicted_cluster_names = get_cluster_labels(predicted_clusters, word_index)
+  word_clusters = map_clusters(word_index, word_index, word_labels, predicted_cluster_names)
+  if args.previous_state_file:
+    num_changed, num_new = count_changed_mentions(previous_state, old2new, words, graph.num_mentions, word_clusters)
+    print(num_changed, 'mentions changed cluster since the previous run, and', num_new, 'new mentions were clustered')
+  save_clustering_state(args.state_file, words, word_index.values, graph.num_mentions, labels, word_labels, predicted_cluster_names, sim_matrix)
+  print('- Saved clustering state to', args.state_file)
+
+  # Score the predicted clusters of all components at once, over the whole similarity graph; words without a cluster are their own cluster
+  cluster_labels, cluster_names = pd.factorize(word_clusters)
+  print('Modularity of the predicted clusters: %0.3f' % modularity(sim_matrix, cluster_labels))
+  if args.cluster_quality_file:
+    quality_df = cohesion_stats(sim_matrix, cluster_labels)
+    quality_df.insert(0, 'predicted_cluster', cluster_names[quality_df['label'].values])
+    quality_df.drop(columns = ['label']).to_csv(args.cluster_quality_file, index = False)
+    print('- Saved cohesion stats of', len(quality_df), 'clusters to', args.cluster_quality_file)
 
   cols_of_interest = [['ID', 'software_mention', 'synonym', 'synonym_conf', 'synonym_source', 'synonym_ID',  'mapped_to']]
-  synonyms_df['predicted_cluster'] = synonyms_df['software_mention'].apply(lambda x: mention2cluster[x] if x in mention2cluster else x)
+  synonyms_df = pd.read_csv(args.synonyms_file)
+  synonyms_df['predicted_cluster'] = map_clusters(synonyms_df['software_mention'], word_index, word_labels, predicted_cluster_names)
   synonyms_df.to_csv(args.output_disambiguated_file, index = False, sep = '\t')
   
-  mentions_df = pd.read_csv(args.input_file, sep = '\\t', engine = 'python', compression = 'gzip')
-  mentions_df['predicted_cluster'] = synonyms_df['software_mention'].apply(lambda x: mention2cluster[x] if x in mention2cluster else x)
-  mentions_df.to_csv(args.output_file, index = False, sep = '\t')
+  # Mentions are nodes below graph.num_mentions, with their integer ID as node ID
+  mention_labels = np.full(graph.num_mentions, -1, dtype = np.int32)
+  is_mention = words < graph.num_mentions
+  mention_labels[words[is_mention]] = word_labels[is_mention]
+  save_mention_clusters(args.clusters_file, mention_labels, predicted_cluster_names)
+  print('- Saved mention clusters to', args.clusters_file, '; run apply_clusters.py to add them to the mentions file')
 
   print('Here are some examples of disambiguated mentions: ')
-  for x in sample_mentions:
-    x_component = find_cluster(x, predicted_clusters)
+  for x, x_component in zip(sample_mentions, map_clusters(sample_mentions, word_index, word_labels, predicted_cluster_names)):
     print("Mention: {0:30} Predicted cluster: {1}".format(x, x_component))
\ No newline at end of file
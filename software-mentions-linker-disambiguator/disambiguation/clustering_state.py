@@ -0,0 +1,218 @@
+"""State of a clustering run, so that later runs only re-cluster the connected components that changed
+
+Details:
+    The state holds, for every node of the similarity matrix: its node ID and name, its connected component and its cluster,
+    plus the cluster names and the edges of the similarity matrix (upper triangle).
+    Mentions are matched across runs by integer mention ID, other nodes (synonyms missing from mention2ID) by name.
+    New or updated edges are applied to the previous components with a union-find structure, to find the components they merge;
+    components that lost edges or nodes are marked as changed too, since they may split.
+
+Author:
+    Ana-Maria Istrate
+"""
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import triu
+from scipy.sparse.csgraph import connected_components
+from synonym_graph import encode_names, decode_names
+
+class UnionFind:
+  """
+  Disjoint sets over the integers 0..n-1, with path compression; the root of a set is its smallest element
+  """
+
+  def __init__(self, n):
+    """
+    :param n: number of elements
+    """
+    self.parent = list(range(n))
+
+  def find(self, x):
+    """
+    :param x: element
+
+    :return root of the set of x
+    """
+    root = x
+    while self.parent[root] != root:
+      root = self.parent[root]
+    while self.parent[x] != root:
+      self.parent[x], x = root, self.parent[x]
+    return root
+
+  def union(self, x, y):
+    """
+    Merges the sets of x and y
+
+    :param x, y: elements
+
+    :return root of the merged set
+    """
+    x, y = self.find(x), self.find(y)
+    root = min(x, y)
+    self.parent[max(x, y)] = root
+    return root
+
+  def get_roots(self):
+    """
+    :return array with the root of every element
+    """
+    roots = np.array(self.parent, dtype = np.int64)
+    while True:
+      next_roots = roots[roots]
+      if np.array_equal(next_roots, roots):
+        return roots
+      roots = next_roots
+
+def save_clustering_state(filename, words, names, num_mentions, component_labels, cluster_labels, cluster_names, sim_matrix):
+  """
+  Saves the state of a clustering run
+
+  :param filename: .npz file to save the state to
+  :param words: node IDs of the words of the similarity matrix
+  :param names: names of the words
+  :param num_mentions: number of node IDs reserved for mentions (see SynonymGraph)
+  :param component_labels: connected component of each word
+  :param cluster_labels: index in cluster_names of the cluster of each word; -1 for words without a cluster
+  :param cluster_names: array of cluster names
+  :param sim_matrix: similarity matrix of the words
+  """
+  names_data, names_offsets = encode_names(list(names))
+  cluster_names_data, cluster_names_offsets = encode_names(list(cluster_names))
+  edges = triu(sim_matrix, k = 1).tocoo()
+  np.savez(filename, node_IDs = np.asarray(words, dtype = np.int64), names_data = names_data, names_offsets = names_offsets, num_mentions = np.int64(num_mentions),
+           component_labels = np.asarray(component_labels, dtype = np.int64), cluster_labels = np.asarray(cluster_labels, dtype = np.int64),
+           cluster_names_data = cluster_names_data, cluster_names_offsets = cluster_names_offsets,
+           edge_rows = edges.row.astype(np.int64), edge_cols = edges.col.astype(np.int64), edge_weights = edges.data.astype(np.float32))
+
+def load_clustering_state(filename):
+  """
+  :param filename: .npz file saved by save_clustering_state
+
+  :return dict with 'node_IDs', 'names', 'num_mentions', 'component_labels', 'cluster_labels', 'cluster_names', 'edge_rows', 'edge_cols' and 'edge_weights'
+  """
+  with np.load(filename) as state:
+    return {
+      'node_IDs' : state['node_IDs'],
+      'names' : decode_names(state['names_data'], state['names_offsets']),
+      'num_mentions' : int(state['num_mentions']),
+      'component_labels' : state['component_labels'],
+      'cluster_labels' : state['cluster_labels'],
+      'cluster_names' : decode_names(state['cluster_names_data'], state['cluster_names_offsets']),
+      'edge_rows' : state['edge_rows'],
+      'edge_cols' : state['edge_cols'],
+      'edge_weights' : state['edge_weights']}
+
+def match_nodes(state, words, names, num_mentions):
+  """
+  Matches the words of a previous run to the words of the current one: mentions by integer mention ID (if their name didn't change), other nodes by name
+
+  :param state: previous state (see load_clustering_state)
+  :param words: node IDs of the current words (sorted)
+  :param names: names of the current words
+  :param num_mentions: number of node IDs reserved for mentions in the current graph
+
+  :return old2new: position of each previous word in words; -1 for words that are gone
+  """
+  words = np.asarray(words)
+  names = np.asarray(names, dtype = object)
+  old2new = np.full(len(state['node_IDs']), -1, dtype = np.int64)
+  old_is_mention = state['node_IDs'] < state['num_mentions']
+
+  positions = pd.Index(words).get_indexer(state['node_IDs'][old_is_mention])
+  found = positions >= 0
+  found[found] = (words[positions[found]] < num_mentions) & (names[positions[found]] == state['names'][old_is_mention][found])
+  old2new[np.flatnonzero(old_is_mention)[found]] = positions[found]
+
+  extra_positions = np.flatnonzero(words >= num_mentions)
+  positions = pd.Index(names[extra_positions]).get_indexer(state['names'][~old_is_mention])
+  found = positions >= 0
+  old2new[np.flatnonzero(~old_is_mention)[found]] = extra_positions[positions[found]]
+  return old2new
+
+def get_changed_components(state, old2new, sim_matrix):
+  """
+  Finds the words whose connected component changed since a previous run.
+  Edges that are new or whose similarity changed are applied to the previous components with a union-find structure;
+  components merged by them, and components that lost an edge or a word, are changed. New words start as their own component.
+  Words of unchanged components keep their previous component; connected components are recomputed over the changed words only.
+
+  :param state: previous state (see load_clustering_state)
+  :param old2new: position of each previous word in the current words (see match_nodes)
+  :param sim_matrix: similarity matrix of the current words
+
+  :return changed: boolean array, True for the words of changed components
+  :return component_labels: connected component of each current word, numbered 0..n_components-1
+  :return stats: dict with 'num_new_edges', 'num_removed_edges', 'num_new_words', 'num_removed_words' and 'num_changed_components' (previous components)
+  """
+  num_words = sim_matrix.shape[0]
+  num_old_components = int(state['component_labels'].max()) + 1 if len(state['component_labels']) > 0 else 0
+  matched = old2new >= 0
+
+  # Elements of the union-find: previous components, then one element per new word
+  elements = np.full(num_words, -1, dtype = np.int64)
+  elements[old2new[matched]] = state['component_labels'][matched]
+  is_new = elements < 0
+  elements[is_new] = num_old_components + np.arange(np.count_nonzero(is_new))
+  union_find = UnionFind(num_old_components + np.count_nonzero(is_new))
+
+  # Previous edges, as (row, col) positions in the current words, with row < col
+  old_rows, old_cols = old2new[state['edge_rows']], old2new[state['edge_cols']]
+  old_kept = (old_rows >= 0) & (old_cols >= 0)
+  old_rows, old_cols = np.minimum(old_rows, old_cols)[old_kept], np.maximum(old_rows, old_cols)[old_kept]
+  old_keys = pd.Index(old_rows * num_words + old_cols)
+  new_edges = triu(sim_matrix, k = 1).tocoo()
+  new_keys = pd.Index(new_edges.row.astype(np.int64) * num_words + new_edges.col)
+
+  positions = old_keys.get_indexer(new_keys)
+  added = positions < 0
+  added[~added] = state['edge_weights'][old_kept][positions[~added]] != new_edges.data[~added].astype(np.float32)
+  removed = new_keys.get_indexer(old_keys) < 0
+
+  for row, col in zip(elements[new_edges.row[added]], elements[new_edges.col[added]]):
+    union_find.union(row, col)
+  element_roots = union_find.get_roots()
+  dirty = np.zeros(len(element_roots), dtype = bool)
+  dirty[element_roots[elements[new_edges.row[added]]]] = True
+  dirty[element_roots[elements[old_rows[removed]]]] = True
+  dirty[element_roots[state['component_labels'][~matched]]] = True
+  roots = element_roots[elements]
+  changed = dirty[roots]
+
+  # Merges are exact, but removed edges may split components: recompute the components of the changed words
+  changed_positions = np.flatnonzero(changed)
+  if len(changed_positions) > 0:
+    _, sub_labels = connected_components(csgraph = sim_matrix[changed_positions][:, changed_positions], directed = False, return_labels = True)
+    roots[changed_positions] = len(element_roots) + sub_labels
+  _, component_labels = np.unique(roots, return_inverse = True)
+
+  stats = {
+    'num_new_edges' : int(np.count_nonzero(added)),
+    'num_removed_edges' : int(np.count_nonzero(removed) + np.count_nonzero(~old_kept)),
+    'num_new_words' : int(np.count_nonzero(is_new)),
+    'num_removed_words' : int(np.count_nonzero(~matched)),
+    'num_changed_components' : int(np.count_nonzero(dirty[element_roots[:num_old_components]]))}
+  return changed, component_labels, stats
+
+def count_changed_mentions(state, old2new, words, num_mentions, word_clusters):
+  """
+  Counts the mentions whose predicted cluster changed since a previous run
+
+  :param state: previous state (see load_clustering_state)
+  :param old2new: position of each previous word in the current words (see match_nodes)
+  :param words: node IDs of the current words
+  :param num_mentions: number of node IDs reserved for mentions in the current graph
+  :param word_clusters: predicted cluster of each current word; words without a cluster are their own cluster
+
+  :return num_changed: number of mentions of both runs with a different predicted cluster
+  :return num_new: number of mentions that are new in the current run
+  """
+  previous_clusters = state['names'].copy()
+  has_cluster = state['cluster_labels'] >= 0
+  previous_clusters[has_cluster] = state['cluster_names'][state['cluster_labels'][has_cluster]]
+  matched = (old2new >= 0) & (state['node_IDs'] < state['num_mentions'])
+  num_changed = int(np.count_nonzero(np.asarray(word_clusters, dtype = object)[old2new[matched]] != previous_clusters[matched]))
+  is_mention = np.asarray(words) < num_mentions
+  is_mention[old2new[old2new >= 0]] = False
+  return num_changed, int(np.count_nonzero(is_mention))
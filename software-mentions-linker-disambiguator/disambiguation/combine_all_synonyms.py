@@ -9,8 +9,9 @@ Assumes the following files are already computed:
 - 'bioconductor_synonyms.pkl'
 - 'scicrunch_synonyms.pkl'
 - 'extra_scicrunch_synonyms.pkl'
-- 'string_similarity_dict.pkl";
+- 'string_similarity_pairs.npz'
 - 'mention2ID.pkl'
+Saves the combined synonyms to 'synonyms.csv', and as a graph over integer mention IDs to 'synonym_graph.npz' (see synonym_graph.py).
 
 Usage:
     python combine_all_synonyms.py 
@@ -26,102 +27,154 @@ Author:
 """
 
 
+import numpy as np
 import pandas as pd
 import pickle
 import string
 import time
 import ast
 import argparse
+from synonym_graph import SynonymGraph
+from utils_disambiguation import ID_PREFIX, get_ID2mention, get_mention2int_ID, load_string_similarity_pairs, string_similarity_pairs_to_edges, drop_duplicate_edges, edges_to_synonyms_df
 
 ROOT_DIR = "../data/disambiguation_files/"
 
-def assign_confidences(df, synonym_map, synonym_source, conf = 1, use_confs = None):
+def get_synonym_edges(synonym_map, mention2int_ID, synonym_source, conf = 1, use_confs = None):
   """
-  Assigns confidences in a given df to synonyms in synonym_map coming from a synonym_source
+  Builds the edge table (see EDGE_FIELDS) of the synonyms in synonym_map coming from a synonym_source, as flat arrays.
+  Only keeps mentions in mention2ID with more than one synonym.
   
-  :param df: df to assing confidences to
-  :param synonym_map: map from {software : (synonym, synonym_conf)}
+  :param synonym_map: map from {software : synonyms}, or {software : (synonyms, synonym_confs)} if use_confs
+  :param mention2int_ID: Series mapping software mentions to integer IDs (see get_mention2int_ID)
   :param synonym_source: source of synonyms (e.g. pypi, CRAN, )
   :param conf: confidence to assign to synonyms
   :param use_confs: True if confidences are already computed (eg from string similarity)
   
-  :return df_conf: df augmented with synonym confidences
+  :return edge df, without duplicates
   """
-  df_conf = df.copy()
-  if use_confs:
-    df_conf['synonyms'] = df_conf['software_mention'].apply(lambda x: synonym_map[x][0] if ((x in synonym_map) and len(synonym_map[x][0]) > 1) else None)
-    df_conf['synonyms_confs'] = df_conf['software_mention'].apply(lambda x: synonym_map[x][1] if ((x in synonym_map) and len(synonym_map[x][1]) > 1) else None)
-  else:
-    df_conf['synonyms'] = df_conf['software_mention'].apply(lambda x: synonym_map[x] if ((x in synonym_map) and len(synonym_map[x]) > 1) else None)
-    df_conf['synonyms_confs'] = df_conf['synonyms'].apply(lambda x: [conf] * len(x) if x else None)
-  df_conf['synonym_source'] = synonym_source
-  df_conf = df_conf.dropna()
-  return df_conf
-
-def assert_equal_str_digits(x):
-  """
-  Asserts whether the 'software_mention' and 'synonym' fields in a given dataframe row are equal when stripped of digits and white space
-  
-  :param x: row in a dataframe; contains a 'software_mention' and a 'synonym' field
-  
-  :return True: if 'software_mention' and 'synonym' fields are equal given constraints
-  """
-  s1 = x['software_mention'].translate(str.maketrans('', '', string.digits)).replace(" ", "")
-  s2 = x['synonym'].translate(str.maketrans('', '', string.digits)).replace(" ", "")
-  return s1 == s2
+  software_mentions = pd.Series(list(synonym_map.keys()), dtype = object)
+  mention_int_IDs = software_mentions.map(mention2int_ID).fillna(-1).astype(np.int64)
+  int_IDs = []
+  synonyms = []
+  synonyms_confs = []
+  for software_mention, x in zip(software_mentions.values, mention_int_IDs.values):
+    if x < 0:
+      continue
+    if use_confs:
+      mention_synonyms, mention_confs = synonym_map[software_mention]
+      if len(mention_synonyms) <= 1 or len(mention_confs) <= 1:
+        continue
+    else:
+      mention_synonyms = synonym_map[software_mention]
+      if len(mention_synonyms) <= 1:
+        continue
+      mention_confs = [conf] * len(mention_synonyms)
+    int_IDs.extend([x] * len(mention_synonyms))
+    synonyms.extend(mention_synonyms)
+    synonyms_confs.extend(mention_confs)
+  synonyms = pd.Series(synonyms, dtype = object)
+  edges = pd.DataFrame({
+    'int_ID' : np.array(int_IDs, dtype = np.int64),
+    'synonym_int_ID' : synonyms.map(mention2int_ID).fillna(-1).astype(np.int64).values,
+    'synonym' : synonyms.values,
+    'synonym_conf' : np.array(synonyms_confs, dtype = float),
+    'synonym_source' : synonym_source})
+  return drop_duplicate_edges(edges)
 
-def assert_equal_str_punctuation(x):
+class EdgeTableWriter:
   """
-  Asserts whether the 'software_mention' and 'synonym' fields in a given dataframe row are equal when stripped of punctuation and white space
-  
-  :param x: row in a dataframe; contains a 'software_mention' and a 'synonym' field
-  
-  :return True: if 'software_mention' and 'synonym' fields are equal given constraints
+  Streams synonym pairs to a raw file, one source at a time: 
+  a Parquet file (one row group per source; requires pyarrow), or a CSV file if the filename ends with '.csv'
   """
-  s1 = x['software_mention'].translate(str.maketrans('', '', string.punctuation)).replace(" ", "")
-  s2 = x['synonym'].translate(str.maketrans('', '', string.punctuation)).replace(" ", "")
-  return s1 == s2
 
-def assert_equal_str_copyright(x):
-  """
-  Asserts whether the 'software_mention' and 'synonym' fields in a given dataframe row are equal when stripped of copyright chars and white space
-  
-  :param x: row in a dataframe; contains a 'software_mention' and a 'synonym' field
-  
-  :return True: if 'software_mention' and 'synonym' fields are equal given constraints
-  """
-  software_mention = x['software_mention']
-  s11 = software_mention.translate(str.maketrans('', '', u'\N{COPYRIGHT SIGN}')).replace(" ", "")
-  s12 = software_mention.translate(str.maketrans('', '', u'\N{TRADE MARK SIGN}')).replace(" ", "")
-  s13 = software_mention.translate(str.maketrans('', '', u'\N{REGISTERED SIGN}')).replace(" ", "")
-  
-  synonym = x['synonym']
-  s21 = synonym.translate(str.maketrans('', '', u'\N{COPYRIGHT SIGN}')).replace(" ", "")
-  s22 = synonym.translate(str.maketrans('', '', u'\N{TRADE MARK SIGN}')).replace(" ", "")
-  s23 = synonym.translate(str.maketrans('', '', u'\N{REGISTERED SIGN}')).replace(" ", "")
-  return (s11 == s21) or (s12 == s22) or (s13 == s23)
+  def __init__(self, filename):
+    """
+    :param filename: raw output file
+    """
+    self.filename = filename
+    self.writer = None
+    self.num_rows = 0
 
-def all_chars(s):
-  """
-  Returns True if a string contains all chars
-  
-  :param s: string to check
+  def write(self, synonyms_df):
+    """
+    :param synonyms_df: df with fields ['ID', 'software_mention', 'synonym', 'synonym_conf', 'synonym_source']
+    """
+    if self.filename.endswith('.csv'):
+      synonyms_df.to_csv(self.filename, index = False, mode = 'w' if self.num_rows == 0 else 'a', header = self.num_rows == 0)
+    else:
+      import pyarrow as pa
+      import pyarrow.parquet as pq
+      schema = pa.schema([('ID', pa.string()), ('software_mention', pa.string()), ('synonym', pa.string()), ('synonym_conf', pa.float64()), ('synonym_source', pa.string())])
+      if self.writer is None:
+        self.writer = pq.ParquetWriter(self.filename, schema)
+      self.writer.write_table(pa.Table.from_pandas(synonyms_df, schema = schema, preserve_index = False))
+    self.num_rows += len(synonyms_df)
+
+  def close(self):
+    if self.writer is not None:
+      self.writer.close()
+
+# Translation tables stripping white space, together with digits, punctuation or copyright chars
+DIGITS_TABLE = str.maketrans('', '', string.digits + ' ')
+PUNCTUATION_TABLE = str.maketrans('', '', string.punctuation + ' ')
+COPYRIGHT_TABLES = [str.maketrans('', '', sign + ' ') for sign in [u'\N{COPYRIGHT SIGN}', u'\N{TRADE MARK SIGN}', u'\N{REGISTERED SIGN}']]
+
+def get_string_keys(strings):
   """
-  for ch in s:
-    if not ch.isalpha():
-      return False
-  return True
+  Computes normalization keys for a list of unique strings, with vectorized string ops:
+  - 'digits': stripped of digits and white space
+  - 'punctuation': stripped of punctuation and white space
+  - 'copyright', 'trademark', 'registered': stripped of the copyright, trade mark or registered sign, and white space
+  - 'lower': lowercased
+  - 'num_tokens': number of white space separated tokens
+  - 'is_chars': True if the string only contains letters (or is empty)
 
-def starts_with(x):
+  :param strings: unique strings
+
+  :return df of keys, with one row per string, in the order of strings
   """
-  Returns True if the 'software_mention' field is a substring of the 'synonym' field in a give dataframe row
-  
-  :param s: dataframe row to check
+  strings = pd.Series(strings, dtype = object)
+  keys = pd.DataFrame({
+    'digits' : strings.str.translate(DIGITS_TABLE),
+    'punctuation' : strings.str.translate(PUNCTUATION_TABLE),
+    'copyright' : strings.str.translate(COPYRIGHT_TABLES[0]),
+    'trademark' : strings.str.translate(COPYRIGHT_TABLES[1]),
+    'registered' : strings.str.translate(COPYRIGHT_TABLES[2]),
+    'lower' : strings.str.lower(),
+    'num_tokens' : strings.str.split().str.len(),
+    'is_chars' : strings.str.isalpha() | (strings == '')})
+  return keys
+
+def add_string_flags(synonyms_df):
   """
-  s1 = x['software_mention']
-  s2 = x['synonym']
-  return s2.startswith(s1)
+  Adds flags comparing the 'software_mention' and 'synonym' fields of each synonym pair. 
+  Normalization keys are computed once per unique string (see get_string_keys), and compared column-wise:
+  - 'syn_substring_digits': equal when stripped of digits and white space
+  - 'syn_substring_punctuation': equal when stripped of punctuation and white space
+  - 'syn_substring_copyright': equal when stripped of one of the copyright, trade mark or registered signs, and white space
+  - 'lowercase_equal': equal when lowercased
+  - 'num_tokens': number of tokens of 'software_mention'
+  - 'is_chars', 'is_chars_syn': 'software_mention', resp. 'synonym', only contain letters
+
+  :param synonyms_df: df of synonym pairs, with 'software_mention' and 'synonym' fields
 
+  :return synonyms_df, with the flags added
+  """
+  unique_strings = pd.unique(pd.concat([synonyms_df['software_mention'], synonyms_df['synonym']], ignore_index = True))
+  keys = get_string_keys(unique_strings)
+  unique_index = pd.Index(unique_strings)
+  mention_keys = keys.iloc[unique_index.get_indexer(synonyms_df['software_mention'])].reset_index(drop = True)
+  synonym_keys = keys.iloc[unique_index.get_indexer(synonyms_df['synonym'])].reset_index(drop = True)
+  synonyms_df = synonyms_df.copy()
+  synonyms_df['syn_substring_digits'] = (mention_keys['digits'] == synonym_keys['digits']).values
+  synonyms_df['syn_substring_punctuation'] = (mention_keys['punctuation'] == synonym_keys['punctuation']).values
+  synonyms_df['syn_substring_copyright'] = ((mention_keys['copyright'] == synonym_keys['copyright']) | (mention_keys['trademark'] == synonym_keys['trademark']) | 
+                                            (mention_keys['registered'] == synonym_keys['registered'])).values
+  synonyms_df['lowercase_equal'] = (mention_keys['lower'] == synonym_keys['lower']).values
+  synonyms_df['num_tokens'] = mention_keys['num_tokens'].values
+  synonyms_df['is_chars'] = mention_keys['is_chars'].values
+  synonyms_df['is_chars_syn'] = synonym_keys['is_chars'].values
+  return synonyms_df
 
 if __name__ == '__main__':
   parser = argparse.ArgumentParser()
@@ -131,45 +184,51 @@ if __name__ == '__main__':
   parser.add_argument("--bioconductor-synonyms-file", help="Location of Bioconductor synonyms file", default = ROOT_DIR + 'bioconductor_synonyms.pkl', required = False)
   parser.add_argument("--scicrunch-synonyms-file", help="Location of Scicrunch synonyms file", default = ROOT_DIR + 'scicrunch_synonyms.pkl', required = False)
   parser.add_argument("--extra-scicrunch-synonyms-file", help="Location of extra Scicrunch synonyms file", default = ROOT_DIR + 'extra_scicrunch_synonyms.pkl', required = False)
-  parser.add_argument("--string-sim-synonyms-file", help="Location of string similarity synonyms file", default = ROOT_DIR + 'string_similarity_dict.pkl', required = False)
+  parser.add_argument("--string-sim-synonyms-file", help="Location of string similarity pairs file", default = ROOT_DIR + 'string_similarity_pairs.npz', required = False)
   parser.add_argument("--conf_threshold", help="Minium confidence threshold for synonyms in the final file", default = 0.97, required = False)
   parser.add_argument('--mention2ID-file', type=str, default = '../data/intermediate_files/mention2ID.pkl')
+  parser.add_argument('--raw-output-file', type=str, help="Location of the raw synonym pairs of all sources (Parquet, or CSV if ending with .csv)", default = ROOT_DIR + 'synonyms_raw.parquet')
   parser.add_argument('--output-file', type=str, default = ROOT_DIR + 'synonyms.csv')
+  parser.add_argument('--graph-output-file', type=str, help="Location of the synonym graph consumed by clustering.py", default = ROOT_DIR + 'synonym_graph.npz')
 
   args, _ = parser.parse_known_args()
 
-  pypi_synonyms = pickle.load(open(args.pypi_synonyms_file, 'rb'))
-  cran_synonyms = pickle.load(open(args.cran_synonyms_file, 'rb'))
-  bioconductor_synonyms = pickle.load(open(args.bioconductor_synonyms_file, 'rb'))
-  scicrunch_synonyms = pickle.load(open(args.scicrunch_synonyms_file, 'rb'))
-  extra_scicrunch_synonyms = pickle.load(open(args.extra_scicrunch_synonyms_file, 'rb'))
-  string_similarity_dict = pickle.load(open(args.string_sim_synonyms_file, 'rb+'))
-
   mention2ID = pickle.load(open(args.mention2ID_file, 'rb'))
-  all_software_mentions = list(mention2ID.keys())
-  all_mentions_df = pd.DataFrame({'software_mention' : all_software_mentions})
-  all_mentions_df['ID'] = all_mentions_df['software_mention'].apply(lambda x: mention2ID[x])
-  all_mentions_df = all_mentions_df[['ID', 'software_mention']]
-  pypi_synonyms_df = assign_confidences(all_mentions_df, pypi_synonyms, 'pypi', 0.99)
-  cran_synonyms_df = assign_confidences(all_mentions_df, cran_synonyms, 'CRAN', 0.99)
-  bioconductor_synonyms_df = assign_confidences(all_mentions_df, bioconductor_synonyms, 'Bioconductor', 0.99)
-  scicrunch_synonyms_df = assign_confidences(all_mentions_df, scicrunch_synonyms, 'Scicrunch')
-  scicrunch_extra_synonyms_df = assign_confidences(all_mentions_df, extra_scicrunch_synonyms, 'Scicrunch_page_query')
-  string_sim_synonyms_df = assign_confidences(all_mentions_df, string_similarity_dict, 'string_similarity', 1, True)
-
-  synonyms_df_raw = pd.concat([scicrunch_synonyms_df, scicrunch_extra_synonyms_df, pypi_synonyms_df, cran_synonyms_df, bioconductor_synonyms_df, string_sim_synonyms_df], axis = 0).sort_values(by = 'ID', ascending = True)
+  mention2int_ID = get_mention2int_ID(mention2ID)
+  ID2mention = get_ID2mention(mention2ID)
+  del mention2ID
+
+  # Synonym maps are loaded one at a time, and turned into edge tables that are streamed to the raw file
+  synonym_files = [(args.scicrunch_synonyms_file, 'Scicrunch', 1), (args.extra_scicrunch_synonyms_file, 'Scicrunch_page_query', 1), 
+                   (args.pypi_synonyms_file, 'pypi', 0.99), (args.cran_synonyms_file, 'CRAN', 0.99), (args.bioconductor_synonyms_file, 'Bioconductor', 0.99)]
+  raw_writer = EdgeTableWriter(args.raw_output_file)
+  all_edges = []
+  for synonym_file, synonym_source, conf in synonym_files:
+    synonym_map = pickle.load(open(synonym_file, 'rb'))
+    edges = get_synonym_edges(synonym_map, mention2int_ID, synonym_source, conf)
+    del synonym_map
+    raw_writer.write(edges_to_synonyms_df(edges, ID2mention))
+    all_edges.append(edges)
+  # String similarity pairs are already stored one pair per row, with integer IDs
+  string_sim_mention_ids, string_sim_synonym_ids, string_sim_confs = load_string_similarity_pairs(args.string_sim_synonyms_file)
+  edges = drop_duplicate_edges(string_similarity_pairs_to_edges(string_sim_mention_ids, string_sim_synonym_ids, string_sim_confs, ID2mention))
+  raw_writer.write(edges_to_synonyms_df(edges, ID2mention))
+  all_edges.append(edges)
+  raw_writer.close()
+  print('- Saved', raw_writer.num_rows, 'synonym pairs to', args.raw_output_file)
+
+  edges = pd.concat(all_edges, axis = 0, ignore_index = True).sort_values(by = 'int_ID', ascending = True, kind = 'stable')
+  del all_edges
+  synonym_int_IDs = edges['synonym_int_ID']
+  synonyms_df = edges_to_synonyms_df(edges, ID2mention)
+  del edges
 
   # Clean up synonym files
   common_words_to_remove = ['script', 'Interface', 'R package', 'r package', 'interface', 'R packag', 'r packag', 'R packages', 'Bioconductor package', 'analysis', 'BioConductor', 'Bioconductor', 'Bioconductor package R', 'Bioconductor/R', 'R bioconductor', 'R/Bioconductor', 'package', 'Bioconductor R package', 'Bioconductor R-package', 'R package)', 'R Bioconductor package', 'bioconductor', 'Bioconductor', 'R/Bioconductor package', 'Library', 'Biothings API and Explorer', 'Python', 'python', 'python programming language', 'Python package', 'Python Package', 'packages', 'libraries']
 
-  synonyms_df = synonyms_df_raw.set_index(['ID', 'software_mention', 'synonym_source']).apply(pd.Series.explode).reset_index()
-  synonyms_df = synonyms_df.rename(columns = {'synonyms' : 'synonym', 'synonyms_confs' : 'synonym_conf'})
-  synonyms_df = synonyms_df[['ID', 'software_mention', 'synonym', 'synonym_conf', 'synonym_source']].drop_duplicates()
-  synonyms_df.to_csv(ROOT_DIR + "synonyms_raw.csv", index = False)
-
   # Remove common words
   synonyms_df = synonyms_df[(~synonyms_df['software_mention'].isin(common_words_to_remove)) & (~synonyms_df['synonym'].isin(common_words_to_remove))]
-  synonyms_df['synonym_ID'] = synonyms_df['synonym'].apply(lambda x: mention2ID[x] if x in mention2ID else -1)
+  synonyms_df['synonym_ID'] = [ID_PREFIX + str(x) if x >= 0 else -1 for x in synonym_int_IDs.loc[synonyms_df.index].values]
 
   # Some cleanup of string similarity confidences; reduces the noise for clustering
   synonyms_df = synonyms_df.drop(synonyms_df[synonyms_df['software_mention'] == synonyms_df['synonym']].index)
@@ -179,28 +238,24 @@ if __name__ == '__main__':
   synonyms_df = synonyms_df[~((synonyms_df['synonym'].str.startswith('R package')) & (synonyms_df['synonym_conf'] < 0.94))]
   synonyms_df = synonyms_df[~((synonyms_df['synonym'].str.startswith('R-package')) & (synonyms_df['synonym_conf'] < 0.94))]
 
+  # Compare synonym pairs on normalization keys, computed once per unique string
+  synonyms_df = add_string_flags(synonyms_df)
+
   # Assign confidence of one for pairs of synonyms that are equal when stripped of digits 
-  synonyms_df['syn_substring_digits'] = synonyms_df.apply(assert_equal_str_digits, axis = 1)
   synonyms_df.loc[synonyms_df['syn_substring_digits'], 'synonym_conf'] = 1
 
   # Assign confidence of one for pairs of synonyms that are equal when stripped of punctuation
-  synonyms_df['syn_substring_punctuation'] = synonyms_df.apply(assert_equal_str_punctuation, axis = 1)
   synonyms_df.loc[synonyms_df['syn_substring_punctuation'], 'synonym_conf'] = 1
 
   # Assign confidence of one for pairs of synonyms that are equal when stripped of copyright chars
-  synonyms_df['syn_substring_copyright'] = synonyms_df.apply(assert_equal_str_copyright, axis = 1)
   synonyms_df.loc[synonyms_df['syn_substring_copyright'], 'synonym_conf'] = 1
 
   # Assign confidence of one for pairs of synonyms that have more than one token and are equal (case insensitive)
-  synonyms_df['lowercase_equal'] = synonyms_df['software_mention'].str.lower() == synonyms_df['synonym'].str.lower()
-  synonyms_df['num_tokens'] = synonyms_df['software_mention'].apply(lambda x: len(x.split()))
   synonyms_df.loc[(synonyms_df['lowercase_equal']) & (synonyms_df['num_tokens'] > 1), 'synonym_conf'] = 1.0
 
   # Remove pairs of synonyms that are all chars and are not equal when stripped of digits, punctuation or copyright chars 
-  synonyms_df['is_chars'] = synonyms_df['software_mention'].apply(all_chars)
-  synonyms_df['is_chars_syn'] = synonyms_df['synonym'].apply(all_chars)
   synonyms_df = synonyms_df[~(synonyms_df['is_chars'] & synonyms_df['is_chars_syn'] & (~synonyms_df['syn_substring_digits'] & ~synonyms_df['syn_substring_punctuation'] & ~synonyms_df['syn_substring_punctuation']))]
-  synonyms_df['is_substr'] = synonyms_df.apply(starts_with, axis = 1)
+  synonyms_df['is_substr'] = [synonym.startswith(software_mention) for software_mention, synonym in zip(synonyms_df['software_mention'].values, synonyms_df['synonym'].values)]
   
   # Only consider synonyms with a high confidence
   synonyms_df_high_conf = synonyms_df[(synonyms_df['synonym_conf'] >= args.conf_threshold)]
@@ -209,4 +264,9 @@ if __name__ == '__main__':
   # synonyms_df = synonyms_df_high_conf[synonyms_df_high_conf['synonym_ID'] != -1]
   
   # Save to file
-  synonyms_df.to_csv(args.output_file, index = False)
\ No newline at end of file
+  synonyms_df.to_csv(args.output_file, index = False)
+
+  # Save the synonym graph over integer IDs
+  graph = SynonymGraph.from_synonyms_df(synonyms_df, ID2mention)
+  graph.save(args.graph_output_file)
+  print('- Saved synonym graph with', graph.num_edges, 'edges to', args.graph_output_file)
\ No newline at end of file
@@ -1,34 +1,80 @@
 #!/usr/bin/env python3
 
-"""Generates strin_synonyms_dict by concatenating files containing string similarity pairs and confidences
+"""Generates the string similarity pair table by concatenating files containing string similarity pairs and confidences
 Assumes these files already exist. The files can be created by running the generate_synonyms_string_sim.py script.
+Output is a single (mention_id:int32, synonym_id:int32, conf:float32) table, sorted by (mention_id, synonym_id) and saved as .npz.
+Files in the legacy .csv format (stringified lists of synonyms and confidences) are converted on the fly.
 
 Usage:
-    python generate_string_sim_dict.py 
+    python generate_string_sim_dict.py
 
 Author:
     Ana-Maria Istrate
 """
 
 import pandas as pd
+import numpy as np
 import pickle
 import argparse
 import ast
 import time
 import os
+from utils_disambiguation import mention_ID_to_int, save_string_similarity_pairs, load_string_similarity_pairs
 
 ROOT_DIR = "../data/disambiguation_files/"
 
+def read_legacy_csv_pairs(filename, mention2ID):
+  """
+  Reads a string similarity file in the legacy .csv format and converts it to a pair table
+
+  :param filename: .csv file with 'software_mention', 'synonyms' and 'synonyms_confs' fields
+  :param mention2ID: mapping from mention to ID
+
+  :return mention_ids, synonym_ids, confs
+  """
+  df = pd.read_csv(filename, index_col = 0)
+  mention_ids = []
+  synonym_ids = []
+  confs = []
+  for software_mention, synonyms, synonyms_confs in zip(df['software_mention'].values, df['synonyms'].values, df['synonyms_confs'].values):
+    if software_mention and synonyms == synonyms:
+      synonyms = ast.literal_eval(synonyms)
+      mention_ids.extend([mention_ID_to_int(mention2ID[software_mention])] * len(synonyms))
+      synonym_ids.extend([mention_ID_to_int(mention2ID[x]) for x in synonyms])
+      confs.extend(ast.literal_eval(synonyms_confs))
+  return np.array(mention_ids, dtype = np.int32), np.array(synonym_ids, dtype = np.int32), np.array(confs, dtype = np.float32)
+
 if __name__ == '__main__':
-  string_sim_files = [filename for filename in os.listdir(ROOT_DIR) if filename.startswith("synonym_string_similarity_")]
-  string_sim_dfs = []
+  parser = argparse.ArgumentParser()
+
+  parser.add_argument('--input-dir', type=str, help="Directory containing the synonym_string_similarity_* files", default = ROOT_DIR)
+  parser.add_argument('--mention2ID-file', type=str, help="mention2ID mapping; only needed for files in the legacy .csv format", default = '../data/intermediate_files/mention2ID.pkl')
+  parser.add_argument('--output-file', type=str, default = ROOT_DIR + 'string_similarity_pairs.npz')
+
+  args, _ = parser.parse_known_args()
+
+  t1 = time.time()
+  string_sim_files = sorted([filename for filename in os.listdir(args.input_dir) if filename.startswith("synonym_string_similarity_")])
+  mention2ID = None
+  all_mention_ids = []
+  all_synonym_ids = []
+  all_confs = []
   for file in string_sim_files:
     print(file)
-    df = pd.read_csv(ROOT_DIR + file, index_col = 0)
-    string_sim_dfs.append(df)
-  string_sim_df = pd.concat(string_sim_dfs)
-  string_similarity_dict = {}
-  for software_mention, synonyms, synonyms_confs in zip(string_sim_df['software_mention'].values, string_sim_df['synonyms'].values, string_sim_df['synonyms_confs'].values):
-    if software_mention and synonyms == synonyms:
-      string_similarity_dict[software_mention] = (ast.literal_eval(synonyms), ast.literal_eval(synonyms_confs))
-  pickle.dump(string_similarity_dict, open(ROOT_DIR + 'string_similarity_dict.pkl', 'wb+'))
\ No newline at end of file
+    if file.endswith('.npz'):
+      mention_ids, synonym_ids, confs = load_string_similarity_pairs(args.input_dir + file)
+    else:
+      if mention2ID is None:
+        mention2ID = pickle.load(open(args.mention2ID_file, 'rb'))
+      mention_ids, synonym_ids, confs = read_legacy_csv_pairs(args.input_dir + file, mention2ID)
+    all_mention_ids.append(mention_ids)
+    all_synonym_ids.append(synonym_ids)
+    all_confs.append(confs)
+
+  mention_ids = np.concatenate(all_mention_ids) if all_mention_ids else np.array([], dtype = np.int32)
+  synonym_ids = np.concatenate(all_synonym_ids) if all_synonym_ids else np.array([], dtype = np.int32)
+  confs = np.concatenate(all_confs) if all_confs else np.array([], dtype = np.float32)
+  order = np.lexsort((synonym_ids, mention_ids))
+  save_string_similarity_pairs(args.output_file, mention_ids[order], synonym_ids[order], confs[order])
+  t2 = time.time()
+  print('- Saved', len(order), 'string similarity pairs to', args.output_file, 'in', "{:.3f}".format(t2-t1), 's')
@@ -10,17 +10,139 @@ Author:
 """
 
 import pandas as pd
+import numpy as np
 import pickle
 import time
-import re
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 import nltk
 nltk.download('stopwords')
 from nltk.corpus import stopwords
 
 ROOT_DIR = "../data/"
 
-def generate_synonyms_keywords_extraction(packages, software_mentions, clue_words, pypi_cran_common, python = True):
+# disregarding some common words from generating synonyms for, as these are likely to contain extra noise
+DISREGARD_WORDS = ['package', 'software', 'Library', 'studio', 'image', 'analysis', 'scripts', 'language']
+
+# keywords used to generate synonym pairs for each index
+PYPI_CLUE_WORDS = ['python', 'Python', 'API']
+CRAN_CLUE_WORDS = ['R', 'r', 'package', 'Package', 'R-package', 'R-Package', 'r-package']
+BIOCONDUCTOR_CLUE_WORDS = ['R', 'r', 'package', 'Package', 'R-package', 'R-Package', 'r-package', 'bioconductor', 'Bioconductor']
+
+# characters stripped from mention tokens before matching them against packages
+TOKEN_CLEANUP_REGEX = "[^A-z0-9 \n\-]"
+
+def build_token_index(software_mentions):
+  """
+  Tokenizes software mentions once and builds inverted indices over the tokens
+  
+  :param software_mentions: the entire list of software packages to get synonyms from
+  
+  :return token_index: dict containing
+          'mentions': array of software mentions (NaNs dropped)
+          'tokens': df with one row per (mention_idx, token, clean_token), in mention and token order
+          'clean_token2rows': mapping from {cleaned token : rows in 'tokens'}
+          'token2mentions': mapping from {raw token : set of mention_idx}
+  """
+  mentions = pd.Series(software_mentions, dtype = object).dropna().reset_index(drop = True)
+  tokens = mentions.str.split().explode().dropna()
+  tokens_df = pd.DataFrame({'mention_idx' : tokens.index.values, 'token' : tokens.values})
+  tokens_df['clean_token'] = tokens_df['token'].str.replace(TOKEN_CLEANUP_REGEX, "", regex = True)
+  clean_token2rows = tokens_df.groupby('clean_token', sort = False).indices
+  token2mentions = {k : set(v) for k, v in tokens_df.groupby('token', sort = False)['mention_idx']}
+  return {'mentions' : mentions.values, 'tokens' : tokens_df, 'clean_token2rows' : clean_token2rows, 'token2mentions' : token2mentions}
+
+def get_clue_words_common(clue_words, python):
+  """
+  Returns the clue words that still count for packages found in both PyPI and CRAN. 
+  For these packages, python clue words other than 'python'/'Python' and R clue words 'package'/'Package' reset a previously found clue,
+  so only clue words placed after the last resetting clue word are effective.
+  
+  :param clue_words: keywords used to generate synonym pairs
+  :param python: True if generating keywords for python packages
+  
+  :return list of effective clue words
+  """
+  if python:
+    resets = [i for i, clue in enumerate(clue_words) if clue not in ['python', 'Python']]
+  else:
+    resets = [i for i, clue in enumerate(clue_words) if clue in ['package', 'Package']]
+  if len(resets) == 0:
+    return list(clue_words)
+  return list(clue_words[resets[-1] + 1:])
+
+def mentions_with_tokens(token_index, words):
+  """
+  Returns the set of mentions containing at least one of the given words as a token
+  
+  :param token_index: token index built by build_token_index
+  :param words: words to look for
+  
+  :return set of mention_idx
+  """
+  token2mentions = token_index['token2mentions']
+  found = set()
+  for word in set(words).intersection(token2mentions):
+    found.update(token2mentions[word])
+  return found
+
+def get_keyword_matches(token_index, packages, clue_words, pypi_cran_common, python = True):
+  """
+  Matches mentions in a token index against a set of packages and clue words
+  
+  :param token_index: token index built by build_token_index
+  :param packages: packages to generate synonyms for
+  :param clue_words: keywords used to generate synonym pairs
+  :param pypi_cran_common: list of mentions found in both PyPI and CRAN
+  :param python: True if generating keywords for python packages
+  
+  :return matches: mapping from {mention_idx : package}, for mentions that are synonyms of a package
+  """
+  mentions = token_index['mentions']
+  tokens_df = token_index['tokens']
+  package_set = set(packages)
+  pypi_cran_common = set(pypi_cran_common)
+  disregard_words = set(DISREGARD_WORDS + stopwords.words('english'))
+
+  # A mention can contain a package as one of its tokens; the last such token wins
+  package_tokens = package_set.difference(disregard_words).intersection(token_index['clean_token2rows'])
+  rows = [r for token in package_tokens for r in token_index['clean_token2rows'][token]]
+  package_mentions_df = tokens_df.iloc[sorted(rows)].drop_duplicates(subset = 'mention_idx', keep = 'last')
+  
+  mentions_with_clue = mentions_with_tokens(token_index, clue_words)
+  mentions_with_clue_common = mentions_with_tokens(token_index, get_clue_words_common(clue_words, python))
+  matches = {}
+  for i, package in zip(package_mentions_df['mention_idx'].values, package_mentions_df['clean_token'].values):
+    if i in (mentions_with_clue_common if package in pypi_cran_common else mentions_with_clue):
+      matches[i] = package
+
+  # A mention can also be a package itself, regardless of clue words
+  exact_matches = np.flatnonzero(pd.Series(mentions).isin(package_set).values)
+  for i in exact_matches:
+    matches[i] = mentions[i]
+  return matches
+
+def generate_synonyms_from_matches(token_index, all_matches):
+  """
+  Generates synonym maps for a number of keyword rule sets in a single pass over the mentions
+  
+  :param token_index: token index built by build_token_index
+  :param all_matches: list of mappings from {mention_idx : package}, one per rule set (see get_keyword_matches)
+  
+  :return list of synonym maps, one per rule set, each mapping from {package : synonym}
+  """
+  all_synonyms = [{} for _ in all_matches]
+  for i, mention in enumerate(token_index['mentions']):
+    for matches, synonyms in zip(all_matches, all_synonyms):
+      if i in matches:
+        software = matches[i]
+        if software in synonyms:
+          synonyms[software].append(mention)
+        else:
+          synonyms[software] = [mention]
+  return all_synonyms
+
+def generate_synonyms_keywords_extraction(packages, software_mentions, clue_words, pypi_cran_common, python = True, token_index = None):
   """
   Generates synonyms for a given list of packages using relevant keywords
   
@@ -29,94 +151,113 @@ def generate_synonyms_keywords_extraction(packages, software_mentions, clue_word
   :param clue_words: keywords used to generate synonym pairs
   :param pypi_cran_common: list of mentions found in both PyPI and CRAN
   :param python: True if generating keywords for python packages
+  :param token_index: precomputed token index for software_mentions (see build_token_index); computed if None
   
   :return synonyms: mapping from {package : synonym}
   """
-  # disregarding some common words from generating synonyms for, as these are likely to contain extra noise
-  disregard_words = ['package', 'software', 'Library', 'studio', 'image', 'analysis', 'scripts', 'language'] + stopwords.words('english')
-  synonyms = {}
-  for i, mention in enumerate(software_mentions):
-    if i % 10000 == 0:
-      print('Processed', i, '/', len(software_mentions))
-    t1 = time.time()
-    if mention == mention:
-      mention_tokens = mention.split()
-      found_clue = False
-      found_package_mention = False
-      found_exact_match = False
-      software = ""
-      if mention in packages:
-        found_exact_match = True
-        software = mention
-      else:
-        for mention_token in mention_tokens:
-          package = re.sub("[^A-z0-9 \n\-]", "", mention_token)
-          if package in packages and package not in disregard_words:
-            found_package_mention = True
-            software = package
-        
-      for clue in clue_words:
-        for mention_token in mention_tokens:
-          if clue == mention_token:
-            found_clue = True
-          if python and software in pypi_cran_common and clue not in ['python', 'Python']:
-            found_clue = False
-          if not python and software in pypi_cran_common and clue in ['package', 'Package']:
-            found_clue = False
-      if found_exact_match or (found_package_mention and found_clue):
+  if token_index is None:
+    token_index = build_token_index(software_mentions)
+  matches = get_keyword_matches(token_index, packages, clue_words, pypi_cran_common, python)
+  return generate_synonyms_from_matches(token_index, [matches])[0]
+
+def generate_keyword_synonyms_shard(rule_sets, software_mentions, pypi_cran_common):
+  """
+  Tokenizes a shard of software mentions once and evaluates all keyword rule sets against it
+  
+  :param rule_sets: list of (packages, clue_words, python) keyword rule sets
+  :param software_mentions: shard of software mentions to get synonyms from
+  :param pypi_cran_common: list of mentions found in both PyPI and CRAN
+  
+  :return list of synonym maps, one per rule set
+  """
+  token_index = build_token_index(software_mentions)
+  all_matches = [get_keyword_matches(token_index, packages, clue_words, pypi_cran_common, python) for packages, clue_words, python in rule_sets]
+  return generate_synonyms_from_matches(token_index, all_matches)
+
+def generate_all_keyword_synonyms(rule_sets, software_mentions, pypi_cran_common, num_workers = 1, shard_size = 500000):
+  """
+  Generates keywords-based synonyms for a number of rule sets (e.g. PyPI, CRAN, Bioconductor) in one shared pass over the mentions.
+  Mentions are split into shards, which can be processed in parallel; results are merged in shard order, 
+  so the output doesn't depend on num_workers.
+  
+  :param rule_sets: list of (packages, clue_words, python) keyword rule sets
+  :param software_mentions: the entire list of software packages to get synonyms from
+  :param pypi_cran_common: list of mentions found in both PyPI and CRAN
+  :param num_workers: number of worker processes
+  :param shard_size: number of mentions in a shard
+  
+  :return list of synonym maps, one per rule set, each mapping from {package : synonym}
+  """
+  software_mentions = list(software_mentions)
+  shards = [software_mentions[i:i + shard_size] for i in range(0, len(software_mentions), shard_size)]
+  pypi_cran_common = set(pypi_cran_common)
+  if num_workers > 1 and len(shards) > 1:
+    with ProcessPoolExecutor(max_workers = num_workers) as executor:
+      shard_results = executor.map(generate_keyword_synonyms_shard, [rule_sets] * len(shards), shards, [pypi_cran_common] * len(shards))
+      shard_results = list(shard_results)
+  else:
+    shard_results = [generate_keyword_synonyms_shard(rule_sets, shard, pypi_cran_common) for shard in shards]
+
+  all_synonyms = [{} for _ in rule_sets]
+  for i, shard_synonyms in enumerate(shard_results):
+    print('Merged shard', i + 1, '/', len(shard_results))
+    for synonyms, shard_synonym_map in zip(all_synonyms, shard_synonyms):
+      for software, mentions in shard_synonym_map.items():
         if software in synonyms:
-          synonyms[software].append(mention)
+          synonyms[software].extend(mentions)
         else:
-          synonyms[software] = [mention]
-    t2 = time.time()
-  return synonyms
+          synonyms[software] = mentions
+  return all_synonyms
 
-def get_pypi_synonyms(pypi_df, software_mentions, pypi_cran_common):
+def get_pypi_synonyms(pypi_df, software_mentions, pypi_cran_common, token_index = None):
   """
   Generates keywords-based synonyms for mentions found in the PyPI index
   
   :param pypi_df: df containing mentions found in the PyPI index
   :param software_mentions: full list of software mentions to generate synonyms from 
   :param pypi_cran_common: list of mentions found in both PyPI and CRAN
+  :param token_index: precomputed token index for software_mentions (see build_token_index)
 
   :return mapping from {pypi package : synonym}
   """
   print('- Generating Pypi synonyms ... ')
-  clue_words = ['python', 'Python', 'API']
+  clue_words = PYPI_CLUE_WORDS
   packages = pypi_df['mapped_to'].unique()
-  return generate_synonyms_keywords_extraction(packages, software_mentions, clue_words, pypi_cran_common, python = True)
+  return generate_synonyms_keywords_extraction(packages, software_mentions, clue_words, pypi_cran_common, python = True, token_index = token_index)
 
 
-def get_bioconductor_synonyms(bioconductor_df, software_mentions, pypi_cran_common):
+def get_bioconductor_synonyms(bioconductor_df, software_mentions, pypi_cran_common, token_index = None):
   """
   Generates keywords-based synonyms for mentions found in the Bioconductor index
   
   :param pypi_df: df containing mentions found in the Bioconductor index
   :param software_mentions: full list of software mentions to generate synonyms from 
   :param pypi_cran_common: list of mentions found in both PyPI and CRAN
+  :param token_index: precomputed token index for software_mentions (see build_token_index)
 
   :return mapping from {bioconductor package : synonym}
   """
   print('- Generating Bioconductor synonyms ...')
-  clue_words = ['R', 'r', 'package', 'Package', 'R-package', 'R-Package', 'r-package', 'bioconductor', 'Bioconductor']
+  clue_words = BIOCONDUCTOR_CLUE_WORDS
   packages = bioconductor_df['mapped_to'].unique()
-  return generate_synonyms_keywords_extraction(packages, software_mentions, clue_words, pypi_cran_common, python = False)
+  return generate_synonyms_keywords_extraction(packages, software_mentions, clue_words, pypi_cran_common, python = False, token_index = token_index)
 
 
-def get_cran_synonyms(cran_df, software_mentions, pypi_cran_common):
+def get_cran_synonyms(cran_df, software_mentions, pypi_cran_common, token_index = None):
   """
   Generates keywords-based synonyms for mentions found in the CRAN index
   
   :param pypi_df: df containing mentions found in the CRAN index
   :param software_mentions: full list of software mentions to generate synonyms from 
   :param pypi_cran_common: list of mentions found in both PyPI and CRAN
+  :param token_index: precomputed token index for software_mentions (see build_token_index)
 
   :return mapping from {CRAN package : synonym}
   """  
   print('- Generating CRAN synonyms ...')
-  clue_words = ['R', 'r', 'package', 'Package', 'R-package', 'R-Package', 'r-package']
+  clue_words = CRAN_CLUE_WORDS
   packages = cran_df['mapped_to'].unique()
-  return generate_synonyms_keywords_extraction(packages, software_mentions, clue_words, pypi_cran_common, python = False)
+  return generate_synonyms_keywords_extraction(packages, software_mentions, clue_words, pypi_cran_common, python = False, token_index = token_index)
 
 
 if __name__ == '__main__':
@@ -127,6 +268,8 @@ if __name__ == '__main__':
   parser.add_argument('--bioconductor-file', type=str, default = ROOT_DIR + 'metadata_files/normalized/bioconductor_df.csv')
   parser.add_argument('--mention2ID-file', type=str, default = ROOT_DIR + 'intermediate_files/mention2ID.pkl')
   parser.add_argument('--output_dir', type=str, default = ROOT_DIR + 'disambiguation_files/')
+  parser.add_argument('--num-workers', type=int, help="Number of processes used to generate synonyms over shards of mentions", default = 1)
+  parser.add_argument('--shard-size', type=int, help="Number of mentions per shard", default = 500000)
 
   args, _ = parser.parse_known_args()
 
@@ -141,9 +284,15 @@ if __name__ == '__main__':
   pypi_mentions = pypi_df['software_mention'].unique()
   pypi_cran_common = (set(cran_mentions).union(bioconductor_mentions)).intersection(pypi_mentions)
 
-  pypi_synonyms = get_pypi_synonyms(pypi_df, all_software_mentions, pypi_cran_common)
-  cran_synonyms = get_cran_synonyms(cran_df, all_software_mentions, pypi_cran_common)
-  bioconductor_synonyms = get_bioconductor_synonyms(bioconductor_df, all_software_mentions, pypi_cran_common)
+  # PyPI, CRAN and Bioconductor synonyms are generated together, tokenizing each mention only once
+  print('- Generating Pypi, CRAN and Bioconductor synonyms ...')
+  t1 = time.time()
+  rule_sets = [(pypi_df['mapped_to'].unique(), PYPI_CLUE_WORDS, True),
+               (cran_df['mapped_to'].unique(), CRAN_CLUE_WORDS, False),
+               (bioconductor_df['mapped_to'].unique(), BIOCONDUCTOR_CLUE_WORDS, False)]
+  pypi_synonyms, cran_synonyms, bioconductor_synonyms = generate_all_keyword_synonyms(rule_sets, all_software_mentions, pypi_cran_common, args.num_workers, args.shard_size)
+  t2 = time.time()
+  print('It took', "{:.3f}".format(t2-t1), 's to generate keywords-based synonyms')
 
   pickle.dump(pypi_synonyms, open(args.output_dir + 'pypi_synonyms.pkl', 'wb+'))
   pickle.dump(cran_synonyms, open(args.output_dir + 'cran_synonyms.pkl', 'wb+'))
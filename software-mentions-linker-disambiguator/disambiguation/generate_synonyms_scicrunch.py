@@ -15,8 +15,11 @@ import pickle
 import argparse
 import ast
 import time
+import os
+import hashlib
 import requests
-from bs4 import BeautifulSoup
+import lxml.html
+from concurrent.futures import ThreadPoolExecutor
 
 ROOT_DIR = "../data/"
 
@@ -37,35 +40,113 @@ def get_scicrunch_synonyms(scicrunch_df):
   return synonym_map
 
 
-def get_more_scicrunch_synonyms(scicrunch_url):
+def get_scicrunch_page(scicrunch_url, session = None, cache_dir = None):
+  """
+  Retrieves the html of a Scicrunch page, from cache_dir if it was already downloaded
+  
+  :param scicrunch_url: URL of the Scicrunch page to query
+  :param session: requests session to send the request through
+  :param cache_dir: directory where downloaded pages are cached; no caching if None
+  
+  :return html, from_cache: html of the page (None if the request failed) and True if the page was read from cache_dir
+  """
+  cache_file = None
+  if cache_dir:
+    cache_file = os.path.join(cache_dir, hashlib.sha1(scicrunch_url.encode('utf-8')).hexdigest() + '.html')
+    if os.path.exists(cache_file):
+      with open(cache_file, 'rb') as f:
+        return f.read(), True
+  try:
+    response = (session if session else requests).get(url = scicrunch_url, timeout = 60)
+  except requests.RequestException:
+    return None, False
+  if response.status_code != 200:
+    return None, False
+  if cache_file:
+    with open(cache_file, 'wb') as f:
+      f.write(response.content)
+  return response.content, False
+
+def parse_scicrunch_page(html):
+  """
+  Extracts synonyms and abbreviations from the html of a Scicrunch page.
+  Only the 'Synonym(s)' and 'Abbreviation(s)' blocks are located, with xpath
+  
+  :param html: html of the Scicrunch page
+  
+  :return list of extra synonyms
+  """
+  if not html:
+    return []
+  root = lxml.html.fromstring(html)
+  extra_synonyms = []
+  for title in ['Synonym(s)', 'Abbreviation(s)']:
+    headers = root.xpath('//h2[string() = $title]', title = title)
+    if len(headers) > 0:
+      paragraph = headers[0].getparent().find('.//p')
+      extra_synonyms.extend(paragraph.text_content().split(', '))
+  return extra_synonyms
+
+def get_more_scicrunch_synonyms(scicrunch_url, session = None, cache_dir = None):
   """
   Scrapes a Scicrunch page to retrieve more synonyms 
   
   :param scicrunch_url: URL of the Scicrunch page to query
+  :param session: requests session to send the request through
+  :param cache_dir: directory where downloaded pages are cached; no caching if None
   
-  :return mapping from {Scicrunch mention : extra_synonym}
+  :return list of extra synonyms
   """
-  html = requests.get(url = scicrunch_url).text
-  soup = BeautifulSoup(html, 'html.parser')
-  synonyms = soup.find_all('h2', text = 'Synonym(s)')
-  if len(synonyms) > 0:
-    synonyms = synonyms[0].parent.find('p').text.split(', ')
-  abbreviations = soup.find_all('h2', text = 'Abbreviation(s)')
-  if len(abbreviations) > 0:
-    abbreviations = abbreviations[0].parent.find('p').text.split(', ')
-  return synonyms + abbreviations
-
-def generate_extra_scicrunch_synonyms(scicrunch_df):
+  html, _ = get_scicrunch_page(scicrunch_url, session, cache_dir)
+  return parse_scicrunch_page(html)
+
+def get_scicrunch_pages_synonyms(scicrunch_urls, num_workers = 8, cache_dir = None, log_every = 100):
+  """
+  Scrapes Scicrunch pages concurrently to retrieve more synonyms. Each distinct URL is fetched only once.
+  
+  :param scicrunch_urls: URLs of the Scicrunch pages to query
+  :param num_workers: number of threads fetching pages
+  :param cache_dir: directory where downloaded pages are cached; no caching if None
+  :param log_every: report progress every log_every pages
+  
+  :return mapping from {Scicrunch URL : extra synonyms}
+  """
+  urls = pd.Series(scicrunch_urls).dropna().unique()
+  num_total = len(urls)
+  if cache_dir and not os.path.exists(cache_dir):
+    os.makedirs(cache_dir)
+  session = requests.Session()
+  adapter = requests.adapters.HTTPAdapter(pool_connections = num_workers, pool_maxsize = num_workers)
+  session.mount('https://', adapter)
+  session.mount('http://', adapter)
+  url2synonyms = {}
+  num_from_cache = 0
+  t1 = time.time()
+  with ThreadPoolExecutor(max_workers = num_workers) as executor:
+    pages = executor.map(lambda url: get_scicrunch_page(url, session, cache_dir), urls)
+    for i, (url, (html, from_cache)) in enumerate(zip(urls, pages)):
+      url2synonyms[url] = parse_scicrunch_page(html)
+      num_from_cache += from_cache
+      if (i + 1) % log_every == 0 or i + 1 == num_total:
+        elapsed = time.time() - t1
+        print('Processed', i + 1, '/', num_total, 'pages', '({} from cache, {:.1f} pages/s)'.format(num_from_cache, (i + 1) / elapsed if elapsed > 0 else 0))
+  session.close()
+  return url2synonyms
+
+def generate_extra_scicrunch_synonyms(scicrunch_df, num_workers = 8, cache_dir = None):
   """
   Generates extra Scicrunch synonyms by scraping Scicrunch page URLs
   
   :param scicrunch_df: df containing mentions found in Scicrunch
+  :param num_workers: number of threads fetching pages
+  :param cache_dir: directory where downloaded pages are cached; no caching if None
   
   :return mapping from {Scicrunch mention : synonym}
   """
   print('- Generating extra Scicrunch synonyms ...')
   t1 = time.time()
-  scicrunch_df['extra_scicrunch_synonyms'] = scicrunch_df['package_url'].apply(lambda x: get_more_scicrunch_synonyms(x))
+  url2synonyms = get_scicrunch_pages_synonyms(scicrunch_df['package_url'].values, num_workers, cache_dir)
+  scicrunch_df['extra_scicrunch_synonyms'] = scicrunch_df['package_url'].apply(lambda x: url2synonyms.get(x, []))
   software_mentions = scicrunch_df['mapped_to'].values
   extra_scicrunch_synonyms = scicrunch_df['extra_scicrunch_synonyms'].values
   synonym_dict = {x: y for x, y in zip(software_mentions, extra_scicrunch_synonyms)}
@@ -78,12 +159,14 @@ if __name__ == '__main__':
 
   parser.add_argument('--scicrunch-file', type=str, default = ROOT_DIR + 'metadata_files/normalized/scicrunch_df.csv')
   parser.add_argument('--output_dir', type=str, default = ROOT_DIR + 'disambiguation_files/')
+  parser.add_argument('--num-workers', type=int, help="Number of threads fetching Scicrunch pages", default = 8)
+  parser.add_argument('--cache-dir', type=str, help="Directory where downloaded Scicrunch pages are cached", default = ROOT_DIR + 'intermediate_files/scicrunch_pages/')
 
   args, _ = parser.parse_known_args()
 
   scicrunch_df = pd.read_csv(args.scicrunch_file)  
   scicrunch_synonyms = get_scicrunch_synonyms(scicrunch_df)
   pickle.dump(scicrunch_synonyms, open(args.output_dir + 'scicrunch_synonyms.pkl', 'wb+'))
-  extra_scicrunch_synonyms = generate_extra_scicrunch_synonyms(scicrunch_df)
+  extra_scicrunch_synonyms = generate_extra_scicrunch_synonyms(scicrunch_df, args.num_workers, args.cache_dir)
   
   pickle.dump(extra_scicrunch_synonyms, open(args.output_dir + 'extra_scicrunch_synonyms.pkl', 'wb+'))
\ No newline at end of file
@@ -9,49 +9,66 @@ Author:
     Ana-Maria Istrate
 """
 
-import pandas as pd
 import pickle
 import argparse
 import ast
 import time
 import os
 import textdistance
+from utils_disambiguation import mention_ID_to_int, save_string_similarity_pairs
 
 ROOT_DIR = "../data/"
 
-def save_result_to_file(synonym_map, synonym_confidences, software_mentions_df, ID_start, ID_end, output_dir):
+def get_pairs(synonym_map, synonym_confidences, mention2ID):
   """
-  Saves result to file.
+  Flattens synonym maps to a columnar pair table
   
   :param synonym_map: map from {software_mention : synonyms}
   :param synonym_confidences: map from {software_mention : synonym_confidences}
-  :param mentions_batch_df: software_mentions_df to augment with synonyms
-  :param ID_start: ID_start for mentions in software_mentions_df
-  :param ID_end: ID_end for mentions in software_mentions_df
+  :param mention2ID: mapping from mention to ID
+  
+  :return mention_ids, synonym_ids, confs: arrays of integer mention IDs, integer synonym IDs and confidences
   """
+  mention_ids = []
+  synonym_ids = []
+  confs = []
   for software, synonyms in synonym_map.items():
-    synonyms_confs = synonym_confidences[software]
-    software_mentions_df.loc[software_mentions_df['software_mention'] == software, 'synonyms'] = str(synonyms)
-    software_mentions_df.loc[software_mentions_df['software_mention'] == software, 'synonyms_confs'] = str(synonyms_confs)
-  software_mentions_df.to_csv(output_dir + 'synonym_string_similarity_' + str(ID_start) + "_" + str(ID_end) + '.csv')
+    software_id = mention_ID_to_int(mention2ID[software])
+    mention_ids.extend([software_id] * len(synonyms))
+    synonym_ids.extend([mention_ID_to_int(mention2ID[x]) for x in synonyms])
+    confs.extend(synonym_confidences[software])
+  return mention_ids, synonym_ids, confs
+
+def save_result_to_file(synonym_map, synonym_confidences, mention2ID, ID_start, ID_end, output_dir):
+  """
+  Saves result to file, as a (mention_id, synonym_id, conf) pair table.
   
-def save_result_to_file_spark(result, software_mentions_df, ID_start, ID_end, output_dir):
+  :param synonym_map: map from {software_mention : synonyms}
+  :param synonym_confidences: map from {software_mention : synonym_confidences}
+  :param mention2ID: mapping from mention to ID
+  :param ID_start: ID_start for mentions in the batch
+  :param ID_end: ID_end for mentions in the batch
+  :param output_dir: directory to save the file to
   """
-  Converts Spark result to df and saves it to file.
+  mention_ids, synonym_ids, confs = get_pairs(synonym_map, synonym_confidences, mention2ID)
+  save_string_similarity_pairs(output_dir + 'synonym_string_similarity_' + str(ID_start) + "_" + str(ID_end) + '.npz', mention_ids, synonym_ids, confs)
+  
+def save_result_to_file_spark(result, mention2ID, ID_start, ID_end, output_dir):
+  """
+  Converts Spark result to a (mention_id, synonym_id, conf) pair table and saves it to file.
   
   :param result: result to save
-  :param software_mentions_df: software_mentions_df to augment with synonyms
-  :param ID_start: ID_start for mentions in software_mentions_df
-  :param ID_end: ID_end for mentions in software_mentions_df
+  :param mention2ID: mapping from mention to ID
+  :param ID_start: ID_start for mentions in the batch
+  :param ID_end: ID_end for mentions in the batch
+  :param output_dir: directory to save the file to
   """
+  synonym_map = {}
+  synonym_confidences = {}
   for entry in result:
-    if len(entry[0]) > 0:
-      software = list(entry[0].keys())[0]
-      synonyms = str(entry[0][software])
-      synonyms_confs = str(entry[1][software])
-      software_mentions_df.loc[software_mentions_df['software_mention'] == software, 'synonyms'] = synonyms
-      software_mentions_df.loc[software_mentions_df['software_mention'] == software, 'synonyms_confs'] = synonyms_confs
-  software_mentions_df.to_csv(output_dir + 'synonym_string_similarity_' + str(ID_start) + "_" + str(ID_end) + '.csv')
+    synonym_map.update(entry[0])
+    synonym_confidences.update(entry[1])
+  save_result_to_file(synonym_map, synonym_confidences, mention2ID, ID_start, ID_end, output_dir)
   
 def get_string_similarity_synonyms(software_mentions, all_software_mentions, threshold = 0.9):
   """
@@ -101,9 +118,6 @@ if __name__ == '__main__':
   
   mentions_batch = all_software_mentions[ID_start:ID_end]
   print(len(mentions_batch))
-  mentions_batch_IDs = [mention2ID[x] for x in mentions_batch]
-  mentions_batch_df = pd.DataFrame({'ID' : mentions_batch_IDs, 'software_mention' : mentions_batch})
-  num_mentions_batch = len(mentions_batch)
   
   # Non-Spark implementation
   if args.use_spark:
@@ -111,7 +125,7 @@ if __name__ == '__main__':
     distData = sc.parallelize(mentions_batch, 2)
     rdd = distData.map(lambda x: get_string_similarity_synonyms([x], all_software_mentions, threshold = 0.9))
     result = rdd.collect()
-    save_result_to_file_spark(result, mentions_batch_df, ID_start, ID_end, args.output_dir)
+    save_result_to_file_spark(result, mention2ID, ID_start, ID_end, args.output_dir)
   else:
     synonym_map, synonym_confidences = get_string_similarity_synonyms(mentions_batch, all_software_mentions, threshold = 0.9)
-    save_result_to_file(synonym_map, synonym_confidences, mentions_batch_df, ID_start, ID_end, args.output_dir)
\ No newline at end of file
+    save_result_to_file(synonym_map, synonym_confidences, mention2ID, ID_start, ID_end, args.output_dir)
\ No newline at end of file
@@ -0,0 +1,153 @@
+"""Compact synonym graph over integer mention IDs, shared by combine_all_synonyms.py and clustering.py
+
+Author:
+    Ana-Maria Istrate
+"""
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+from utils_disambiguation import ID_PREFIX
+
+# Sources of synonym pairs; the source of an edge is stored as its index in this list
+SYNONYM_SOURCES = ['Scicrunch', 'Scicrunch_page_query', 'pypi', 'CRAN', 'Bioconductor', 'string_similarity']
+
+class SynonymGraph:
+  """
+  Directed graph of synonym pairs, stored as a CSR adjacency over integer node IDs:
+  row i lists the synonyms of node i, with their confidence (float32) and source code (uint8, index into SYNONYM_SOURCES).
+  Nodes 0..num_mentions-1 are the integer mention IDs of mention2ID; synonyms missing from mention2ID (e.g. retrieved from Scicrunch)
+  are numbered from num_mentions on. Node names are stored as a single utf-8 buffer with offsets, and decoded on demand.
+  """
+
+  def __init__(self, indptr, indices, weights, sources, num_mentions, names_data, names_offsets):
+    """
+    :param indptr, indices: CSR structure of the adjacency
+    :param weights: float32 confidence of each edge
+    :param sources: uint8 source code of each edge
+    :param num_mentions: number of node IDs reserved for mentions of mention2ID
+    :param names_data: utf-8 encoded node names, concatenated (uint8 array)
+    :param names_offsets: offsets of each node name in names_data; node i is names_data[names_offsets[i]:names_offsets[i + 1]]
+    """
+    self.indptr = indptr
+    self.indices = indices
+    self.weights = weights
+    self.sources = sources
+    self.num_mentions = int(num_mentions)
+    self.names_data = names_data
+    self.names_offsets = names_offsets
+    self.names = None
+
+  @property
+  def num_nodes(self):
+    return len(self.indptr) - 1
+
+  @property
+  def num_edges(self):
+    return len(self.indices)
+
+  @classmethod
+  def from_synonyms_df(cls, synonyms_df, ID2mention):
+    """
+    Builds the graph from the combined synonyms (see combine_all_synonyms.py).
+    Pairs repeated across sources are merged into one edge, keeping the highest confidence and its source; self pairs and missing synonyms are dropped.
+
+    :param synonyms_df: df with fields ['ID', 'synonym', 'synonym_conf', 'synonym_source', 'synonym_ID'], with synonym_ID -1 for synonyms missing from mention2ID
+    :param ID2mention: array mapping integer IDs to software mentions (see get_ID2mention)
+
+    :return SynonymGraph
+    """
+    num_mentions = len(ID2mention)
+    rows = synonyms_df['ID'].astype(str).str[len(ID_PREFIX):].astype(np.int64).values
+    synonym_IDs = synonyms_df['synonym_ID'].astype(str)
+    known = (synonym_IDs != '-1').values
+    cols = np.empty(len(synonyms_df), dtype = np.int64)
+    cols[known] = synonym_IDs[known].str[len(ID_PREFIX):].astype(np.int64).values
+    extra_codes, extra_names = pd.factorize(synonyms_df['synonym'].values[~known])
+    cols[~known] = np.where(extra_codes >= 0, num_mentions + extra_codes, -1)
+    weights = synonyms_df['synonym_conf'].astype(np.float32).values
+    sources = pd.Categorical(synonyms_df['synonym_source'], categories = SYNONYM_SOURCES).codes.astype(np.uint8)
+
+    # Keep the edge with the highest confidence for each (row, col) pair
+    keep = (rows != cols) & (cols >= 0)
+    rows, cols, weights, sources = rows[keep], cols[keep], weights[keep], sources[keep]
+    order = np.lexsort((-weights, cols, rows))
+    rows, cols, weights, sources = rows[order], cols[order], weights[order], sources[order]
+    first = np.ones(len(rows), dtype = bool)
+    first[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+    rows, cols, weights, sources = rows[first], cols[first], weights[first], sources[first]
+
+    num_nodes = num_mentions + len(extra_names)
+    indptr = np.zeros(num_nodes + 1, dtype = np.int64)
+    np.cumsum(np.bincount(rows, minlength = num_nodes), out = indptr[1:])
+    names = [x if isinstance(x, str) else '' for x in ID2mention] + list(extra_names)
+    names_data, names_offsets = encode_names(names)
+    return cls(indptr, cols.astype(np.int32), weights, sources, num_mentions, names_data, names_offsets)
+
+  def save(self, filename):
+    """
+    :param filename: .npz file to save the graph to
+    """
+    np.savez(filename, indptr = self.indptr, indices = self.indices, weights = self.weights, sources = self.sources,
+             num_mentions = np.int64(self.num_mentions), names_data = self.names_data, names_offsets = self.names_offsets)
+
+  @classmethod
+  def load(cls, filename):
+    """
+    :param filename: .npz file saved by SynonymGraph.save
+
+    :return SynonymGraph
+    """
+    with np.load(filename) as graph:
+      return cls(graph['indptr'], graph['indices'], graph['weights'], graph['sources'], graph['num_mentions'], graph['names_data'], graph['names_offsets'])
+
+  def to_csr_matrix(self):
+    """
+    :return scipy CSR matrix of shape (num_nodes, num_nodes), with the confidences as values
+    """
+    return csr_matrix((self.weights, self.indices, self.indptr), shape = (self.num_nodes, self.num_nodes))
+
+  def get_nodes(self):
+    """
+    :return sorted IDs of the nodes with at least one edge
+    """
+    has_edges = np.diff(self.indptr) > 0
+    has_edges[self.indices] = True
+    return np.flatnonzero(has_edges)
+
+  def get_names(self, node_IDs = None):
+    """
+    :param node_IDs: node IDs; all nodes if None
+
+    :return object array with the names of node_IDs
+    """
+    if self.names is None:
+      self.names = decode_names(self.names_data, self.names_offsets)
+    return self.names if node_IDs is None else self.names[node_IDs]
+
+def encode_names(names):
+  """
+  Encodes a list of strings as a single utf-8 buffer with offsets
+
+  :param names: list of strings
+
+  :return names_data (uint8 array), names_offsets (int64 array of len(names) + 1)
+  """
+  encoded = [x.encode('utf-8') for x in names]
+  names_offsets = np.zeros(len(encoded) + 1, dtype = np.int64)
+  np.cumsum([len(x) for x in encoded], out = names_offsets[1:])
+  return np.frombuffer(b''.join(encoded), dtype = np.uint8), names_offsets
+
+def decode_names(names_data, names_offsets):
+  """
+  Decodes strings encoded by encode_names
+
+  :param names_data: utf-8 buffer
+  :param names_offsets: offsets of each string in names_data
+
+  :return object array of strings
+  """
+  buffer = names_data.tobytes()
+  names = np.empty(len(names_offsets) - 1, dtype = object)
+  names[:] = [buffer[start:end].decode('utf-8') for start, end in zip(names_offsets[:-1], names_offsets[1:])]
+  return names
@@ -0,0 +1,141 @@
+"""Helper functions common across disambiguation files
+
+Author:
+    Ana-Maria Istrate
+"""
+
+import numpy as np
+import pandas as pd
+
+# Prefix of software mention IDs, e.g. 'SM123'
+ID_PREFIX = 'SM'
+
+# Fields of an edge table: one row per (software mention, synonym) pair of a source, with integer mention IDs;
+# 'synonym_int_ID' is -1 for synonyms missing from mention2ID (e.g. retrieved from Scicrunch)
+EDGE_FIELDS = ['int_ID', 'synonym_int_ID', 'synonym', 'synonym_conf', 'synonym_source']
+
+def mention_ID_to_int(ID):
+  """
+  Converts a software mention ID (e.g. 'SM123') to its integer part (e.g. 123)
+
+  :param ID: software mention ID
+
+  :return integer ID
+  """
+  return int(ID[len(ID_PREFIX):])
+
+def int_to_mention_ID(int_ID):
+  """
+  Converts an integer ID (e.g. 123) to a software mention ID (e.g. 'SM123')
+
+  :param int_ID: integer ID
+
+  :return software mention ID
+  """
+  return ID_PREFIX + str(int_ID)
+
+def get_ID2mention(mention2ID):
+  """
+  Builds an array mapping integer IDs to software mentions, i.e. ID2mention[mention_ID_to_int(mention2ID[m])] == m
+
+  :param mention2ID: mapping from mention to ID
+
+  :return ID2mention: object array indexed by integer ID; IDs missing from mention2ID map to None
+  """
+  int_IDs = np.fromiter((mention_ID_to_int(x) for x in mention2ID.values()), dtype = np.int64, count = len(mention2ID))
+  ID2mention = np.empty(int_IDs.max() + 1 if len(int_IDs) > 0 else 0, dtype = object)
+  ID2mention[int_IDs] = list(mention2ID.keys())
+  return ID2mention
+
+def get_mention2int_ID(mention2ID):
+  """
+  Builds a Series mapping software mentions to integer IDs, for vectorized lookups (Series.map)
+
+  :param mention2ID: mapping from mention to ID
+
+  :return Series indexed by software mention, with int64 values
+  """
+  int_IDs = np.fromiter((mention_ID_to_int(x) for x in mention2ID.values()), dtype = np.int64, count = len(mention2ID))
+  return pd.Series(int_IDs, index = pd.Index(list(mention2ID.keys()), dtype = object))
+
+def save_string_similarity_pairs(filename, mention_ids, synonym_ids, confs):
+  """
+  Saves string similarity pairs as a columnar pair table
+
+  :param filename: .npz file to save the pairs to
+  :param mention_ids: integer IDs of software mentions
+  :param synonym_ids: integer IDs of synonyms
+  :param confs: string similarity confidences
+  """
+  np.savez(filename,
+    mention_id = np.asarray(mention_ids, dtype = np.int32),
+    synonym_id = np.asarray(synonym_ids, dtype = np.int32),
+    conf = np.asarray(confs, dtype = np.float32))
+
+def load_string_similarity_pairs(filename):
+  """
+  Loads string similarity pairs saved by save_string_similarity_pairs
+
+  :param filename: .npz file containing the pairs
+
+  :return mention_ids, synonym_ids, confs: int32, int32 and float32 arrays
+  """
+  with np.load(filename) as pairs:
+    return pairs['mention_id'], pairs['synonym_id'], pairs['conf']
+
+def string_similarity_pairs_to_edges(mention_ids, synonym_ids, confs, ID2mention, synonym_source = 'string_similarity'):
+  """
+  Converts string similarity pairs to an edge table (see EDGE_FIELDS).
+  Only keeps mentions with more than one synonym, since every mention is trivially similar to itself.
+
+  :param mention_ids: integer IDs of software mentions
+  :param synonym_ids: integer IDs of synonyms
+  :param confs: string similarity confidences
+  :param ID2mention: array mapping integer IDs to software mentions
+  :param synonym_source: value of the 'synonym_source' field
+
+  :return edge df
+  """
+  unique_ids, counts = np.unique(mention_ids, return_counts = True)
+  keep = np.isin(mention_ids, unique_ids[counts > 1])
+  df = pd.DataFrame({
+    'int_ID' : mention_ids[keep].astype(np.int64),
+    'synonym_int_ID' : synonym_ids[keep].astype(np.int64),
+    'synonym' : ID2mention[synonym_ids[keep]],
+    'synonym_conf' : confs[keep].astype(float),
+    'synonym_source' : synonym_source})
+  return df
+
+def drop_duplicate_edges(edges):
+  """
+  Drops duplicate edges, comparing integer keys instead of strings: 
+  synonyms are keyed by their integer ID, and synonyms missing from mention2ID by a negative code, computed once per unique string
+
+  :param edges: edge df of a single source
+
+  :return edges, without duplicates
+  """
+  synonym_keys = edges['synonym_int_ID'].values.copy()
+  unknown = synonym_keys < 0
+  if unknown.any():
+    codes, _ = pd.factorize(edges['synonym'].values[unknown])
+    synonym_keys[unknown] = -2 - codes
+  keys = pd.DataFrame({'int_ID' : edges['int_ID'].values, 'synonym_key' : synonym_keys, 'synonym_conf' : edges['synonym_conf'].values})
+  return edges[~keys.duplicated().values]
+
+def edges_to_synonyms_df(edges, ID2mention):
+  """
+  Converts an edge table to a (long) df of synonym pairs
+
+  :param edges: edge df
+  :param ID2mention: array mapping integer IDs to software mentions
+
+  :return df with fields ['ID', 'software_mention', 'synonym', 'synonym_conf', 'synonym_source']
+  """
+  df = pd.DataFrame({
+    'ID' : ID_PREFIX + edges['int_ID'].astype(str).values,
+    'software_mention' : ID2mention[edges['int_ID'].values],
+    'synonym' : edges['synonym'].values,
+    'synonym_conf' : edges['synonym_conf'].values,
+    'synonym_source' : edges['synonym_source'].values}, index = edges.index)
+  return df
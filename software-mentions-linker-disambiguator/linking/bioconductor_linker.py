@@ -7,6 +7,7 @@ Usage:
 
 Details:
     The linker queries the Bioconductor repository for exact matches (case dependent) of mentions in the input file.
+    Mentions are linked against a local snapshot of the Bioconductor index, fetched once by registry_snapshots.py (--refresh-snapshot fetches a new one).
     Parses individual Bioconductor project pages to extract: BioConductor Package, BioConductor Link, Maintainer, Title
     Saves raw file under metadata_files/raw/bioconductor_raw_df.csv
     Saves normalized file (to a common schema among all metadata files) under metadata_files/normalized/bioconductor_df.csv
@@ -18,33 +19,33 @@ Author:
 from utils_linker import *
 from utils_common import *
 from schema_normalizations import *
-from bs4 import BeautifulSoup
+from registry_snapshots import *
+from functools import partial
 
 # Search BioConductor
-def build_df(packages, software_mentions, bioconductor_links, maintainers, titles):
+def build_df(snapshot_df, software_mentions):
   """ 
-  Filters list of BioConductor packages and metadata for a given array of software mentions
+  Filters the snapshot of the BioConductor index for a given array of software mentions. 
+  Package names are lowercased before matching.
 
-  :param packages: software packages available in the BioConductor repository
+  :param snapshot_df: snapshot of the BioConductor index (see registry_snapshots.py)
   :param software_mentions: software mentions we want to link
-  :param bioconductor_links: links of software_mentions in the BioConductor repository
-  :param maintainers: maintainers of software packages in the BioConductor repository
-  :param titles: titles of software packages in the BioConductor repository
 
-  :return: filtered df containing all the above metadata
+  :return: filtered df containing the BioConductor Package, BioConductor Link, Maintainer and Title of linked mentions
   """ 
-
-  df = pd.DataFrame({'Bioconductor Package' : packages, 'BioConductor Link' : bioconductor_links, 'Maintainer' : maintainers, 'Title' : titles})
-  df = df[df['Bioconductor Package'].isin(software_mentions)]
+  linked_df = link_snapshot(snapshot_df, software_mentions, lowercase_names = True)
+  df = pd.DataFrame({'Bioconductor Package' : linked_df['name'], 'BioConductor Link' : linked_df['url'], 'Maintainer' : linked_df['maintainer'], 'Title' : linked_df['title']})
   return df
 
-def get_bioconductor_df(software_mentions, filename = None, save_new = True):
+def get_bioconductor_df(software_mentions, filename = None, save_new = True, snapshot_dir = ROOT_DIR_SNAPSHOTS, refresh_snapshot = False):
   """ 
   Retrieves links and metadata from the BioConductor repository for a list of software mentions. 
 
   :param software_mentions: list of software mentions to query
   :param filename: where the raw (un-normalized) file will be saved
   :param save_new: True if to create the file from scratch
+  :param snapshot_dir: directory containing the registry snapshots
+  :param refresh_snapshot: if True, fetch a new snapshot of the BioConductor index
 
   :return: linked (raw) dataframe
   """ 
@@ -56,53 +57,12 @@ def get_bioconductor_df(software_mentions, filename = None, save_new = True):
   elif not filename_exists and not save_new:
     raise Exception('- Sorry, the file', filename, 'does not exist on file. Please use --generate-new t generate first.')
   else:
-    header = True
     print('- Generating Bioconductor dataframe ... ')
-    bioconductor_url = "https://www.bioconductor.org/packages/release/bioc/"
-    bioconductor_html = requests.get(url = bioconductor_url).text
-    soup = BeautifulSoup(bioconductor_html, 'html.parser')
-    packages = []
-    maintainers = []
-    titles = []
-    bioconductor_links = []
-    num_processed = 0
-    num_processed_total = 0
-    total_entries = soup.find_all('tr')[1:]
-    num_total = len(total_entries)
-    final_dfs = []
-    mode = 'w'
-    for tr in total_entries:
-      num_processed += 1
-      num_processed_total += 1
-      tds = tr.find_all('td')
-      hrefs = str(tds[0].find_all('a')[0])
-      package_link, package_name = parse_html_string(hrefs)
-      bioconductor_link = 'https://www.bioconductor.org/packages/release/bioc/' + package_link
-      maintainer = tds[1].text
-      title = tds[2].text
-      packages.append(package_name.lower())
-      bioconductor_links.append(bioconductor_link)
-      maintainers.append(maintainer)
-      titles.append(title)
-      if num_processed == CHUNK_SIZE:
-        df  = build_df(packages, software_mentions, bioconductor_links, maintainers, titles)
-        if len(df) > 0:
-          df.to_csv(filename, index = False, header = header, mode = mode)
-          header = False
-          print('Processed', num_processed_total, '/', num_total, 'saving', len(df), 'to', filename)
-          final_dfs.append(df)
-          mode = 'a'
-        num_processed = 0
-        packages = []
-        maintainers = []
-        titles = []
-        bioconductor_links = []
-    df = build_df(packages, software_mentions, bioconductor_links, maintainers, titles)
-    if len(df) > 0:
-      df.to_csv(filename, index = False, header = header, mode = mode)
-      final_dfs.append(df)
-      print('Processed', num_processed_total, '/', num_total, 'saving', len(df), 'to', filename)
-    return pd.concat(final_dfs)
+    snapshot_df = load_snapshot('bioconductor', snapshot_dir, refresh_snapshot)
+    df = build_df(snapshot_df, software_mentions)
+    df.to_csv(filename, index = False)
+    print('Processed', len(snapshot_df), 'packages, saving', len(df), 'to', filename)
+    return df
 
 
 # Usage: python bioconductor_linker.py --generate-new
@@ -115,12 +75,15 @@ if __name__ == '__main__':
   parser.add_argument("--top-k", help="Retrieve top_k mentions", type = int, default = -1, required = False)
   parser.add_argument("--generate-new", help="True if generating a new file from scratch", default = False, action = 'store_true', required = False)
   parser.add_argument("--ID-start", help="ID mention start", type = str, required = False)
-  parser.add_argument("--ID-end", help="ID mention end", type = str, required = False) 
+  parser.add_argument("--ID-end", help="ID mention end", type = str, required = False)
+  parser.add_argument("--snapshot-dir", help="Directory containing the registry snapshots", default = ROOT_DIR_SNAPSHOTS, required = False)
+  parser.add_argument("--refresh-snapshot", help="Fetch a new snapshot of the index before linking", default = False, action = 'store_true', required = False)
+  parser.add_argument("--output-format", help="Format of the normalized file", default = 'csv', choices = OUTPUT_FORMATS, required = False)
   args = parser.parse_args()
   print(args)
 
   bioconductor_linker = DatabaseLinker(args.input_file, args.output_file, args.min_freq, args.top_k, 
                       args.raw_filename, args.generate_new, 'bioconductor_df', args.ID_start, args.ID_end)
-  bioconductor_linker.get_metadata_df(get_bioconductor_df)
+  bioconductor_linker.get_metadata_df(partial(get_bioconductor_df, snapshot_dir = args.snapshot_dir, refresh_snapshot = args.refresh_snapshot))
   bioconductor_linker.normalize_schema(normalize_bioconductor_df)
-  bioconductor_linker.save_to_file()
+  bioconductor_linker.save_to_file(args.output_format)
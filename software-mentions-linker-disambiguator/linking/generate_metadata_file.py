@@ -7,6 +7,9 @@ Usage:
 
 Details:
     Retrieves normalized metadata files from a given root directory, does light processing, and outputs master metadata file to output directory. 
+    Files are streamed in chunks, reading only the fields of the linking schema; rows are deduplicated on a hash of the row,
+    and Github rows that are not exact matches are dropped chunk by chunk, so memory doesn't grow with the number of sources and rows.
+    The output can be written as TSV (default) or Parquet, and partitioned by source (--partition-dir).
 
 Author:
     Ana-Maria Istrate
@@ -15,26 +18,148 @@ Author:
 import os
 import pandas as pd
 import argparse
+from utils_linker import LINKING_SCHEMA, to_linking_schema, get_parquet_schema
+
+# Number of rows of a normalized metadata file read at a time
+CHUNK_ROWS = 100000
+
+# Formats the master metadata file can be saved in
+MASTER_OUTPUT_FORMATS = ['tsv', 'parquet']
+
+def read_metadata_chunks(filename, chunk_rows = CHUNK_ROWS):
+	"""
+	Reads a normalized metadata file in chunks, keeping only the fields of the linking schema
+
+	:param filename: normalized metadata file (.csv or .parquet)
+	:param chunk_rows: number of rows per chunk
+
+	:return iterator over dfs with the fields of the linking schema (see to_linking_schema)
+	"""
+	fields = [field for field, _ in LINKING_SCHEMA]
+	if filename.endswith('.parquet'):
+		import pyarrow.parquet as pq
+		parquet_file = pq.ParquetFile(filename)
+		columns = [field for field in fields if field in parquet_file.schema_arrow.names]
+		for batch in parquet_file.iter_batches(batch_size = chunk_rows, columns = columns):
+			yield to_linking_schema(batch.to_pandas())
+	else:
+		for chunk in pd.read_csv(filename, usecols = lambda field: field in fields, dtype = str, chunksize = chunk_rows):
+			yield to_linking_schema(chunk)
+
+def filter_metadata_chunk(df, seen_hashes):
+	"""
+	Filters a chunk of normalized metadata: drops rows already seen (by row hash), and Github rows that are not exact matches
+
+	:param df: chunk of normalized metadata, with the fields of the linking schema
+	:param seen_hashes: set of hashes of the rows kept so far; updated in place
+
+	:return filtered df
+	"""
+	df = df[(df['source'] != 'Github API') | (df['exact_match'] == True)]
+	row_hashes = pd.util.hash_pandas_object(df, index = False).tolist()
+	keep = []
+	for row_hash in row_hashes:
+		keep.append(row_hash not in seen_hashes)
+		seen_hashes.add(row_hash)
+	return df[keep]
+
+class MetadataWriter:
+	"""
+	Writes the master metadata file chunk by chunk, either as a single file, or partitioned by source,
+	as <partition_dir>/source=<source>/part-<n>.<tsv|parquet>, with the source in the directory name only (Hive-style partitioning)
+	"""
+
+	def __init__(self, output_file, output_format = 'tsv', partition_dir = None):
+		"""
+		:param output_file: master metadata file; ignored if partition_dir is given
+		:param output_format: 'tsv' or 'parquet' (requires pyarrow)
+		:param partition_dir: if given, directory to write one partition per source to
+		"""
+		self.output_file = output_file
+		self.output_format = output_format
+		self.partition_dir = partition_dir
+		self.parquet_writer = None
+		self.num_chunks = 0
+		self.num_rows = 0
+
+	def write_file(self, df, filename, append):
+		if self.output_format == 'parquet':
+			import pyarrow as pa
+			import pyarrow.parquet as pq
+			schema = get_parquet_schema()
+			if 'source' not in df.columns:
+				schema = schema.remove(schema.get_field_index('source'))
+			table = pa.Table.from_pandas(df, schema = schema, preserve_index = False)
+			if append:
+				self.parquet_writer.write_table(table)
+			else:
+				pq.write_table(table, filename)
+		else:
+			df.to_csv(filename, sep = '\t', index = False, header = not append, mode = 'a' if append else 'w')
+
+	def write(self, df):
+		"""
+		Writes a chunk of the master metadata file
+
+		:param df: chunk, with the fields of the linking schema
+		"""
+		if self.partition_dir:
+			for source, source_df in df.groupby('source', dropna = False, sort = False):
+				source_dir = os.path.join(self.partition_dir, 'source=' + str(source))
+				os.makedirs(source_dir, exist_ok = True)
+				self.write_file(source_df.drop(columns = ['source']), os.path.join(source_dir, 'part-' + str(self.num_chunks).zfill(5) + '.' + self.output_format), False)
+		elif self.output_format == 'parquet':
+			if self.parquet_writer is None:
+				import pyarrow.parquet as pq
+				self.parquet_writer = pq.ParquetWriter(self.output_file, get_parquet_schema())
+			self.write_file(df, self.output_file, True)
+		else:
+			self.write_file(df, self.output_file, self.num_chunks > 0)
+		self.num_chunks += 1
+		self.num_rows += len(df)
+
+	def close(self):
+		if self.num_chunks == 0 and not self.partition_dir:
+			# no rows: still write the header (or schema) of the output file
+			self.write(to_linking_schema(pd.DataFrame()))
+		if self.parquet_writer:
+			self.parquet_writer.close()
+
+def generate_metadata_file(metadata_files, output_file, output_format = 'tsv', partition_dir = None):
+	"""
+	Merges normalized metadata files into a master metadata file, chunk by chunk. 
+	Only the fields of the linking schema are read; Github rows that are not exact matches are dropped, 
+	and duplicate rows (across all files) are dropped by comparing row hashes.
+
+	:param metadata_files: list of normalized metadata files (.csv or .parquet)
+	:param output_file: location of the master metadata file
+	:param output_format: 'tsv' or 'parquet'
+	:param partition_dir: if given, the master metadata file is written partitioned by source under this directory, instead of to output_file
+
+	:return number of rows of the master metadata file
+	"""
+	writer = MetadataWriter(output_file, output_format, partition_dir)
+	seen_hashes = set()
+	for f in metadata_files:
+		print('Concatenating file', f)
+		for df in read_metadata_chunks(f):
+			df = filter_metadata_chunk(df, seen_hashes)
+			if len(df) > 0:
+				writer.write(df)
+	writer.close()
+	return writer.num_rows
 
 if __name__ == '__main__':
 	parser = argparse.ArgumentParser(description='Linking normalized metadata files.')
 	parser.add_argument("--root_dir", help="Root directory where metadata files are located", default = '../data/metadata_files/normalized/', required = False)
 	parser.add_argument("--output-file", help="Location of output file", default = '../data/metadata_files/metadata.csv', required = False)
+	parser.add_argument("--output-format", help="Format of the output file", default = 'tsv', choices = MASTER_OUTPUT_FORMATS, required = False)
+	parser.add_argument("--partition-dir", help="If given, write the output partitioned by source under this directory, instead of to --output-file", default = None, required = False)
 	args = parser.parse_args()
 
 	root_dir = args.root_dir
 	output_file = args.output_file
 
-	metadata_dfs = []
-	for filename in os.listdir(root_dir):
-		f = os.path.join(root_dir, filename)
-		if os.path.isfile(f):
-			print('Concatenating file', f)
-			df = pd.read_csv(f)
-			metadata_dfs.append(df)
-
-	metadata_df = pd.concat(metadata_dfs)
-	metadata_df = metadata_df.drop_duplicates()
-	metadata_df = metadata_df[((metadata_df['source'] == 'Github API') & (metadata_df['exact_match'] == True)) | (metadata_df['source'] != 'Github API')]
-	metadata_df.to_csv(output_file, sep = '\t', index = False)
-
+	metadata_files = [os.path.join(root_dir, filename) for filename in os.listdir(root_dir)]
+	num_rows = generate_metadata_file([f for f in metadata_files if os.path.isfile(f)], output_file, args.output_format, args.partition_dir)
+	print('- Saved', num_rows, 'rows to', args.partition_dir if args.partition_dir else output_file)
@@ -18,35 +18,142 @@ Author:
 
 from utils_linker import *
 from utils_common import *
+from utils_http import *
 import time
 from schema_normalizations import *
 import requests
 import os
+import json
+import asyncio
+import aiohttp
+from functools import partial
 
-def search_github_repos(software):
+# Github search API endpoint
+GITHUB_SEARCH_URL = 'https://api.github.com/search/repositories'
+
+# Number of search requests allowed per minute for an authenticated user
+GITHUB_SEARCH_REQUESTS_PER_MINUTE = 30
+
+# Fields of the raw github df
+GITHUB_RAW_COLUMNS = ['software_mention', 'best_github_match', 'description', 'github_url', 'license', 'exact_match']
+
+def get_github_tokens():
+  """ 
+  Retrieves Github tokens from the environment. 
+  GITHUB_TOKEN can contain several comma-separated tokens, which the async linker spreads requests across.
+
+  :return list of tokens ([None] if no token is set, i.e. unauthenticated requests)
+  """ 
+  tokens = [token.strip() for token in os.getenv("GITHUB_TOKEN", "").split(',') if token.strip()]
+  return tokens if tokens else [None]
+
+def search_github_repos(software, api_url = GITHUB_SEARCH_URL, max_retries = 5):
   """ 
   Query the Github API for a particular software.
+  Waits according to the Retry-After and X-RateLimit-Reset headers when rate limited; a 403 that isn't rate limited is not retried.
 
   :param software: software mention to query
+  :param api_url: Github search API endpoint
+  :param max_retries: maximum number of retries for rate limited or failed (5xx) requests
 
-  :return JSON response
+  :return JSON response ({} if the query failed)
   """ 
-  url = 'https://api.github.com/search/repositories'
+  url = api_url
   params = {
       'q' : software
   }
   user = os.getenv("GITHUB_USER")
-  token = os.getenv("GITHUB_TOKEN")
-  authorization = "token " + token
+  token = get_github_tokens()[0]
   headers = {
       "Accept": "application/vnd.github.v3+json",
       }
   response = requests.get(url = url, params = params, headers = headers, auth = (user, token))
+  num_retries = 0
   while(response.status_code != 200):
-    time.sleep(1)
+    if response.status_code in (403, 429):
+      if not is_rate_limited(response.headers, response.status_code):
+        return {}
+    elif response.status_code < 500:
+      return {}
+    if num_retries == max_retries:
+      return {}
+    num_retries += 1
+    time.sleep(get_wait_time(response.headers))
     response = requests.get(url = url, params = params, headers = headers, auth = (user, token))
   return response.json()
 
+async def search_github_repos_async(session, scheduler, cache, software, api_url = GITHUB_SEARCH_URL, max_retries = 5):
+  """ 
+  Query the Github API for a particular software, without blocking. 
+  Requests are scheduled across tokens by scheduler; cached responses are revalidated with their ETag,
+  so that unchanged results (HTTP 304) don't spend the rate limit.
+
+  :param session: aiohttp client session
+  :param scheduler: TokenBucketScheduler over the Github tokens
+  :param cache: ResponseCache for Github responses, or None
+  :param software: software mention to query
+  :param api_url: Github search API endpoint
+  :param max_retries: maximum number of retries for rate limited or failed requests; a 403 that isn't rate limited is not retried
+
+  :return JSON response ({} if the query failed)
+  """ 
+  cached = cache.get(api_url, software) if cache else None
+  headers = {
+      "Accept": "application/vnd.github.v3+json",
+      }
+  if cached and cached['etag']:
+    headers['If-None-Match'] = cached['etag']
+  num_retries = 0
+  while num_retries <= max_retries:
+    token = await scheduler.acquire()
+    request_headers = dict(headers)
+    if token:
+      request_headers['Authorization'] = 'token ' + token
+    try:
+      async with session.get(api_url, params = {'q' : software}, headers = request_headers) as response:
+        scheduler.update(token, response.headers, response.status)
+        if response.status == 304 and cached:
+          cache.touch(api_url, software)
+          return json.loads(cached['body'])
+        if response.status == 200:
+          body = await response.read()
+          if cache:
+            cache.put(api_url, software, body, response.headers.get('ETag'))
+          return json.loads(body)
+        if response.status in (403, 429):
+          if not is_rate_limited(response.headers, response.status):
+            # e.g. a revoked token or an abuse block: retrying won't help
+            return {}
+          # the scheduler holds the token back until the rate limit resets
+          num_retries += 1
+          continue
+        if response.status < 500:
+          return {}
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+      pass
+    num_retries += 1
+    await asyncio.sleep(DEFAULT_RETRY_WAIT * 2 ** num_retries)
+  return {}
+
+async def fetch_github_responses(software_mentions, scheduler, cache, max_concurrency, api_url = GITHUB_SEARCH_URL):
+  """ 
+  Query the Github API for a list of software mentions, with at most max_concurrency requests in flight.
+
+  :param software_mentions: list of software mentions to query
+  :param scheduler: TokenBucketScheduler over the Github tokens
+  :param cache: ResponseCache for Github responses, or None
+  :param max_concurrency: maximum number of concurrent requests
+  :param api_url: Github search API endpoint
+
+  :return list of JSON responses, in the order of software_mentions
+  """ 
+  semaphore = asyncio.Semaphore(max_concurrency)
+  async with aiohttp.ClientSession(connector = aiohttp.TCPConnector(limit = max_concurrency)) as session:
+    async def fetch(software_mention):
+      async with semaphore:
+        return await search_github_repos_async(session, scheduler, cache, software_mention, api_url)
+    return await asyncio.gather(*[fetch(software_mention) for software_mention in software_mentions])
+
 def parse_json_response(response, mention):
   """ 
   Parses the JSON response received by querying the Github API for a given mention.
@@ -74,13 +181,60 @@ def parse_json_response(response, mention):
   except:
     return "no_github_entry", "no_github_entry", "no_github_entry", "no_github_entry"
 
-def get_github_df(software_mentions, filename = None, save_new = True):
+def link_github_mentions(software_mentions, scheduler = None, cache = None, max_concurrency = 10, api_url = GITHUB_SEARCH_URL, linking_cache = None):
+  """ 
+  Links a batch of software mentions to Github. 
+
+  :param software_mentions: list of software mentions to query
+  :param scheduler: TokenBucketScheduler over the Github tokens, to query Github concurrently; mentions are queried one by one if None
+  :param cache: ResponseCache for Github responses (concurrent queries only), or None
+  :param max_concurrency: maximum number of concurrent requests
+  :param api_url: Github search API endpoint
+  :param linking_cache: LinkingCache of results from previous runs; mentions with a fresh cached result aren't queried
+
+  :return list containing the list of raw records (with GITHUB_RAW_COLUMNS fields) for each software mention, in the order of software_mentions
+  """ 
+  cached = linking_cache.get_many('github', software_mentions) if linking_cache else {}
+  to_fetch = [software_mention for software_mention in software_mentions if software_mention not in cached]
+  if scheduler:
+    json_responses = asyncio.run(fetch_github_responses(to_fetch, scheduler, cache, max_concurrency, api_url))
+  else:
+    json_responses = [search_github_repos(software_mention, api_url) for software_mention in to_fetch]
+  fetched = {}
+  for software_mention, json_response in zip(to_fetch, json_responses):
+    best_name_match, description, url, license = parse_json_response(json_response, software_mention)
+    if best_name_match != 'no_github_entry':
+      fetched[software_mention] = [{'software_mention' : software_mention, 'best_github_match' : best_name_match, 'description' : description, 
+                                    'github_url' : url, 'license' : license}]
+    else:
+      fetched[software_mention] = []
+  if linking_cache:
+    # failed queries ({} responses) aren't cached
+    linking_cache.put_many('github', {software_mention : fetched[software_mention] for software_mention, json_response in zip(to_fetch, json_responses) if json_response})
+  fetched.update(cached)
+  records = []
+  for software_mention in software_mentions:
+    # cached records may come from another spelling of the same normalized query
+    records.append([dict(record, software_mention = software_mention, exact_match = 'true' if record['best_github_match'] == software_mention else 'false') 
+                    for record in fetched[software_mention]])
+  return records
+
+def get_github_df(software_mentions, filename = None, save_new = True, use_async = False, tokens = None, max_concurrency = 10, cache_file = None, api_url = GITHUB_SEARCH_URL, 
+                  linking_cache_file = None, cache_ttl_days = LINKING_CACHE_TTL_DAYS, negative_cache_ttl_days = LINKING_CACHE_NEGATIVE_TTL_DAYS):
   """ 
   Retrieves links and metadata from Github for a list of software mentions. 
 
   :param software_mentions: list of software mentions to query
   :param filename: where the raw (un-normalized) file will be saved
   :param save_new: True if to create the file from scratch
+  :param use_async: if True, query Github concurrently (asyncio), scheduling requests across tokens according to the rate limit
+  :param tokens: Github tokens used by the async linker; read from GITHUB_TOKEN if None
+  :param max_concurrency: maximum number of concurrent requests for the async linker
+  :param cache_file: SQLite file caching Github responses (async linker only); no caching if None
+  :param api_url: Github search API endpoint, e.g. a local stub server for testing
+  :param linking_cache_file: SQLite file caching linking results across runs; no caching if None
+  :param cache_ttl_days: days after which cached results are queried again
+  :param negative_cache_ttl_days: days after which cached no_github_entry results are queried again
   
   :return: linked (raw) dataframe
   """ 
@@ -92,56 +246,22 @@ def get_github_df(software_mentions, filename = None, save_new = True):
     raise Exception('- Sorry, the file', filename, 'does not exist on file. Please use --generate-new t generate first.')
   else:
     print('- Generating Github dataframe ...')
-    best_name_match_arr = []
-    description_arr = []
-    url_arr = []
-    initial_queries = []
-    licenses = []
-    exact_matches = []
-    num_processed = 0
-    num_processed_total = 0
+    cache = ResponseCache(cache_file) if cache_file else None
+    linking_cache = LinkingCache(linking_cache_file, cache_ttl_days, negative_cache_ttl_days) if linking_cache_file else None
+    scheduler = TokenBucketScheduler(tokens if tokens else get_github_tokens(), GITHUB_SEARCH_REQUESTS_PER_MINUTE) if use_async else None
     num_total = len(software_mentions)
-    header = True
-    final_dfs = []
-    mode = 'w'
-    for software_mention in software_mentions:
-      num_processed += 1
-      num_processed_total += 1
-      json_response = search_github_repos(software_mention)
-      best_name_match, description, url, license = parse_json_response(json_response, software_mention)
-      if best_name_match == software_mention:
-        exact_match = 'true'
-      else:
-        exact_match = 'false'
-      if best_name_match != 'no_github_entry':
-        best_name_match_arr.append(best_name_match)
-        description_arr.append(description)
-        url_arr.append(url)
-        licenses.append(license)
-        initial_queries.append(software_mention)
-        exact_matches.append(exact_match)
-
-      if num_processed == CHUNK_SIZE:
-        df = pd.DataFrame({'software_mention' : initial_queries, 'best_github_match' : best_name_match_arr, 'description' : description_arr, 'github_url' : url_arr, 'license' : licenses, 'exact_match' : exact_matches})
-        if len(df) > 0:
-          df.to_csv(filename, index = False, header = header, mode = mode)
-          header = False
-          print('Processed', num_processed_total, '/', num_total, 'saving', len(df), 'to', filename)
-          final_dfs.append(df)
-          mode = 'a'
-        num_processed = 0
-        best_name_match_arr = []
-        description_arr = []
-        url_arr = []
-        initial_queries = []
-        licenses = []
-        exact_matches = []
-    df = pd.DataFrame({'software_mention' : initial_queries, 'best_github_match' : best_name_match_arr, 'description' : description_arr, 'github_url' : url_arr, 'license' : licenses, 'exact match' : exact_matches})
-    if len(df) > 0:
-      df.to_csv(filename, index = False, header = header, mode = mode)
-      print('Processed', num_processed_total, '/', num_total, 'saving', len(df), 'to', filename)
-      final_dfs.append(df)
-    return pd.concat(final_dfs)
+    writer = ChunkedCSVWriter(filename, GITHUB_RAW_COLUMNS)
+    for chunk_start in range(0, num_total, CHUNK_SIZE):
+      chunk = software_mentions[chunk_start:chunk_start + CHUNK_SIZE]
+      for records in link_github_mentions(chunk, scheduler, cache, max_concurrency, api_url, linking_cache):
+        writer.extend(records)
+      writer.flush(chunk_start + len(chunk), num_total)
+    if cache:
+      cache.close()
+    if linking_cache:
+      print('-', linking_cache.report())
+      linking_cache.close()
+    return writer.close()
 
 # Usage: python github_linker.py --generate-new
 if __name__ == '__main__':
@@ -155,11 +275,21 @@ if __name__ == '__main__':
   parser.add_argument("--ID-start", help="ID mention start", type = str, required = False)
   parser.add_argument("--ID-end", help="ID mention end", type = str, required = False)
   parser.add_argument("--IDs-seen-so-far", help="Filter out IDs seen so far", type = str, default = 'github_IDs_queried_total.npy', required = False)
+  parser.add_argument("--use-async", help="Query Github concurrently, across all tokens in GITHUB_TOKEN (comma-separated)", default = False, action = 'store_true', required = False)
+  parser.add_argument("--max-concurrency", help="Maximum number of concurrent Github requests (with --use-async)", type = int, default = 10, required = False)
+  parser.add_argument("--cache-file", help="SQLite file caching Github responses (with --use-async)", default = ROOT_DIR_INTERMEDIATE_FILES + 'github_responses.sqlite', required = False)
+  parser.add_argument("--api-url", help="Github search API endpoint", default = GITHUB_SEARCH_URL, required = False)
+  parser.add_argument("--linking-cache-file", help="SQLite file caching linking results across runs; pass '' to disable", default = ROOT_DIR_INTERMEDIATE_FILES + 'linking_cache.sqlite', required = False)
+  parser.add_argument("--cache-ttl-days", help="Days after which cached results are queried again", type = float, default = LINKING_CACHE_TTL_DAYS, required = False)
+  parser.add_argument("--negative-cache-ttl-days", help="Days after which cached no_github_entry results are queried again", type = float, default = LINKING_CACHE_NEGATIVE_TTL_DAYS, required = False)
+  parser.add_argument("--output-format", help="Format of the normalized file", default = 'csv', choices = OUTPUT_FORMATS, required = False)
   args = parser.parse_args()
   print(args)
 
   github_linker = DatabaseLinker(args.input_file, args.output_file, args.min_freq, args.top_k, 
                       args.raw_filename, args.generate_new, 'github_df', args.ID_start, args.ID_end, None)
-  github_linker.get_metadata_df(get_github_df)
+  github_linker.get_metadata_df(partial(get_github_df, use_async = args.use_async, max_concurrency = args.max_concurrency, 
+                      cache_file = args.cache_file, api_url = args.api_url, linking_cache_file = args.linking_cache_file, 
+                      cache_ttl_days = args.cache_ttl_days, negative_cache_ttl_days = args.negative_cache_ttl_days))
   github_linker.normalize_schema(normalize_github_df)
-  github_linker.save_to_file()
+  github_linker.save_to_file(args.output_format)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+"""Links software mentions to all sources (PyPI, CRAN, Bioconductor, Github, SciCrunch) and generates the master metadata file
+
+Usage:
+    python link_all_sources.py --input-file <input_file> --generate-new
+
+Details:
+    Loads the input file and the mention2ID map once, and shares them across the linkers of all sources.
+    Each source is linked in its own thread, since querying the sources is I/O bound;
+    schema normalization is CPU bound and runs in a pool of processes (--num-processes).
+    Saves raw files under metadata_files/raw/ and normalized files under metadata_files/normalized/, with the same filenames as the individual linkers,
+    then concatenates the normalized files into metadata_files/metadata.csv (see generate_metadata_file.py).
+    Prints per-source timings at the end.
+
+Author:
+    Ana-Maria Istrate
+"""
+
+from utils_linker import *
+from utils_common import *
+from utils_http import LINKING_CACHE_TTL_DAYS, LINKING_CACHE_NEGATIVE_TTL_DAYS
+from schema_normalizations import *
+from registry_snapshots import ROOT_DIR_SNAPSHOTS
+from bioconductor_linker import get_bioconductor_df
+from cran_linker import get_cran_df
+from pypi_linker import get_pypi_df
+from github_linker import get_github_df
+from scicrunch_linker import get_scicrunch_df
+from generate_metadata_file import generate_metadata_file, MASTER_OUTPUT_FORMATS
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
+
+# Sources, with their df type, normalized and raw filenames
+SOURCES = {
+  'bioconductor' : ('bioconductor_df', 'bioconductor_df.csv', 'bioconductor_raw_df.csv'),
+  'cran' : ('cran_df', 'cran_df.csv', 'cran_raw_df.csv'),
+  'pypi' : ('pypi_df', 'pypi_df.csv', 'pypi_raw_df.csv'),
+  'github' : ('github_df', 'github_df.csv', 'github_raw_df.csv'),
+  'scicrunch' : ('scicrunch_df', 'scicrunch_df.csv', 'scicrunch_raw_df.csv'),
+}
+
+def get_linking_fns(args):
+  """
+  Returns the metadata generation and schema normalization functions of each source, configured from the command line arguments
+
+  :param args: command line arguments
+
+  :return dict mapping source to (metadata_generation_fn, schema_normalization_fn)
+  """
+  linking_cache_args = {'linking_cache_file' : args.linking_cache_file, 'cache_ttl_days' : args.cache_ttl_days, 'negative_cache_ttl_days' : args.negative_cache_ttl_days}
+  return {
+    'bioconductor' : (partial(get_bioconductor_df, snapshot_dir = args.snapshot_dir, refresh_snapshot = args.refresh_snapshots), normalize_bioconductor_df),
+    'cran' : (partial(get_cran_df, snapshot_dir = args.snapshot_dir, refresh_snapshot = args.refresh_snapshots), normalize_cran_df),
+    'pypi' : (partial(get_pypi_df, snapshot_dir = args.snapshot_dir, refresh_snapshot = args.refresh_snapshots), normalize_pypi_df),
+    'github' : (partial(get_github_df, use_async = args.use_async, max_concurrency = args.max_concurrency, cache_file = args.github_cache_file, 
+                        **linking_cache_args), normalize_github_df),
+    'scicrunch' : (partial(get_scicrunch_df, num_workers = args.scicrunch_workers, cache_file = args.scicrunch_cache_file, **linking_cache_args), normalize_scicrunch_df),
+  }
+
+def link_source(linker, metadata_generation_fn, schema_normalization_fn, executor, output_format = 'csv'):
+  """
+  Links a source: generates its raw metadata df, normalizes it in executor and saves it to file
+
+  :param linker: DatabaseLinker of the source
+  :param metadata_generation_fn: function to generate the raw metadata df
+  :param schema_normalization_fn: function to normalize the raw metadata df to a common schema
+  :param executor: executor running schema_normalization_fn
+  :param output_format: format of the normalized file, 'csv' or 'parquet'
+
+  :return linker
+  """
+  linker.get_metadata_df(metadata_generation_fn)
+  linker.normalize_schema(schema_normalization_fn, executor)
+  linker.save_to_file(output_format)
+  return linker
+
+def print_timings(linkers, total_time):
+  """
+  Prints per-source timings
+
+  :param linkers: dict mapping source to its DatabaseLinker
+  :param total_time: wall-clock time of the whole run
+  """
+  steps = ['fetching', 'normalizing', 'saving']
+  print("=" * 30)
+  print('{:<15}'.format('source') + ''.join('{:>14}'.format(step) for step in steps))
+  for source, linker in linkers.items():
+    print('{:<15}'.format(source) + ''.join('{:>14}'.format("{:.3f}".format(linker.timings.get(step, float('nan')))) for step in steps))
+  print('Took', "{:.3f}".format(total_time), 's linking all sources')
+
+# Usage: python link_all_sources.py --generate-new
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Linking all sources ...')
+  parser.add_argument("--input-file", help="Input file", default = 'comm_IDs.tsv.gz', required = False)
+  parser.add_argument("--output-file", help="Master metadata file", default = '../data/metadata_files/metadata.csv', required = False)
+  parser.add_argument("--sources", help="Sources to link", nargs = '+', default = list(SOURCES.keys()), choices = list(SOURCES.keys()), required = False)
+  parser.add_argument("--min-freq", help="Minimum Mention Frequency", type = int, default = FREQ_THRESHOLD, required = False)
+  parser.add_argument("--top-k", help="Retrieve top_k mentions", type = int, default = -1, required = False)
+  parser.add_argument("--generate-new", help="True if generating new files from scratch", default = False, action = 'store_true', required = False)
+  parser.add_argument("--ID-start", help="ID mention start", type = str, required = False)
+  parser.add_argument("--ID-end", help="ID mention end", type = str, required = False)
+  parser.add_argument("--num-processes", help="Number of processes normalizing schemas", type = int, default = 4, required = False)
+  parser.add_argument("--snapshot-dir", help="Directory containing the registry snapshots", default = ROOT_DIR_SNAPSHOTS, required = False)
+  parser.add_argument("--refresh-snapshots", help="Fetch new snapshots of the registry indexes before linking", default = False, action = 'store_true', required = False)
+  parser.add_argument("--use-async", help="Query Github concurrently, across all tokens in GITHUB_TOKEN (comma-separated)", default = False, action = 'store_true', required = False)
+  parser.add_argument("--max-concurrency", help="Maximum number of concurrent Github requests (with --use-async)", type = int, default = 10, required = False)
+  parser.add_argument("--github-cache-file", help="SQLite file caching Github responses (with --use-async)", default = ROOT_DIR_INTERMEDIATE_FILES + 'github_responses.sqlite', required = False)
+  parser.add_argument("--scicrunch-workers", help="Number of threads querying SciCrunch concurrently", type = int, default = 1, required = False)
+  parser.add_argument("--scicrunch-cache-file", help="SQLite file caching SciCrunch responses", default = ROOT_DIR_INTERMEDIATE_FILES + 'scicrunch_responses.sqlite', required = False)
+  parser.add_argument("--linking-cache-file", help="SQLite file caching Github and SciCrunch linking results across runs; pass '' to disable", default = ROOT_DIR_INTERMEDIATE_FILES + 'linking_cache.sqlite', required = False)
+  parser.add_argument("--cache-ttl-days", help="Days after which cached results are queried again", type = float, default = LINKING_CACHE_TTL_DAYS, required = False)
+  parser.add_argument("--negative-cache-ttl-days", help="Days after which cached results without matches are queried again", type = float, default = LINKING_CACHE_NEGATIVE_TTL_DAYS, required = False)
+  parser.add_argument("--output-format", help="Format of the normalized files", default = 'csv', choices = OUTPUT_FORMATS, required = False)
+  parser.add_argument("--master-output-format", help="Format of the master metadata file", default = 'tsv', choices = MASTER_OUTPUT_FORMATS, required = False)
+  parser.add_argument("--partition-dir", help="If given, write the master metadata file partitioned by source under this directory", default = None, required = False)
+  args = parser.parse_args()
+  print(args)
+
+  t0 = time.time()
+  mentions = load_mentions('pmc-oa', file = ROOT_DIR_INPUT_FILES + args.input_file, freq_threshold = args.min_freq, top_num_entities = args.top_k,
+                           ID_start = args.ID_start, ID_end = args.ID_end)
+  mention2ID = get_mention2ID_series(retrieve_ID_map())
+  t1 = time.time()
+  print('Took', "{:.3f}".format(t1-t0), 's reading input_file and mention2ID')
+
+  linking_fns = get_linking_fns(args)
+  linkers = {}
+  for source in args.sources:
+    df_type, output_file, raw_filename = SOURCES[source]
+    linkers[source] = DatabaseLinker(args.input_file, output_file, args.min_freq, args.top_k, raw_filename, args.generate_new, df_type,
+                                     args.ID_start, args.ID_end, mentions = mentions, mention2ID = mention2ID)
+
+  with ProcessPoolExecutor(max_workers = args.num_processes) as process_executor, ThreadPoolExecutor(max_workers = len(linkers)) as thread_executor:
+    futures = {source : thread_executor.submit(link_source, linker, *linking_fns[source], process_executor, args.output_format) for source, linker in linkers.items()}
+    for source, future in futures.items():
+      future.result()
+
+  generate_metadata_file([linker.normalized_filename for linker in linkers.values()], args.output_file, args.master_output_format, args.partition_dir)
+  print('- Saved master metadata file to', args.partition_dir if args.partition_dir else args.output_file)
+  print_timings(linkers, time.time() - t0)
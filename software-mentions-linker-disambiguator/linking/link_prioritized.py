@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+"""Links software mentions to Github and SciCrunch most frequent first, within a request budget per source
+
+Usage:
+    python link_prioritized.py --input-file <input_file> --budget github=1800 scicrunch=3600 --hours 8
+
+Details:
+    Mentions are linked in decreasing order of frequency (number of pmids, as computed by load_mentions),
+    so that when the budget or the time runs out, the mentions linked so far cover as many mention occurrences as possible.
+    Each source spends its budget of requests per hour (--budget) evenly, at most a minute's worth of requests at once
+    (so any hour sees at most the budget plus a minute's worth); mentions answered from the linking cache don't count.
+    Leased batches larger than a minute's worth of requests are linked in smaller sub-batches.
+    Progress is checkpointed in the work queue (see link_queue.py) after every (sub-)batch: rerunning the command resumes where it stopped,
+    and pending mentions (including mentions added to the input file since) are scheduled according to their current frequency.
+    Prints the share of mention occurrences covered after every batch, and saves the results linked so far as the raw files of the sources
+    (e.g. metadata_files/raw/github_raw_df.csv), which the linkers normalize when run without --generate-new.
+
+Author:
+    Ana-Maria Istrate
+"""
+
+from utils_linker import *
+from utils_common import *
+from utils_http import *
+from work_queue import *
+from link_queue import QUEUE_SOURCES, get_batch_linker
+from github_linker import GITHUB_SEARCH_URL, GITHUB_SEARCH_REQUESTS_PER_MINUTE, GITHUB_RAW_COLUMNS
+from concurrent.futures import ThreadPoolExecutor
+
+# Default budget of each source, in requests per hour
+DEFAULT_BUDGETS = {
+  'github' : GITHUB_SEARCH_REQUESTS_PER_MINUTE * 60,
+  'scicrunch' : 3600,
+}
+
+class RequestBudget:
+  """
+  Limits the requests sent to a source to requests_per_hour, spread evenly over the hour: at most a minute's worth of requests
+  (max_requests) can be spent at once, so any hour sees at most requests_per_hour plus a minute's worth
+  """
+
+  def __init__(self, requests_per_hour):
+    """
+    :param requests_per_hour: number of requests allowed per hour
+    """
+    self.rate = requests_per_hour / 3600
+    self.max_requests = max(1, int(requests_per_hour / 60))
+    self.capacity = self.max_requests
+    self.level = self.capacity
+    self.updated = time.time()
+
+  def _refill(self):
+    now = time.time()
+    self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+    self.updated = now
+
+  def get_wait_time(self, num_requests):
+    """
+    :param num_requests: number of requests to send
+
+    :return seconds to wait until the budget allows num_requests
+    """
+    self._refill()
+    return max(0, (num_requests - self.level) / self.rate)
+
+  def spend(self, num_requests):
+    """
+    Waits until the budget allows num_requests, and spends them
+
+    :param num_requests: number of requests to send, at most max_requests
+    """
+    time.sleep(self.get_wait_time(num_requests))
+    self._refill()
+    self.level -= num_requests
+
+  def refund(self, num_requests):
+    """
+    Gives back requests that were spent but not sent, e.g. for mentions answered from a cache
+
+    :param num_requests: number of requests to give back
+    """
+    self.level = min(self.capacity, self.level + num_requests)
+
+def parse_budgets(budgets):
+  """
+  Parses budgets given on the command line
+
+  :param budgets: list of 'source=requests_per_hour' strings
+
+  :return dict mapping source to requests per hour, with DEFAULT_BUDGETS for sources without a budget
+  """
+  parsed = dict(DEFAULT_BUDGETS)
+  for budget in budgets:
+    source, requests_per_hour = budget.split('=')
+    parsed[source] = float(requests_per_hour)
+  return parsed
+
+def print_coverage(queue, source):
+  """
+  Prints the share of mentions, and of mention occurrences, linked to a source so far
+
+  :param queue: WorkQueue
+  :param source: source of the tasks
+  """
+  num_done, num_total, done_frequency, total_frequency = queue.get_progress(source)
+  print('-', source + ':', num_done, '/', num_total, 'mentions linked, covering', "{:.2f}".format(100 * done_frequency / max(total_frequency, 1)), '% of mention occurrences')
+
+def link_source_prioritized(source, args, requests_per_hour, deadline):
+  """
+  Links the pending mentions of a source, most frequent first, until they are all linked, or the deadline passes
+
+  :param source: 'github' or 'scicrunch'
+  :param args: command line arguments
+  :param requests_per_hour: budget of the source
+  :param deadline: time after which no new batch (or sub-batch) is started
+
+  :return number of mentions linked
+  """
+  queue = WorkQueue(args.queue_file)
+  link_batch, cleanup_fns = get_batch_linker(source, args)
+  linking_cache = link_batch.keywords.get('linking_cache')
+  budget = RequestBudget(requests_per_hour)
+  worker_id = get_worker_id()
+  num_linked = 0
+  out_of_time = False
+  while time.time() < deadline and not out_of_time:
+    mentions = queue.lease(source, worker_id, args.batch_size, args.lease_seconds)
+    if len(mentions) == 0:
+      break
+    # Batches are spent and linked a minute's worth of requests at a time, so a large batch doesn't burst past the budget
+    for start in range(0, len(mentions), budget.max_requests):
+      sub_batch = mentions[start:start + budget.max_requests]
+      wait = budget.get_wait_time(len(sub_batch))
+      if time.time() + wait > deadline:
+        queue.release(source, mentions[start:])
+        out_of_time = True
+        break
+      budget.spend(len(sub_batch))
+      num_hits = linking_cache.num_hits if linking_cache else 0
+      try:
+        records = link_batch(sub_batch)
+      except:
+        queue.release(source, mentions[start:])
+        raise
+      if linking_cache:
+        budget.refund(linking_cache.num_hits - num_hits)
+      queue.ack(source, dict(zip(sub_batch, records)))
+      num_linked += len(sub_batch)
+    print_coverage(queue, source)
+  for cleanup_fn in cleanup_fns:
+    cleanup_fn()
+  queue.close()
+  return num_linked
+
+# Usage: python link_prioritized.py --budget github=1800 --hours 8
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Linking mentions by frequency, within request budgets ...')
+  parser.add_argument("--input-file", help="Input file", default = 'comm_IDs.tsv.gz', required = False)
+  parser.add_argument("--sources", help="Sources to link", nargs = '+', default = list(QUEUE_SOURCES.keys()), choices = list(QUEUE_SOURCES.keys()), required = False)
+  parser.add_argument("--budget", help="Requests per hour of each source, as source=requests_per_hour", nargs = '+', default = [], required = False)
+  parser.add_argument("--hours", help="Stop starting new batches after this many hours", type = float, default = float('inf'), required = False)
+  parser.add_argument("--min-freq", help="Minimum Mention Frequency", type = int, default = FREQ_THRESHOLD, required = False)
+  parser.add_argument("--queue-file", help="SQLite file checkpointing progress (see link_queue.py)", default = ROOT_DIR_INTERMEDIATE_FILES + 'linking_queue.sqlite', required = False)
+  parser.add_argument("--batch-size", help="Number of mentions leased at a time (linked a minute's worth of the budget at a time)", type = int, default = CHUNK_SIZE, required = False)
+  parser.add_argument("--lease-seconds", help="Seconds after which a batch leased by a crashed run is linked again", type = int, default = DEFAULT_LEASE_SECONDS, required = False)
+  parser.add_argument("--use-async", help="Query Github concurrently, across all tokens in GITHUB_TOKEN", default = False, action = 'store_true', required = False)
+  parser.add_argument("--max-concurrency", help="Maximum number of concurrent Github requests (with --use-async)", type = int, default = 10, required = False)
+  parser.add_argument("--api-url", help="Github search API endpoint", default = GITHUB_SEARCH_URL, required = False)
+  parser.add_argument("--num-workers", help="Number of threads querying SciCrunch concurrently", type = int, default = 1, required = False)
+  parser.add_argument("--cache-file", help="SQLite file caching API responses", default = None, required = False)
+  parser.add_argument("--linking-cache-file", help="SQLite file caching linking results across runs; pass '' to disable", default = ROOT_DIR_INTERMEDIATE_FILES + 'linking_cache.sqlite', required = False)
+  parser.add_argument("--cache-ttl-days", help="Days after which cached results are queried again", type = float, default = LINKING_CACHE_TTL_DAYS, required = False)
+  parser.add_argument("--negative-cache-ttl-days", help="Days after which cached results without matches are queried again", type = float, default = LINKING_CACHE_NEGATIVE_TTL_DAYS, required = False)
+  args = parser.parse_args()
+  print(args)
+
+  t0 = time.time()
+  deadline = t0 + args.hours * 3600
+  budgets = parse_budgets(args.budget)
+  top_mentions_df, top_software_mentions, all_mentions_df, all_software_mentions = load_mentions('pmc-oa', file = ROOT_DIR_INPUT_FILES + args.input_file,
+    freq_threshold = args.min_freq, top_num_entities = -1, save_to_file = False)
+  queue = WorkQueue(args.queue_file)
+  for source in args.sources:
+    num_added = queue.enqueue(source, list(top_mentions_df['software']), list(top_mentions_df['num_pmids']))
+    print('- Scheduled', num_added, 'new mentions for', source + ', at', budgets[source], 'requests per hour')
+    print_coverage(queue, source)
+
+  with ThreadPoolExecutor(max_workers = len(args.sources)) as executor:
+    futures = {source : executor.submit(link_source_prioritized, source, args, budgets[source], deadline) for source in args.sources}
+    num_linked = {source : future.result() for source, future in futures.items()}
+
+  for source in args.sources:
+    raw_filename = ROOT_DIR_METADATA_RAW + QUEUE_SOURCES[source]
+    raw_df = queue.get_results_df(source, GITHUB_RAW_COLUMNS if source == 'github' else None)
+    raw_df.to_csv(raw_filename, index = False)
+    print('- Linked', num_linked[source], 'mentions to', source, 'in this run; saved', len(raw_df), 'records to', raw_filename)
+    print_coverage(queue, source)
+  queue.close()
+  print('Took', "{:.3f}".format(time.time()-t0), 's')
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+"""Links software mentions to Github and SciCrunch through a durable work queue, shared by any number of workers
+
+Usage:
+    python link_queue.py enqueue --source github --input-file <input_file>
+    python link_queue.py work --source github
+    python link_queue.py status --source github
+    python link_queue.py export --source github
+
+Details:
+    enqueue: adds the mentions of the input file to the queue (data/intermediate_files/linking_queue.sqlite by default), most frequent mentions first.
+             Mentions already in the queue are not added again, so the same queue can be extended with new input files;
+             pending ones are reprioritized by their frequency in the new input file.
+    work: leases batches of mentions, links them, and acks them with their results, until all mentions are done.
+          Start as many workers as needed, on one or more machines sharing the queue file.
+          Batches leased by a worker that crashed are handed to other workers once their lease expires (--lease-seconds):
+          workers that run out of pending mentions wait for the leases of other workers to be acked or to expire.
+    status: prints the number of pending, leased and done mentions.
+    export: saves the results of all done mentions as the raw file of the source (e.g. metadata_files/raw/github_raw_df.csv),
+            which the linker normalizes when run without --generate-new.
+
+Author:
+    Ana-Maria Istrate
+"""
+
+from utils_linker import *
+from utils_common import *
+from utils_http import *
+from work_queue import *
+from github_linker import GITHUB_SEARCH_URL, GITHUB_SEARCH_REQUESTS_PER_MINUTE, GITHUB_RAW_COLUMNS, get_github_tokens, link_github_mentions
+from scicrunch_linker import query_scicrunch_mentions
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+# Maximum seconds a worker waits between checks for expired leases, once no pending mention is left
+LEASE_POLL_SECONDS = 30
+
+# Sources that can be linked through the queue, with their raw filenames
+QUEUE_SOURCES = {
+  'github' : 'github_raw_df.csv',
+  'scicrunch' : 'scicrunch_raw_df.csv',
+}
+
+def get_batch_linker(source, args):
+  """
+  Returns a function linking a batch of mentions to a source, configured from the command line arguments
+
+  :param source: 'github' or 'scicrunch'
+  :param args: command line arguments
+
+  :return link_batch, cleanup_fns: function mapping a list of mentions to the list of raw records of each mention, and functions to call once done
+  """
+  cache = ResponseCache(args.cache_file) if args.cache_file else None
+  linking_cache = LinkingCache(args.linking_cache_file, args.cache_ttl_days, args.negative_cache_ttl_days) if args.linking_cache_file else None
+  cleanup_fns = [cache.close] if cache else []
+  if linking_cache:
+    cleanup_fns += [lambda: print('-', linking_cache.report()), linking_cache.close]
+  if source == 'github':
+    scheduler = TokenBucketScheduler(get_github_tokens(), GITHUB_SEARCH_REQUESTS_PER_MINUTE) if args.use_async else None
+    link_batch = partial(link_github_mentions, scheduler = scheduler, cache = cache, max_concurrency = args.max_concurrency, api_url = args.api_url, 
+                         linking_cache = linking_cache)
+    return link_batch, cleanup_fns
+  executor = ThreadPoolExecutor(max_workers = args.num_workers) if args.num_workers > 1 else None
+  session = get_session(pool_size = max(args.num_workers, 1))
+  link_batch = partial(query_scicrunch_mentions, executor = executor, session = session, cache = cache, linking_cache = linking_cache)
+  return link_batch, cleanup_fns + [session.close] + ([executor.shutdown] if executor else [])
+
+def run_worker(queue, source, link_batch, batch_size, lease_seconds):
+  """
+  Leases, links and acks batches of mentions until all mentions are done.
+  Once no mention is pending, waits while other workers hold leases: their tasks are acked, or requeued and linked here once their lease expires.
+
+  :param queue: WorkQueue
+  :param source: source to link the mentions to
+  :param link_batch: function mapping a list of mentions to the list of raw records of each mention
+  :param batch_size: number of mentions per batch
+  :param lease_seconds: seconds after which a leased batch is handed to another worker
+
+  :return number of mentions linked by this worker
+  """
+  worker_id = get_worker_id()
+  num_linked = 0
+  while True:
+    mentions = queue.lease(source, worker_id, batch_size, lease_seconds)
+    if len(mentions) == 0:
+      next_lease_expiry = queue.get_next_lease_expiry(source)
+      if next_lease_expiry is None:
+        break
+      time.sleep(min(LEASE_POLL_SECONDS, max(0, next_lease_expiry - time.time())))
+      num_requeued = queue.requeue_expired(source)
+      if num_requeued > 0:
+        print('Worker', worker_id, 'requeued', num_requeued, 'mentions whose lease expired')
+      continue
+    t0 = time.time()
+    try:
+      records = link_batch(mentions)
+    except:
+      queue.release(source, mentions)
+      raise
+    queue.ack(source, dict(zip(mentions, records)))
+    num_linked += len(mentions)
+    counts = queue.counts(source)
+    print('Worker', worker_id, 'linked', len(mentions), 'mentions in', "{:.3f}".format(time.time()-t0), 's;', counts['done'], 'done,', counts['pending'], 'pending,', counts['leased'], 'leased')
+  return num_linked
+
+# Usage: python link_queue.py work --source github
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Linking mentions through a work queue ...')
+  parser.add_argument("command", help="Command to run", choices = ['enqueue', 'work', 'status', 'export'])
+  parser.add_argument("--source", help="Source to link mentions to", choices = list(QUEUE_SOURCES.keys()), required = True)
+  parser.add_argument("--queue-file", help="SQLite file backing the work queue", default = ROOT_DIR_INTERMEDIATE_FILES + 'linking_queue.sqlite', required = False)
+  parser.add_argument("--input-file", help="Input file (enqueue)", default = 'comm_IDs.tsv.gz', required = False)
+  parser.add_argument("--min-freq", help="Minimum Mention Frequency (enqueue)", type = int, default = FREQ_THRESHOLD, required = False)
+  parser.add_argument("--top-k", help="Enqueue top_k mentions (enqueue)", type = int, default = -1, required = False)
+  parser.add_argument("--batch-size", help="Number of mentions leased at a time (work)", type = int, default = CHUNK_SIZE, required = False)
+  parser.add_argument("--lease-seconds", help="Seconds after which a leased batch is handed to another worker (work)", type = int, default = DEFAULT_LEASE_SECONDS, required = False)
+  parser.add_argument("--use-async", help="Query Github concurrently, across all tokens in GITHUB_TOKEN (work, github)", default = False, action = 'store_true', required = False)
+  parser.add_argument("--max-concurrency", help="Maximum number of concurrent Github requests (work, github)", type = int, default = 10, required = False)
+  parser.add_argument("--api-url", help="Github search API endpoint (work, github)", default = GITHUB_SEARCH_URL, required = False)
+  parser.add_argument("--num-workers", help="Number of threads querying SciCrunch concurrently (work, scicrunch)", type = int, default = 1, required = False)
+  parser.add_argument("--cache-file", help="SQLite file caching API responses (work)", default = None, required = False)
+  parser.add_argument("--linking-cache-file", help="SQLite file caching linking results across runs (work); pass '' to disable", default = ROOT_DIR_INTERMEDIATE_FILES + 'linking_cache.sqlite', required = False)
+  parser.add_argument("--cache-ttl-days", help="Days after which cached results are queried again (work)", type = float, default = LINKING_CACHE_TTL_DAYS, required = False)
+  parser.add_argument("--negative-cache-ttl-days", help="Days after which cached results without matches are queried again (work)", type = float, default = LINKING_CACHE_NEGATIVE_TTL_DAYS, required = False)
+  parser.add_argument("--raw-filename", help="Raw output file (export); defaults to the raw file of the source", default = None, required = False)
+  args = parser.parse_args()
+  print(args)
+
+  queue = WorkQueue(args.queue_file)
+  if args.command == 'enqueue':
+    top_mentions_df, top_software_mentions, all_mentions_df, all_software_mentions = load_mentions('pmc-oa', file = ROOT_DIR_INPUT_FILES + args.input_file,
+      freq_threshold = args.min_freq, top_num_entities = args.top_k, save_to_file = False)
+    num_added = queue.enqueue(args.source, list(top_mentions_df['software']), list(top_mentions_df['num_pmids']))
+    print('- Added', num_added, 'mentions to the', args.source, 'queue in', args.queue_file)
+  elif args.command == 'work':
+    link_batch, cleanup_fns = get_batch_linker(args.source, args)
+    num_linked = run_worker(queue, args.source, link_batch, args.batch_size, args.lease_seconds)
+    for cleanup_fn in cleanup_fns:
+      cleanup_fn()
+    print('- Linked', num_linked, 'mentions; all mentions are linked')
+  elif args.command == 'export':
+    raw_filename = ROOT_DIR_METADATA_RAW + (args.raw_filename if args.raw_filename else QUEUE_SOURCES[args.source])
+    counts = queue.counts(args.source)
+    if counts['pending'] + counts['leased'] > 0:
+      print('- Warning:', counts['pending'] + counts['leased'], 'mentions are not linked yet')
+    raw_df = queue.get_results_df(args.source, GITHUB_RAW_COLUMNS if args.source == 'github' else None)
+    raw_df.to_csv(raw_filename, index = False)
+    print('- Saved', len(raw_df), 'records from', counts['done'], 'linked mentions to', raw_filename)
+  print(args.source, 'queue:', queue.counts(args.source))
+  queue.close()
@@ -7,6 +7,7 @@ Usage:
 
 Details:
     The linker queries the PyPI repository for exact matches (case dependent) of mentions in the input file.
+    Mentions are linked against a local snapshot of the PyPI index, fetched once by registry_snapshots.py (--refresh-snapshot fetches a new one).
     Parses individual PyPI project pages to extract: pypi package, pypi_url
     Saves raw file under metadata_files/raw/pypi_raw_df.csv
     Saves normalized file (to a common schema among all metadata files) under metadata_files/normalized/pypi_df.csv
@@ -18,29 +19,32 @@ Author:
 from utils_linker import * 
 from utils_common import *
 from schema_normalizations import *
+from registry_snapshots import *
+from functools import partial
 
 # Search pypi
-def build_df(packages, software_mentions):
+def build_df(snapshot_df, software_mentions):
   """ 
-  Filters list of PyPI packages and metadata for a given array of software mentions
+  Filters the snapshot of the PyPI index for a given array of software mentions
 
-  :param packages: software packages available in the PyPI repository
+  :param snapshot_df: snapshot of the PyPI index (see registry_snapshots.py)
   :param software_mentions: software mentions we want to link
 
-  :return: filtered df containing all the above metadata
+  :return: filtered df containing the pypi package and pypi_url of linked mentions
   """ 
-  pypi_df = pd.DataFrame({'pypi package' : packages})
-  pypi_df['pypi_url'] = pypi_df['pypi package'].apply(lambda x: "https://pypi.org/project/" + x)
-  pypi_df = pypi_df[pypi_df['pypi package'].isin(software_mentions)]
+  linked_df = link_snapshot(snapshot_df, software_mentions)
+  pypi_df = pd.DataFrame({'pypi package' : linked_df['name'], 'pypi_url' : linked_df['url']})
   return pypi_df
 
-def get_pypi_df(software_mentions, filename = None, save_new = True):
+def get_pypi_df(software_mentions, filename = None, save_new = True, snapshot_dir = ROOT_DIR_SNAPSHOTS, refresh_snapshot = False):
   """ 
   Retrieves links and metadata from the PyPI repository for a list of software mentions. 
 
   :param software_mentions: list of software mentions to query
   :param filename: where the raw (un-normalized) file will be saved
   :param save_new: True if to create the file from scratch
+  :param snapshot_dir: directory containing the registry snapshots
+  :param refresh_snapshot: if True, fetch a new snapshot of the PyPI index
   
   :return: linked (raw) dataframe
   """ 
@@ -52,37 +56,11 @@ def get_pypi_df(software_mentions, filename = None, save_new = True):
     raise Exception('- Sorry, the file', filename, 'does not exist on file. Please use --generate-new t generate first.')
   else:
     print('- Generating Python dataframe ... ')
-    pypi_url = "https://pypi.org/simple/"
-    pypi_html = requests.get(url = pypi_url).text
-    soup = BeautifulSoup(pypi_html, 'html.parser')
-    packages = []
-    num_processed = 0
-    num_processed_total = 0
-    total_entries = soup.find_all('a')
-    num_total = len(total_entries)
-    final_dfs = []
-    header = True
-    mode = 'w'
-    for a in soup.find_all('a'):
-      packages.append(a.text)
-      num_processed += 1
-      num_processed_total += 1
-      if num_processed == CHUNK_SIZE:
-        pypi_df = build_df(packages, software_mentions)
-        if len(pypi_df) > 0:
-          pypi_df.to_csv(filename, index = False, header = header, mode = mode)
-          header = False
-          mode = 'a'
-          print('Processed', num_processed_total, '/', num_total, 'saving', len(pypi_df), 'to', filename)
-          final_dfs.append(pypi_df)
-        num_processed = 0
-        packages = []
-    pypi_df = build_df(packages, software_mentions)
-    if len(pypi_df) > 0:
-      pypi_df.to_csv(filename, index = False, header = header, mode = mode)
-      print('Processed', num_processed_total, '/', num_total, 'saving', len(pypi_df), 'to', filename)
-      final_dfs.append(pypi_df)
-    return pd.concat(final_dfs)
+    snapshot_df = load_snapshot('pypi', snapshot_dir, refresh_snapshot)
+    pypi_df = build_df(snapshot_df, software_mentions)
+    pypi_df.to_csv(filename, index = False)
+    print('Processed', len(snapshot_df), 'packages, saving', len(pypi_df), 'to', filename)
+    return pypi_df
 
 # Usage: python pypi_linker.py --generate-new
 if __name__ == '__main__':
@@ -95,11 +73,14 @@ if __name__ == '__main__':
   parser.add_argument("--generate-new", help="True if generating a new file from scratch", default = False, action = 'store_true', required = False)
   parser.add_argument("--ID-start", help="ID mention start", type = str, required = False)
   parser.add_argument("--ID-end", help="ID mention end", type = str, required = False)
+  parser.add_argument("--snapshot-dir", help="Directory containing the registry snapshots", default = ROOT_DIR_SNAPSHOTS, required = False)
+  parser.add_argument("--refresh-snapshot", help="Fetch a new snapshot of the index before linking", default = False, action = 'store_true', required = False)
+  parser.add_argument("--output-format", help="Format of the normalized file", default = 'csv', choices = OUTPUT_FORMATS, required = False)
   args = parser.parse_args()
   print(args)
 
   pypi_linker = DatabaseLinker(args.input_file, args.output_file, args.min_freq, args.top_k, 
                       args.raw_filename, args.generate_new, 'pypi_df', args.ID_start, args.ID_end)
-  pypi_linker.get_metadata_df(get_pypi_df)
+  pypi_linker.get_metadata_df(partial(get_pypi_df, snapshot_dir = args.snapshot_dir, refresh_snapshot = args.refresh_snapshot))
   pypi_linker.normalize_schema(normalize_pypi_df)
-  pypi_linker.save_to_file()
+  pypi_linker.save_to_file(args.output_format)
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+
+"""Maintains local snapshots of the PyPI, CRAN and Bioconductor package indexes
+
+Usage:
+    python registry_snapshots.py --registries pypi cran bioconductor
+
+Details:
+    Each registry index is streamed and parsed once, by tokenizing the raw bytes with regexes instead of building a DOM, so memory stays 
+    constant regardless of the size of the index. It is saved under data/registry_snapshots/ as <registry>.tsv.gz,
+    with fields ['name', 'url', 'title', 'maintainer'], next to a <registry>.json file recording the snapshot format version,
+    the index URL and the time it was fetched.
+    The PyPI, CRAN and Bioconductor linkers link mentions against these snapshots with a single hash join,
+    instead of downloading and parsing the indexes on every run. Running this script refreshes the snapshots.
+    A small fixture snapshot under linking/fixtures/registry_snapshots/ makes the linkers runnable offline (--snapshot-dir).
+
+Author:
+    Ana-Maria Istrate
+"""
+
+import argparse
+import csv
+import gzip
+import html
+import json
+import os
+import re
+import time
+import pandas as pd
+import requests
+
+# Bump when the layout of snapshot files changes; snapshots in an older format are fetched again
+SNAPSHOT_FORMAT_VERSION = 1
+
+# Root directory for registry snapshots
+ROOT_DIR_SNAPSHOTS = '../data/registry_snapshots/'
+
+# Fields of a snapshot
+SNAPSHOT_FIELDS = ['name', 'url', 'title', 'maintainer']
+
+# Index pages of the registries
+REGISTRY_URLS = {
+  'pypi' : 'https://pypi.org/simple/',
+  'cran' : 'https://cran.r-project.org/web/packages/available_packages_by_name.html',
+  'bioconductor' : 'https://www.bioconductor.org/packages/release/bioc/',
+}
+
+# Size of the chunks the index pages are streamed in
+STREAM_CHUNK_SIZE = 1 << 16
+
+# Seconds to wait for the registry to respond (to connect, or between two chunks of the index)
+SNAPSHOT_TIMEOUT = 60
+
+# Regexes tokenizing the raw bytes of the index pages
+ANCHOR_REGEX = re.compile(rb'<a\b([^>]*)>(.*?)</a>', re.IGNORECASE | re.DOTALL)
+HREF_REGEX = re.compile(rb'href\s*=\s*["\']([^"\']*)["\']', re.IGNORECASE)
+ROW_REGEX = re.compile(rb'<tr\b[^>]*>(.*?)</tr>', re.IGNORECASE | re.DOTALL)
+CELL_REGEX = re.compile(rb'<td\b[^>]*>(.*?)</td>', re.IGNORECASE | re.DOTALL)
+TAG_REGEX = re.compile(rb'<[^>]*>')
+
+def get_text(fragment):
+  """
+  Extracts the text of an html fragment, i.e. strips its tags and unescapes its character references
+
+  :param fragment: html fragment (bytes)
+
+  :return text
+  """
+  return html.unescape(TAG_REGEX.sub(b'', fragment).decode('utf-8', errors = 'replace'))
+
+def iter_complete_fragments(chunks, end_tag):
+  """
+  Buffers a stream of byte chunks, and yields the longest prefix of the buffer ending with end_tag, so that 
+  no element closed by end_tag is split across yielded fragments. Only the unfinished tail of the page is kept in memory.
+
+  :param chunks: iterable of bytes, e.g. response.iter_content()
+  :param end_tag: closing tag, e.g. b'</tr>'
+
+  :return iterator over bytes
+  """
+  buffer = b''
+  for chunk in chunks:
+    buffer += chunk
+    end = buffer.lower().rfind(end_tag)
+    if end == -1:
+      continue
+    end += len(end_tag)
+    yield buffer[:end]
+    buffer = buffer[end:]
+
+def iter_anchors(chunks):
+  """
+  Streams the anchors of an html page
+
+  :param chunks: iterable of bytes
+
+  :return iterator over (text, href) tuples
+  """
+  for fragment in iter_complete_fragments(chunks, b'</a>'):
+    for match in ANCHOR_REGEX.finditer(fragment):
+      href = HREF_REGEX.search(match.group(1))
+      yield get_text(match.group(2)), html.unescape(href.group(1).decode('utf-8', errors = 'replace')) if href else ''
+
+def iter_table_rows(chunks):
+  """
+  Streams the rows of the tables of an html page
+
+  :param chunks: iterable of bytes
+
+  :return iterator over rows, each a list of cells; a cell is a (text, first anchor text, first anchor href) tuple, 
+  with None as anchor text and href for cells without anchors
+  """
+  for fragment in iter_complete_fragments(chunks, b'</tr>'):
+    for row in ROW_REGEX.finditer(fragment):
+      cells = []
+      for cell in CELL_REGEX.finditer(row.group(1)):
+        anchors = list(iter_anchors([cell.group(1)]))
+        anchor_text, href = anchors[0] if anchors else (None, None)
+        cells.append((get_text(cell.group(1)), anchor_text, href))
+      yield cells
+
+def parse_pypi_index(chunks):
+  """
+  Parses the PyPI index
+
+  :param chunks: iterable of bytes of the PyPI index
+
+  :return iterator over (name, url, title, maintainer) tuples
+  """
+  for name, _ in iter_anchors(chunks):
+    yield name, "https://pypi.org/project/" + name, '', ''
+
+def parse_cran_index(chunks):
+  """
+  Parses the CRAN index
+
+  :param chunks: iterable of bytes of the CRAN index
+
+  :return iterator over (name, url, title, maintainer) tuples
+  """
+  for cells in iter_table_rows(chunks):
+    if len(cells) > 1 and cells[0][2] is not None:
+      yield cells[0][1], 'https://cran.r-project.org/' + cells[0][2][6:], cells[1][0], ''
+
+def parse_bioconductor_index(chunks):
+  """
+  Parses the Bioconductor index
+
+  :param chunks: iterable of bytes of the Bioconductor index
+
+  :return iterator over (name, url, title, maintainer) tuples
+  """
+  for cells in iter_table_rows(chunks):
+    if len(cells) > 2 and cells[0][2] is not None:
+      yield cells[0][1], 'https://www.bioconductor.org/packages/release/bioc/' + cells[0][2], cells[2][0], cells[1][0]
+
+INDEX_PARSERS = {
+  'pypi' : parse_pypi_index,
+  'cran' : parse_cran_index,
+  'bioconductor' : parse_bioconductor_index,
+}
+
+def get_snapshot_filenames(registry, snapshot_dir = ROOT_DIR_SNAPSHOTS):
+  """
+  Returns the location of the snapshot of a registry
+
+  :param registry: 'pypi', 'cran' or 'bioconductor'
+  :param snapshot_dir: directory containing the snapshots
+
+  :return snapshot file, metadata file
+  """
+  return os.path.join(snapshot_dir, registry + '.tsv.gz'), os.path.join(snapshot_dir, registry + '.json')
+
+def fetch_snapshot(registry, snapshot_dir = ROOT_DIR_SNAPSHOTS):
+  """
+  Downloads and parses the index of a registry, and saves it as a snapshot.
+  The previous snapshot is only replaced once the whole index was parsed: a failed request, or an index without packages
+  (e.g. an error or maintenance page), raises an error and leaves the previous snapshot as is.
+
+  :param registry: 'pypi', 'cran' or 'bioconductor'
+  :param snapshot_dir: directory to save the snapshot to
+
+  :return snapshot df
+  """
+  url = REGISTRY_URLS[registry]
+  print('- Fetching the', registry, 'index from', url)
+  t1 = time.time()
+  if not os.path.exists(snapshot_dir):
+    os.makedirs(snapshot_dir)
+  snapshot_file, metadata_file = get_snapshot_filenames(registry, snapshot_dir)
+
+  # Index entries are streamed from the response straight to a temporary file, which replaces the snapshot once complete
+  num_packages = 0
+  seen = set()
+  try:
+    with requests.get(url = url, stream = True, timeout = SNAPSHOT_TIMEOUT) as response:
+      response.raise_for_status()
+      with gzip.open(snapshot_file + '.tmp', 'wt', newline = '') as f:
+        writer = csv.writer(f, delimiter = '\t')
+        writer.writerow(SNAPSHOT_FIELDS)
+        for entry in INDEX_PARSERS[registry](response.iter_content(chunk_size = STREAM_CHUNK_SIZE)):
+          if entry[0] not in seen:
+            seen.add(entry[0])
+            writer.writerow(entry)
+            num_packages += 1
+    if num_packages == 0:
+      raise ValueError('No packages found in the ' + registry + ' index at ' + url + '; keeping the previous snapshot')
+    os.replace(snapshot_file + '.tmp', snapshot_file)
+  finally:
+    if os.path.exists(snapshot_file + '.tmp'):
+      os.remove(snapshot_file + '.tmp')
+  t2 = time.time()
+  print('Took', "{:.3f}".format(t2-t1), 's fetching', num_packages, registry, 'packages')
+
+  metadata = {'registry' : registry, 'format_version' : SNAPSHOT_FORMAT_VERSION, 'url' : url,
+              'fetched_at' : time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()), 'num_packages' : num_packages}
+  with open(metadata_file, 'w') as f:
+    json.dump(metadata, f, indent = 2)
+  print('- Saved', registry, 'snapshot to', snapshot_file)
+  return read_snapshot_file(snapshot_file)
+
+def read_snapshot_file(snapshot_file):
+  """
+  Reads a snapshot file
+
+  :param snapshot_file: snapshot file (<registry>.tsv.gz)
+
+  :return snapshot df
+  """
+  return pd.read_csv(snapshot_file, sep = '\t', dtype = str, keep_default_na = False, compression = 'gzip')
+
+def load_snapshot(registry, snapshot_dir = ROOT_DIR_SNAPSHOTS, refresh = False):
+  """
+  Loads the snapshot of a registry. The snapshot is fetched if it doesn't exist, if it is in an older format, or if refresh is True.
+
+  :param registry: 'pypi', 'cran' or 'bioconductor'
+  :param snapshot_dir: directory containing the snapshots
+  :param refresh: if True, fetch a new snapshot
+
+  :return snapshot df
+  """
+  snapshot_file, metadata_file = get_snapshot_filenames(registry, snapshot_dir)
+  if not refresh and os.path.exists(snapshot_file) and os.path.exists(metadata_file):
+    with open(metadata_file) as f:
+      metadata = json.load(f)
+    if metadata.get('format_version') == SNAPSHOT_FORMAT_VERSION:
+      print('- Using', registry, 'snapshot from', metadata['fetched_at'], '(' + snapshot_file + ')')
+      return read_snapshot_file(snapshot_file)
+    print('-', registry, 'snapshot is in an older format; fetching a new one')
+  return fetch_snapshot(registry, snapshot_dir)
+
+def link_snapshot(snapshot_df, software_mentions, lowercase_names = False):
+  """
+  Links software mentions to the packages of a snapshot (exact matches), with a single hash join
+
+  :param snapshot_df: snapshot df
+  :param software_mentions: software mentions we want to link
+  :param lowercase_names: if True, match lowercased package names
+
+  :return rows of snapshot_df matching a software mention, with 'name' lowercased if lowercase_names
+  """
+  snapshot_df = snapshot_df.copy()
+  if lowercase_names:
+    snapshot_df['name'] = snapshot_df['name'].str.lower()
+  mentions_df = pd.DataFrame({'name' : pd.unique(pd.Series(software_mentions, dtype = object).dropna())})
+  return snapshot_df.merge(mentions_df, on = 'name', how = 'inner', sort = False)
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description = 'Refreshing registry snapshots ...')
+  parser.add_argument("--registries", help="Registries to refresh", nargs = '+', default = list(REGISTRY_URLS.keys()), choices = list(REGISTRY_URLS.keys()), required = False)
+  parser.add_argument("--snapshot-dir", help="Directory containing the snapshots", default = ROOT_DIR_SNAPSHOTS, required = False)
+  args = parser.parse_args()
+  print(args)
+
+  for registry in args.registries:
+    fetch_snapshot(registry, args.snapshot_dir)
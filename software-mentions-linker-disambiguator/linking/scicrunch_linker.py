@@ -22,18 +22,28 @@ Author:
 
 from utils_linker import *
 from utils_common import *
+from utils_http import *
 import xml.etree.ElementTree as ET
 from schema_normalizations import *
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import os
 
-def scicrunch_endpoint(url_stem, query):
+# SciCrunch API endpoint for software resources
+SCICRUNCH_ENDPOINT = "https://scicrunch.org/api/1/dataservices/federation/data/nlx_144509-1?q="
+
+# Seconds to wait for the SciCrunch API before giving up on a query
+SCICRUNCH_TIMEOUT = 60
+
+def scicrunch_endpoint(url_stem, query, session = None):
   """ 
   Query SciCrunch API endpoint for a particular query.
 
   :param url_stem: the SciCrunch URL endpoint to access
   :param query: query added to the url_stem
+  :param session: requests session to send the request through; a new connection is opened if None
 
-  :return response
+  :return response; None if the query failed (error status, timeout or connection error)
   """ 
   url = url_stem + query
   access_token = os.getenv("SCICRUNCH_TOKEN") 
@@ -44,23 +54,24 @@ def scicrunch_endpoint(url_stem, query):
     'searchAcronyms' : 'true',
     'key' : access_token
   }
-  response = requests.get(url = url, params = params)
+  try:
+    response = (session if session else requests).get(url = url, params = params, timeout = SCICRUNCH_TIMEOUT)
+  except requests.RequestException:
+    return None
   if response.status_code == 200:
     return response.content
   else:
     return None
 
-def query_scicrunch_individual_mention(query):
+def parse_scicrunch_response(endpoint, query):
   """ 
-  Query the SciCrunch API endpoint for a particular query and parse the output to extract metadata.
+  Parses the XML output of the SciCrunch API endpoint for a particular query to extract metadata.
 
+  :param endpoint: raw response of the SciCrunch API endpoint (None if the query failed)
   :param query: query (e.g. software_mention)
 
   :return list of matches, where each match is a dict containing metadata about a hit for the query using the SciCrunch API
   """ 
-  t1 = time.time()
-  endpoint = scicrunch_endpoint("https://scicrunch.org/api/1/dataservices/federation/data/nlx_144509-1?q=", query)
-  t2 = time.time()
   if endpoint != None:
     try:
       root = ET.fromstring(endpoint)
@@ -91,13 +102,70 @@ def query_scicrunch_individual_mention(query):
   else:
     return []
 
-def get_scicrunch_df(queries, filename = None, save_new = True):
+def query_scicrunch_individual_mention(query):
+  """ 
+  Query the SciCrunch API endpoint for a particular query and parse the output to extract metadata.
+
+  :param query: query (e.g. software_mention)
+
+  :return list of matches, where each match is a dict containing metadata about a hit for the query using the SciCrunch API
+  """ 
+  endpoint = scicrunch_endpoint(SCICRUNCH_ENDPOINT, query)
+  return parse_scicrunch_response(endpoint, query)
+
+def query_scicrunch_mentions(queries, executor = None, session = None, cache = None, linking_cache = None):
+  """ 
+  Query the SciCrunch API endpoint for a list of queries and parse the outputs to extract metadata.
+  If an executor is given, requests are sent concurrently by its threads, through a shared keep-alive session;
+  responses are cached and parsed in the calling thread, as they come in, so that parsing doesn't stall the network threads.
+
+  :param queries: list of queries (e.g. software_mentions)
+  :param executor: ThreadPoolExecutor sending the requests; requests are sent serially if None
+  :param session: requests session (see get_session)
+  :param cache: ResponseCache for SciCrunch responses, or None
+  :param linking_cache: LinkingCache of results from previous runs; queries with a fresh cached result aren't sent, 
+  and cached responses older than its TTL are ignored
+
+  :return list containing the list of matches for each query, in the order of queries
+  """ 
+  linked = linking_cache.get_many('scicrunch', queries) if linking_cache else {}
+  cached = {}
+  if cache:
+    for query in queries:
+      cached_response = cache.get(SCICRUNCH_ENDPOINT, query)
+      if cached_response and query not in linked and (not linking_cache or time.time() - cached_response['fetched_at'] < linking_cache.ttl):
+        cached[query] = cached_response['body']
+  to_fetch = [query for query in queries if query not in cached and query not in linked]
+  fetch = partial(scicrunch_endpoint, SCICRUNCH_ENDPOINT, session = session)
+  if executor:
+    responses = executor.map(fetch, to_fetch)
+  else:
+    responses = map(fetch, to_fetch)
+  for query, endpoint in zip(to_fetch, responses):
+    cached[query] = endpoint
+    if cache and endpoint is not None:
+      cache.put(SCICRUNCH_ENDPOINT, query, endpoint)
+  parsed = {query : parse_scicrunch_response(endpoint, query) for query, endpoint in cached.items()}
+  if linking_cache:
+    # failed queries (None responses) aren't cached
+    linking_cache.put_many('scicrunch', {query : matches for query, matches in parsed.items() if cached[query] is not None})
+  # cached matches may come from another spelling of the same normalized query
+  parsed.update({query : [dict(match, software_name = query) for match in matches] for query, matches in linked.items()})
+  return [parsed[query] for query in queries]
+
+def get_scicrunch_df(queries, filename = None, save_new = True, num_workers = 1, cache_file = None, 
+                     linking_cache_file = None, cache_ttl_days = LINKING_CACHE_TTL_DAYS, negative_cache_ttl_days = LINKING_CACHE_NEGATIVE_TTL_DAYS):
   """ 
   Retrieves links and metadata from the SciCrunch repository for a list of software mentions. 
 
   :param software_mentions: list of software mentions to query
   :param filename: where the raw (un-normalized) file will be saved
   :param save_new: True if to create the file from scratch
+  :param num_workers: number of threads querying SciCrunch concurrently
+  :param cache_file: SQLite file caching SciCrunch responses; no caching if None
+  :param linking_cache_file: SQLite file caching linking results across runs; no caching if None
+  :param cache_ttl_days: days after which cached results are queried again
+  :param negative_cache_ttl_days: days after which cached results without matches are queried again
   
   :return: linked (raw) dataframe
   """ 
@@ -109,38 +177,26 @@ def get_scicrunch_df(queries, filename = None, save_new = True):
     raise Exception('- Sorry, the file', filename, 'does not exist on file. Please use --generate-new t generate first.')
   else:
     print('- Generating scicrunch dataframe ... ')
-    all_matches = []
-    num_processed = 0
-    num_processed_total = 0
     num_total = len(queries)
-    header = True
-    mode = 'w'
-    final_dfs = []
-    for i, query in enumerate(queries):
-      num_processed += 1
-      num_processed_total += 1
-      matches = query_scicrunch_individual_mention(query)
-      all_matches.extend(matches)
-      if num_processed == CHUNK_SIZE:
-        df = pd.DataFrame(columns=all_matches[0].keys())
-        for match in all_matches:
-          df = df.append(match, ignore_index=True)
-        if len(df) > 0:
-          df.to_csv(filename, index = False, header = header, mode = mode)
-          header = False
-          print('Processed', num_processed_total, '/', num_total, 'saving', len(df), 'to', filename)
-          final_dfs.append(df)
-          mode = 'a'
-        num_processed = 0
-        all_matches = []
-    if len(all_matches) > 0:
-      df = pd.DataFrame(columns=all_matches[0].keys())
-      for match in all_matches:
-        df = df.append(match, ignore_index=True)
-      df.to_csv(filename, index = False, header = header, mode = mode)
-      print('Processed', num_processed_total, '/', num_total, 'saving', len(df), 'to', filename)
-      final_dfs.append(df)
-    return pd.concat(final_dfs)
+    writer = ChunkedCSVWriter(filename)
+    executor = ThreadPoolExecutor(max_workers = num_workers) if num_workers > 1 else None
+    session = get_session(pool_size = max(num_workers, 1))
+    cache = ResponseCache(cache_file) if cache_file else None
+    linking_cache = LinkingCache(linking_cache_file, cache_ttl_days, negative_cache_ttl_days) if linking_cache_file else None
+    for chunk_start in range(0, num_total, CHUNK_SIZE):
+      chunk = queries[chunk_start:chunk_start + CHUNK_SIZE]
+      for matches in query_scicrunch_mentions(chunk, executor, session, cache, linking_cache):
+        writer.extend(matches)
+      writer.flush(chunk_start + len(chunk), num_total)
+    if executor:
+      executor.shutdown()
+    session.close()
+    if cache:
+      cache.close()
+    if linking_cache:
+      print('-', linking_cache.report())
+      linking_cache.close()
+    return writer.close()
 
 # Usage: python scicrunch_linker.py --generate-new
 if __name__ == '__main__':
@@ -153,12 +209,19 @@ if __name__ == '__main__':
   parser.add_argument("--generate-new", help="True if generating a new file from scratch", default = False, action = 'store_true', required = False)
   parser.add_argument("--ID-start", help="ID mention start", type = str, required = False)
   parser.add_argument("--ID-end", help="ID mention end", type = str, required = False)
+  parser.add_argument("--num-workers", help="Number of threads querying SciCrunch concurrently", type = int, default = 1, required = False)
+  parser.add_argument("--cache-file", help="SQLite file caching SciCrunch responses", default = ROOT_DIR_INTERMEDIATE_FILES + 'scicrunch_responses.sqlite', required = False)
+  parser.add_argument("--linking-cache-file", help="SQLite file caching linking results across runs; pass '' to disable", default = ROOT_DIR_INTERMEDIATE_FILES + 'linking_cache.sqlite', required = False)
+  parser.add_argument("--cache-ttl-days", help="Days after which cached results are queried again", type = float, default = LINKING_CACHE_TTL_DAYS, required = False)
+  parser.add_argument("--negative-cache-ttl-days", help="Days after which cached results without matches are queried again", type = float, default = LINKING_CACHE_NEGATIVE_TTL_DAYS, required = False)
+  parser.add_argument("--output-format", help="Format of the normalized file", default = 'csv', choices = OUTPUT_FORMATS, required = False)
   args = parser.parse_args()
   print(args)
 
   scicrunch_linker = DatabaseLinker(args.input_file, args.output_file, args.min_freq, args.top_k, 
                       args.raw_filename, args.generate_new, 'scicrunch_df', args.ID_start, args.ID_end)
-  scicrunch_linker.get_metadata_df(get_scicrunch_df)
+  scicrunch_linker.get_metadata_df(partial(get_scicrunch_df, num_workers = args.num_workers, cache_file = args.cache_file, 
+                      linking_cache_file = args.linking_cache_file, cache_ttl_days = args.cache_ttl_days, negative_cache_ttl_days = args.negative_cache_ttl_days))
   print(scicrunch_linker.raw_df.columns)
   scicrunch_linker.normalize_schema(normalize_scicrunch_df)
-  scicrunch_linker.save_to_file()
+  scicrunch_linker.save_to_file(args.output_format)
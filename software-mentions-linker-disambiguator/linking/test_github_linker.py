@@ -0,0 +1,129 @@
+"""Tests the Github linker against a local stub of the Github search API
+
+Usage:
+    python -m pytest test_github_linker.py
+
+Details:
+    The stub answers according to the query: 'ok' returns a result with an ETag (and 304 if it's sent back),
+    'limited' is rate limited once (429 with Retry-After), 'always_limited' is always rate limited,
+    and 'forbidden' always returns a 403 without rate limit headers (e.g. a revoked token).
+
+Author:
+    Ana-Maria Istrate
+"""
+
+import asyncio
+import threading
+import aiohttp
+import pytest
+from aiohttp import web
+from utils_http import ResponseCache, TokenBucketScheduler
+from github_linker import search_github_repos, search_github_repos_async
+
+OK_RESPONSE = {'total_count' : 1, 'items' : [{'name' : 'ok', 'description' : 'stub', 'url' : 'https://github.com/stub/ok', 'license' : None}]}
+
+ETAG = '"stub-etag"'
+
+MAX_RETRIES = 3
+
+def get_stub_app(requests_seen):
+  """
+  :param requests_seen: list that the (query, status) of every request is appended to
+
+  :return aiohttp web app of the stub
+  """
+  async def search(request):
+    query = request.query['q']
+    num_seen = sum(1 for q, _ in requests_seen if q == query)
+    if query == 'ok' and request.headers.get('If-None-Match') == ETAG:
+      response = web.Response(status = 304, headers = {'ETag' : ETAG})
+    elif query == 'ok':
+      response = web.json_response(OK_RESPONSE, headers = {'ETag' : ETAG})
+    elif query == 'limited' and num_seen == 0:
+      response = web.Response(status = 429, headers = {'Retry-After' : '0'})
+    elif query == 'limited':
+      response = web.json_response(OK_RESPONSE)
+    elif query == 'always_limited':
+      response = web.Response(status = 429, headers = {'Retry-After' : '0'})
+    else:
+      response = web.Response(status = 403, text = 'Bad credentials')
+    requests_seen.append((query, response.status))
+    return response
+
+  app = web.Application()
+  app.router.add_get('/search/repositories', search)
+  return app
+
+@pytest.fixture
+def stub_server():
+  """
+  Runs the stub in a background thread, so both the blocking and the async linker can query it
+
+  :return api_url, requests_seen
+  """
+  requests_seen = []
+  loop = asyncio.new_event_loop()
+  runner = web.AppRunner(get_stub_app(requests_seen))
+  loop.run_until_complete(runner.setup())
+  site = web.TCPSite(runner, '127.0.0.1', 0)
+  loop.run_until_complete(site.start())
+  port = site._server.sockets[0].getsockname()[1]
+  thread = threading.Thread(target = loop.run_forever, daemon = True)
+  thread.start()
+  yield 'http://127.0.0.1:' + str(port) + '/search/repositories', requests_seen
+  loop.call_soon_threadsafe(loop.stop)
+  thread.join()
+  loop.run_until_complete(runner.cleanup())
+  loop.close()
+
+def search_async(api_url, queries, cache = None):
+  """
+  :return responses of search_github_repos_async for queries, queried one after the other
+  """
+  async def search_all():
+    scheduler = TokenBucketScheduler([None], 600)
+    async with aiohttp.ClientSession() as session:
+      return [await search_github_repos_async(session, scheduler, cache, query, api_url, max_retries = MAX_RETRIES) for query in queries]
+  return asyncio.run(search_all())
+
+def test_sync_ok(stub_server):
+  api_url, requests_seen = stub_server
+  assert search_github_repos('ok', api_url) == OK_RESPONSE
+  assert requests_seen == [('ok', 200)]
+
+def test_sync_retry_after(stub_server):
+  api_url, requests_seen = stub_server
+  assert search_github_repos('limited', api_url) == OK_RESPONSE
+  assert requests_seen == [('limited', 429), ('limited', 200)]
+
+def test_sync_retries_are_capped(stub_server):
+  api_url, requests_seen = stub_server
+  assert search_github_repos('always_limited', api_url, max_retries = MAX_RETRIES) == {}
+  assert len(requests_seen) == MAX_RETRIES + 1
+
+def test_sync_forbidden(stub_server):
+  api_url, requests_seen = stub_server
+  assert search_github_repos('forbidden', api_url) == {}
+  assert requests_seen == [('forbidden', 403)]
+
+def test_async_etag(stub_server, tmp_path):
+  api_url, requests_seen = stub_server
+  cache = ResponseCache(str(tmp_path / 'github_responses.sqlite'))
+  assert search_async(api_url, ['ok', 'ok'], cache) == [OK_RESPONSE, OK_RESPONSE]
+  assert requests_seen == [('ok', 200), ('ok', 304)]
+  cache.close()
+
+def test_async_retry_after(stub_server):
+  api_url, requests_seen = stub_server
+  assert search_async(api_url, ['limited']) == [OK_RESPONSE]
+  assert requests_seen == [('limited', 429), ('limited', 200)]
+
+def test_async_retries_are_capped(stub_server):
+  api_url, requests_seen = stub_server
+  assert search_async(api_url, ['always_limited']) == [{}]
+  assert len(requests_seen) == MAX_RETRIES + 1
+
+def test_async_forbidden(stub_server):
+  api_url, requests_seen = stub_server
+  assert search_async(api_url, ['forbidden']) == [{}]
+  assert requests_seen == [('forbidden', 403)]
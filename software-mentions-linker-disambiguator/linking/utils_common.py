@@ -11,11 +11,6 @@ import re
 import time
 from bs4 import BeautifulSoup
 from os.path import exists
-from bioconductor_linker import get_bioconductor_df
-from pypi_linker import get_pypi_df
-from github_linker import get_github_df
-from scicrunch_linker import get_scicrunch_df
-from cran_linker import get_cran_df
 import numpy as np
 
 # Some repositories are queried in chunks; this is the chunk size
@@ -64,7 +59,7 @@ def load_mentions(mentions_type, file, freq_threshold, top_num_entities, ID_star
     mentions_df = pd.read_csv(file, sep='\\t', engine='python', compression = 'gzip')
     print('- Opened the input file:', file, 'with', len(mentions_df), 'entries.')
     if IDs_seen_so_far:
-      IDs_seen_so_far = list(np.load(open(ROOT_DIR + 'intermediate_files/' + IDs_seen_so_far, 'rb')))
+      IDs_seen_so_far = np.load(ROOT_DIR + 'intermediate_files/' + IDs_seen_so_far, allow_pickle = True)
       mentions_df = mentions_df[~(mentions_df['ID'].isin(IDs_seen_so_far))] 
     if ID_start and ID_end:
       ID_start_int = int(ID_start[2:])
@@ -99,6 +94,12 @@ def get_metadata_files(top_software_mentions, bioconductor_file, cran_file, gith
 
     :return list of metadata files
     """ 
+  # imported here, since the linkers themselves import this module
+  from bioconductor_linker import get_bioconductor_df
+  from pypi_linker import get_pypi_df
+  from github_linker import get_github_df
+  from scicrunch_linker import get_scicrunch_df
+  from cran_linker import get_cran_df
   print(save_new_file)
   bioconductor_df = get_bioconductor_df(top_software_mentions, ROOT_DIR_METADATA_NORMALIZED + bioconductor_file, save_new_file)
   cran_df = get_cran_df(top_software_mentions, ROOT_DIR_METADATA_NORMALIZED + cran_file, save_new_file)
@@ -0,0 +1,307 @@
+"""Helper functions for querying web APIs: response caching and rate limiting
+
+Author:
+    Ana-Maria Istrate
+"""
+
+import asyncio
+import json
+import sqlite3
+import time
+import unicodedata
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Seconds to wait before retrying a request when the API doesn't say how long to wait
+DEFAULT_RETRY_WAIT = 1
+
+# Days after which linking results are queried again
+LINKING_CACHE_TTL_DAYS = 30
+
+# Days after which queries that weren't linked (e.g. no_github_entry) are queried again
+LINKING_CACHE_NEGATIVE_TTL_DAYS = 7
+
+# Number of queries looked up in the linking cache per SQL statement
+LINKING_CACHE_BATCH_SIZE = 500
+
+class ResponseCache:
+  """
+  On-disk cache of raw API responses, keyed by (endpoint, query).
+  Keeps the ETag of each response, so that cached responses can be revalidated with conditional requests.
+  """
+
+  def __init__(self, filename):
+    """
+    :param filename: SQLite file backing the cache; created if it doesn't exist
+    """
+    self.filename = filename
+    self.conn = sqlite3.connect(filename)
+    self.conn.execute('CREATE TABLE IF NOT EXISTS responses (endpoint TEXT, query TEXT, etag TEXT, body BLOB, fetched_at REAL, PRIMARY KEY (endpoint, query))')
+    self.conn.commit()
+
+  def get(self, endpoint, query):
+    """
+    Retrieves a cached response
+
+    :param endpoint: API endpoint
+    :param query: query sent to the endpoint
+
+    :return dict containing 'etag', 'body' and 'fetched_at', or None if the response is not cached
+    """
+    row = self.conn.execute('SELECT etag, body, fetched_at FROM responses WHERE endpoint = ? AND query = ?', (endpoint, query)).fetchone()
+    if row is None:
+      return None
+    return {'etag' : row[0], 'body' : row[1], 'fetched_at' : row[2]}
+
+  def put(self, endpoint, query, body, etag = None):
+    """
+    Caches a response
+
+    :param endpoint: API endpoint
+    :param query: query sent to the endpoint
+    :param body: raw response body
+    :param etag: ETag header of the response, if any
+    """
+    self.conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)', (endpoint, query, etag, body, time.time()))
+    self.conn.commit()
+
+  def touch(self, endpoint, query):
+    """
+    Marks a cached response as fresh, e.g. after the API confirmed it is unchanged (HTTP 304)
+
+    :param endpoint: API endpoint
+    :param query: query sent to the endpoint
+    """
+    self.conn.execute('UPDATE responses SET fetched_at = ? WHERE endpoint = ? AND query = ?', (time.time(), endpoint, query))
+    self.conn.commit()
+
+  def close(self):
+    self.conn.close()
+
+def normalize_query(query):
+  """
+  Normalizes a query before looking it up in the linking cache: Unicode NFC normalization, and stripped surrounding whitespace
+
+  :param query: query (e.g. software mention)
+
+  :return normalized query
+  """
+  return unicodedata.normalize('NFC', query).strip()
+
+class LinkingCache:
+  """
+  On-disk cache of parsed linking results across runs, keyed by (source, normalized query).
+  Results expire after ttl_days; empty results (queries that weren't linked) are cached too, and expire after negative_ttl_days.
+  Keeps count of the queries answered from the cache, i.e. of the API calls avoided.
+  """
+
+  def __init__(self, filename, ttl_days = LINKING_CACHE_TTL_DAYS, negative_ttl_days = LINKING_CACHE_NEGATIVE_TTL_DAYS):
+    """
+    :param filename: SQLite file backing the cache; created if it doesn't exist
+    :param ttl_days: days after which results are queried again
+    :param negative_ttl_days: days after which empty results are queried again
+    """
+    self.filename = filename
+    self.ttl = ttl_days * 24 * 3600
+    self.negative_ttl = negative_ttl_days * 24 * 3600
+    self.num_hits = 0
+    self.num_negative_hits = 0
+    self.num_misses = 0
+    self.conn = sqlite3.connect(filename)
+    self.conn.execute('CREATE TABLE IF NOT EXISTS linked (source TEXT, query TEXT, records TEXT, fetched_at REAL, PRIMARY KEY (source, query))')
+    self.conn.commit()
+
+  def get_many(self, source, queries):
+    """
+    Retrieves the cached results of a list of queries
+
+    :param source: source the queries were linked to, e.g. 'github'
+    :param queries: list of queries
+
+    :return dict mapping each query with a fresh cached result to its list of records
+    """
+    now = time.time()
+    normalized = {}
+    for query in queries:
+      normalized.setdefault(normalize_query(query), []).append(query)
+    normalized_queries = list(normalized.keys())
+    results = {}
+    for start in range(0, len(normalized_queries), LINKING_CACHE_BATCH_SIZE):
+      batch = normalized_queries[start:start + LINKING_CACHE_BATCH_SIZE]
+      rows = self.conn.execute('SELECT query, records, fetched_at FROM linked WHERE source = ? AND query IN (' + ','.join('?' * len(batch)) + ')', 
+                               [source] + batch)
+      for normalized_query, records, fetched_at in rows:
+        records = json.loads(records)
+        if now - fetched_at < (self.ttl if records else self.negative_ttl):
+          for query in normalized[normalized_query]:
+            results[query] = records
+    num_hits = sum(1 for query in queries if query in results)
+    self.num_hits += num_hits
+    self.num_negative_hits += sum(1 for query in queries if query in results and not results[query])
+    self.num_misses += len(queries) - num_hits
+    return results
+
+  def put_many(self, source, results):
+    """
+    Caches the results of a list of queries
+
+    :param source: source the queries were linked to
+    :param results: dict mapping each query to its list of records (empty if the query wasn't linked)
+    """
+    now = time.time()
+    # when several queries share a normalized query, the result of the normalized query itself is kept
+    queries = sorted(results.keys(), key = lambda query: query == normalize_query(query))
+    self.conn.executemany('INSERT OR REPLACE INTO linked VALUES (?, ?, ?, ?)',
+                          [(source, normalize_query(query), json.dumps(results[query]), now) for query in queries])
+    self.conn.commit()
+
+  def report(self):
+    """
+    :return summary of the queries answered from the cache
+    """
+    return ('Linking cache: ' + str(self.num_hits) + ' of ' + str(self.num_hits + self.num_misses) + ' queries answered from ' + self.filename + 
+            ' (' + str(self.num_negative_hits) + ' without a match); ' + str(self.num_hits) + ' API calls avoided')
+
+  def close(self):
+    self.conn.close()
+
+def get_wait_time(headers, default_wait = DEFAULT_RETRY_WAIT):
+  """
+  Computes how long to wait before retrying a request, based on the Retry-After and X-RateLimit-* response headers
+
+  :param headers: response headers (case insensitive mapping)
+  :param default_wait: seconds to wait if the headers don't specify it
+
+  :return seconds to wait
+  """
+  retry_after = headers.get('Retry-After')
+  if retry_after is not None and retry_after.isdigit():
+    return float(retry_after)
+  remaining = headers.get('X-RateLimit-Remaining')
+  reset = headers.get('X-RateLimit-Reset')
+  if remaining == '0' and reset is not None:
+    return max(0.0, float(reset) - time.time()) + 1
+  return default_wait
+
+def is_rate_limited(headers, status_code):
+  """
+  Tells a rate limited response apart from a plain refusal: a HTTP 429, or a HTTP 403 with Retry-After or X-RateLimit-Remaining: 0.
+  Other 403 responses (e.g. a revoked token, or an abuse block) won't succeed if retried.
+
+  :param headers: response headers (case insensitive mapping)
+  :param status_code: response status code
+
+  :return True if the request can be retried once the rate limit resets
+  """
+  if status_code == 429:
+    return True
+  return status_code == 403 and (headers.get('Retry-After') is not None or headers.get('X-RateLimit-Remaining') == '0')
+
+class TokenBucketScheduler:
+  """
+  Schedules requests across one or more API tokens.
+  Each token has its own bucket, refilled at requests_per_minute and synced with the rate limit headers returned by the API:
+  a token is blocked until X-RateLimit-Reset once it runs out of requests, or for Retry-After seconds if the API asks so.
+  """
+
+  def __init__(self, tokens, requests_per_minute):
+    """
+    :param tokens: list of API tokens; use [None] for unauthenticated requests
+    :param requests_per_minute: number of requests allowed per token per minute
+    """
+    now = time.time()
+    self.rate = requests_per_minute / 60
+    self.capacity = requests_per_minute
+    self.buckets = {token : {'level' : requests_per_minute, 'updated' : now, 'blocked_until' : 0} for token in tokens}
+
+  def _refill(self, bucket, now):
+    bucket['level'] = min(self.capacity, bucket['level'] + (now - bucket['updated']) * self.rate)
+    bucket['updated'] = now
+
+  def reserve(self):
+    """
+    Reserves a request on the token with the most requests available
+
+    :return token, wait: the reserved token and 0, or None and the seconds to wait if no token is available
+    """
+    now = time.time()
+    found = False
+    best_token = None
+    best_level = 0
+    wait = None
+    for token, bucket in self.buckets.items():
+      self._refill(bucket, now)
+      if bucket['blocked_until'] > now:
+        token_wait = bucket['blocked_until'] - now
+      elif bucket['level'] >= 1:
+        if not found or bucket['level'] > best_level:
+          found, best_token, best_level = True, token, bucket['level']
+        continue
+      else:
+        token_wait = (1 - bucket['level']) / self.rate
+      wait = token_wait if wait is None else min(wait, token_wait)
+    if found:
+      self.buckets[best_token]['level'] -= 1
+      return best_token, 0
+    return None, wait
+
+  async def acquire(self):
+    """
+    Waits until a request can be made
+
+    :return token to use for the request
+    """
+    while True:
+      token, wait = self.reserve()
+      if wait == 0:
+        return token
+      await asyncio.sleep(wait)
+
+  def acquire_blocking(self):
+    """
+    Blocking version of acquire
+
+    :return token to use for the request
+    """
+    while True:
+      token, wait = self.reserve()
+      if wait == 0:
+        return token
+      time.sleep(wait)
+
+  def update(self, token, headers, status_code):
+    """
+    Syncs the bucket of a token with the rate limit headers of a response
+
+    :param token: token used for the request
+    :param headers: response headers (case insensitive mapping)
+    :param status_code: response status code
+    """
+    bucket = self.buckets[token]
+    now = time.time()
+    remaining = headers.get('X-RateLimit-Remaining')
+    if remaining is not None and remaining.isdigit():
+      self._refill(bucket, now)
+      bucket['level'] = min(bucket['level'], int(remaining))
+    if remaining == '0' or status_code in (403, 429):
+      bucket['blocked_until'] = max(bucket['blocked_until'], now + get_wait_time(headers))
+
+def get_session(pool_size = 10, max_retries = 5, backoff_factor = 1):
+  """
+  Creates a requests session with a pool of keep-alive connections. 
+  Failed requests (connection errors, HTTP 429 and 5xx) are retried with exponential backoff, respecting Retry-After.
+
+  :param pool_size: maximum number of connections kept alive per host; should be at least the number of threads sharing the session
+  :param max_retries: maximum number of retries per request
+  :param backoff_factor: retries wait backoff_factor * 2 ** (retry_number - 1) seconds
+
+  :return requests.Session
+  """
+  retry = Retry(total = max_retries, backoff_factor = backoff_factor, status_forcelist = [429, 500, 502, 503, 504], 
+                allowed_methods = ['GET'], respect_retry_after_header = True, raise_on_status = False)
+  adapter = HTTPAdapter(pool_connections = pool_size, pool_maxsize = pool_size, max_retries = retry)
+  session = requests.Session()
+  session.mount('https://', adapter)
+  session.mount('http://', adapter)
+  return session
@@ -11,15 +11,26 @@ import re
 import ast
 import textdistance
 import pickle
+import os
 from utils_common import *
 
+# Fields of the common linking schema (see README), with their types in Parquet files
+LINKING_SCHEMA = [('ID', 'string'), ('software_mention', 'string'), ('mapped_to', 'string'), ('source', 'string'), ('platform', 'string'), 
+                  ('package_url', 'string'), ('description', 'string'), ('homepage_url', 'string'), ('other_urls', 'string'), ('license', 'string'), 
+                  ('github_repo', 'string'), ('github_repo_license', 'string'), ('exact_match', 'bool'), ('RRID', 'string'), ('reference', 'string'), 
+                  ('scicrunch_synonyms', 'string')]
+
+# Formats normalized metadata files can be saved in
+OUTPUT_FORMATS = ['csv', 'parquet']
+
 
 class DatabaseLinker:
   """ 
   Handles linking an input file to a metadata df
   """ 
 
-  def __init__(self, input_file, output_file, min_freq, top_k, raw_filename, generate_new_file, df_type, ID_start, ID_end, IDs_seen_so_far = None):
+  def __init__(self, input_file, output_file, min_freq, top_k, raw_filename, generate_new_file, df_type, ID_start, ID_end, IDs_seen_so_far = None, 
+               mentions = None, mention2ID = None):
     """
     :param input_file: input file (containing software mentions) to link
     :param output_file: output file for the normalized metadata df
@@ -31,12 +42,17 @@ class DatabaseLinker:
     :param ID_start: if True, only consider software mentions from this ID onward
     :param ID_end: if True, only consider software mentions up until this ID
     :param IDs_seen_so_far: added for sanity checking; list of IDs_seen_so_far, to be excluded when reading the file
+    :param mentions: mentions already loaded with load_mentions, shared across linkers; input_file is read if None
+    :param mention2ID: mention2ID map already loaded with retrieve_ID_map, shared across linkers; read from file if None
     """  
     t0 = time.time()
-    top_mentions_df, top_software_mentions, all_mentions_df, all_software_mentions = load_mentions('pmc-oa', file = ROOT_DIR_INPUT_FILES + input_file, 
-    freq_threshold = min_freq, top_num_entities = top_k, ID_start = ID_start, ID_end = ID_end, IDs_seen_so_far = IDs_seen_so_far)
+    if mentions is None:
+      mentions = load_mentions('pmc-oa', file = ROOT_DIR_INPUT_FILES + input_file, freq_threshold = min_freq, top_num_entities = top_k, 
+                               ID_start = ID_start, ID_end = ID_end, IDs_seen_so_far = IDs_seen_so_far)
+    top_mentions_df, top_software_mentions, all_mentions_df, all_software_mentions = mentions
     t1 = time.time()
     print('Took', "{:.3f}".format(t1-t0), 's reading input_file')
+    self.timings = {'reading' : t1 - t0}
 
     self.top_mentions_df = top_mentions_df
     self.top_software_mentions = top_software_mentions
@@ -44,7 +60,7 @@ class DatabaseLinker:
     self.raw_filename = raw_filename
     self.generate_new_file = generate_new_file
     self.df_type = df_type
-    self.mention2ID = retrieve_ID_map()
+    self.mention2ID = get_mention2ID_series(mention2ID if mention2ID is not None else retrieve_ID_map())
     self.output_file = output_file
 
   def get_metadata_df(self, metadata_generation_fn):
@@ -57,34 +73,125 @@ class DatabaseLinker:
     self.raw_df = metadata_generation_fn(self.top_software_mentions, ROOT_DIR_METADATA_RAW + self.raw_filename, self.generate_new_file)
     t1 = time.time()
     print('Took', "{:.3f}".format(t1-t0), 's generating', self.df_type , 'for', len(self.top_software_mentions), 'software mentions')
+    self.timings['fetching'] = t1 - t0
 
-  def normalize_schema(self, schema_normalization_fn):
+  def normalize_schema(self, schema_normalization_fn, executor = None):
     """
     Generates normalized metadata df
 
     :param schema_normalization_fn: function to normalize the raw metadata df to a common schema
+    :param executor: if given, e.g. a ProcessPoolExecutor, schema_normalization_fn runs in it
     """
     print('- Normalizing Schema')
     t0 = time.time()
-    self.normalized_df = schema_normalization_fn(self.raw_df)
+    if executor:
+      self.normalized_df = executor.submit(schema_normalization_fn, self.raw_df).result()
+    else:
+      self.normalized_df = schema_normalization_fn(self.raw_df)
+    assign_IDs(self.normalized_df, self.mention2ID)
     t1 = time.time()
     print('Took', "{:.3f}".format(t1-t0), 's normalizing', self.df_type, 'schema for', len(self.top_software_mentions), 'software mentions')
-    assign_IDs(self.normalized_df, self.mention2ID)
+    self.timings['normalizing'] = t1 - t0
 
-  def save_to_file(self):
+  def save_to_file(self, output_format = 'csv'):
     """
     Saves normalized metadata df to file
+
+    :param output_format: 'csv', or 'parquet' to save it as a Parquet file with the fixed linking schema (output_file extension is replaced by .parquet)
     """
     t0 = time.time()
-    normalized_filename = ROOT_DIR_METADATA_NORMALIZED + self.output_file
-    self.normalized_df.to_csv(normalized_filename, index = False)
+    if output_format == 'parquet':
+      normalized_filename = ROOT_DIR_METADATA_NORMALIZED + os.path.splitext(self.output_file)[0] + '.parquet'
+      save_parquet(self.normalized_df, normalized_filename)
+    else:
+      normalized_filename = ROOT_DIR_METADATA_NORMALIZED + self.output_file
+      self.normalized_df.to_csv(normalized_filename, index = False)
     t1 = time.time()
     print('Took', "{:.3f}".format(t1-t0), 's for saving output file')
+    self.timings['saving'] = t1 - t0
+    self.normalized_filename = normalized_filename
     print('- Saved', self.df_type, 'to', normalized_filename)
     print('- Here\'s how the df looks like:')
     print("=" * 30)
     print(self.normalized_df[:10])
 
+class ChunkedCSVWriter:
+  """ 
+  Buffers linked records (dicts) and writes them to a CSV file in columnar chunks.
+  The schema is discovered from the records: columns are the union of the record keys, in order of first appearance.
+  If a chunk brings new columns after the header was written, the file is rewritten with the extended header.
+  """ 
+
+  def __init__(self, filename, columns = None):
+    """
+    :param filename: CSV file to write to; overwritten if it exists
+    :param columns: initial columns, if known
+    """
+    self.filename = filename
+    self.columns = list(columns) if columns else []
+    self.known_columns = set(self.columns)
+    self.records = []
+    self.dfs = []
+
+  def append(self, record):
+    """
+    Buffers a record
+
+    :param record: dict mapping column to value
+    """
+    self.records.append(record)
+
+  def extend(self, records):
+    """
+    Buffers a list of records
+
+    :param records: list of dicts mapping column to value
+    """
+    self.records.extend(records)
+
+  def flush(self, num_processed = None, num_total = None):
+    """
+    Writes buffered records to file as one chunk
+
+    :param num_processed: number of processed inputs, for logging
+    :param num_total: total number of inputs, for logging
+
+    :return df written to file, or None if no records were buffered
+    """
+    if len(self.records) == 0:
+      return None
+    num_columns = len(self.columns)
+    for record in self.records:
+      for key in record:
+        if key not in self.known_columns:
+          self.known_columns.add(key)
+          self.columns.append(key)
+    df = pd.DataFrame.from_records(self.records, columns = self.columns)
+    self.records = []
+    if len(self.dfs) > 0 and len(self.columns) > num_columns:
+      # new columns: rewrite chunks written so far with the extended header
+      self.dfs = [chunk_df.reindex(columns = self.columns) for chunk_df in self.dfs]
+      pd.concat(self.dfs).to_csv(self.filename, index = False)
+    df.to_csv(self.filename, index = False, header = len(self.dfs) == 0, mode = 'a' if len(self.dfs) > 0 else 'w')
+    self.dfs.append(df)
+    if num_processed is not None:
+      print('Processed', num_processed, '/', num_total, 'saving', len(df), 'to', self.filename)
+    return df
+
+  def close(self, num_processed = None, num_total = None):
+    """
+    Writes remaining records to file
+
+    :param num_processed: number of processed inputs, for logging
+    :param num_total: total number of inputs, for logging
+
+    :return df containing all records written to file
+    """
+    self.flush(num_processed, num_total)
+    if len(self.dfs) == 0:
+      return pd.DataFrame(columns = self.columns)
+    return pd.concat(self.dfs, ignore_index = True)
+
 def parse_html_string(string):
   """
   Parses an html string to retrieve the link and the name
@@ -115,12 +222,74 @@ def retrieve_ID_map():
     print('No ID map found. Please generate a new one by running "python generate_ID_map.py"')
   return mention2ID 
 
+def get_mention2ID_series(mention2ID):
+  """
+  Converts mention2ID to a Series indexed by mention, to look up IDs of many mentions at once. 
+  Building the Series is the expensive part, so it should be done once and reused.
+
+  :param mention2ID: mapping from mention to ID (dict, or Series which is returned as is)
+
+  :return mention2ID as a Series
+  """
+  if isinstance(mention2ID, pd.Series):
+    return mention2ID
+  return pd.Series(list(mention2ID.values()), index = list(mention2ID.keys()), dtype = object)
+
 def assign_IDs(df, mention2ID, field = 'software_mention'):
   """
-  Assigns IDs (in place) to a df, according to mention2ID
+  Assigns IDs (in place) to a df, according to mention2ID. 
+  Missing (NaN) mentions, and mentions that are not in mention2ID, get ID -1.
 
   :param df: df containing mentions to assign IDs to
-  :param mention2ID: mapping from mention 2 ID
+  :param mention2ID: mapping from mention 2 ID (dict, or Series built by get_mention2ID_series)
   :param field: field to assign an ID to in df
   """
-  df['ID'] = df[field].apply(lambda x: mention2ID[x] if x == x else -1)
\ No newline at end of file
+  IDs = df[field].map(get_mention2ID_series(mention2ID))
+  num_unknown = (IDs.isna() & df[field].notna()).sum()
+  if num_unknown > 0:
+    print('-', num_unknown, 'mentions are not in mention2ID; assigning them ID -1')
+  df['ID'] = IDs.astype(object).where(IDs.notna(), -1)
+
+def to_linking_schema(df):
+  """
+  Conforms a normalized metadata df to the fixed linking schema (LINKING_SCHEMA): 
+  fields are reordered, missing fields are added as nulls and other fields are dropped. 
+  Unknown mentions keep the ID -1 (as in CSV files, see assign_IDs), and exact_match is parsed as a boolean.
+
+  :param df: normalized metadata df
+
+  :return df with the fields of LINKING_SCHEMA
+  """
+  extra_fields = [field for field in df.columns if field not in dict(LINKING_SCHEMA)]
+  if extra_fields:
+    print('- Dropping fields not in the linking schema:', extra_fields)
+  schema_df = pd.DataFrame(index = df.index)
+  for field, field_type in LINKING_SCHEMA:
+    values = df[field].astype(object) if field in df.columns else pd.Series(None, index = df.index, dtype = object)
+    if field_type == 'bool':
+      values = values.map({True : True, False : False, 'true' : True, 'false' : False, 'True' : True, 'False' : False})
+    else:
+      not_null = values.notna()
+      values[not_null] = values[not_null].astype(str)
+    schema_df[field] = values.where(values.notna(), None)
+  return schema_df.reset_index(drop = True)
+
+def get_parquet_schema():
+  """
+  Returns the Parquet schema of the linking schema. Requires pyarrow.
+
+  :return pyarrow schema
+  """
+  import pyarrow as pa
+  return pa.schema([(field, pa.bool_() if field_type == 'bool' else pa.string()) for field, field_type in LINKING_SCHEMA])
+
+def save_parquet(df, filename):
+  """
+  Saves a normalized metadata df as a Parquet file with the fixed linking schema. Requires pyarrow.
+
+  :param df: normalized metadata df
+  :param filename: Parquet file
+  """
+  import pyarrow as pa
+  import pyarrow.parquet as pq
+  pq.write_table(pa.Table.from_pandas(to_linking_schema(df), schema = get_parquet_schema(), preserve_index = False), filename)
\ No newline at end of file
@@ -0,0 +1,195 @@
+"""Durable work queue of software mentions to link, shared by linker workers
+
+Author:
+    Ana-Maria Istrate
+"""
+
+import json
+import os
+import socket
+import sqlite3
+import time
+from contextlib import contextmanager
+import pandas as pd
+
+# Seconds a worker holds a leased batch before it is handed to another worker
+DEFAULT_LEASE_SECONDS = 600
+
+# Seconds to wait for a lock on the queue file held by another worker
+QUEUE_LOCK_TIMEOUT = 60
+
+def get_worker_id():
+  """
+  :return an ID unique to this worker process, across machines
+  """
+  return socket.gethostname() + ':' + str(os.getpid())
+
+class WorkQueue:
+  """
+  SQLite-backed queue of (source, mention) tasks, with lease/ack semantics.
+  Workers lease batches of pending tasks for a limited time, and ack them together with their results once linked.
+  Leases that expire (e.g. because the worker crashed) are put back in the queue the next time a batch is leased.
+  Results are keyed by (source, mention), so acking a task again (e.g. after its lease expired) just replaces its results.
+  Workers on several machines can share the queue file through a filesystem that supports file locks.
+  """
+
+  def __init__(self, filename):
+    """
+    :param filename: SQLite file backing the queue; created if it doesn't exist
+    """
+    self.filename = filename
+    self.conn = sqlite3.connect(filename, timeout = QUEUE_LOCK_TIMEOUT, isolation_level = None)
+    self.conn.execute('CREATE TABLE IF NOT EXISTS tasks (source TEXT, mention TEXT, priority REAL, status TEXT, worker TEXT, lease_expires REAL, attempts INTEGER, '
+                      'PRIMARY KEY (source, mention))')
+    self.conn.execute('CREATE INDEX IF NOT EXISTS tasks_status ON tasks (source, status, priority)')
+    self.conn.execute('CREATE TABLE IF NOT EXISTS results (source TEXT, mention TEXT, records TEXT, linked_at REAL, PRIMARY KEY (source, mention))')
+
+  @contextmanager
+  def transaction(self):
+    """
+    Runs the enclosed statements in a single write transaction, holding the lock on the queue file until it commits
+    """
+    self.conn.execute('BEGIN IMMEDIATE')
+    try:
+      yield
+    except:
+      self.conn.execute('ROLLBACK')
+      raise
+    self.conn.execute('COMMIT')
+
+  def enqueue(self, source, mentions, priorities = None):
+    """
+    Adds tasks to the queue. Mentions already pending for source get the new priority, e.g. their frequency in a refreshed input file;
+    mentions already leased or done are left untouched.
+
+    :param source: source to link the mentions to, e.g. 'github'
+    :param mentions: list of software mentions
+    :param priorities: priority of each mention (higher is leased first), e.g. its frequency; all 0 if None
+
+    :return number of tasks added (not counting updated priorities)
+    """
+    if priorities is None:
+      priorities = [0] * len(mentions)
+    with self.transaction():
+      num_before = self.conn.execute('SELECT COUNT(*) FROM tasks WHERE source = ?', (source,)).fetchone()[0]
+      self.conn.executemany("INSERT INTO tasks VALUES (?, ?, ?, 'pending', NULL, NULL, 0) "
+                            "ON CONFLICT(source, mention) DO UPDATE SET priority = excluded.priority WHERE status = 'pending'",
+                            [(source, mention, float(priority)) for mention, priority in zip(mentions, priorities)])
+      num_after = self.conn.execute('SELECT COUNT(*) FROM tasks WHERE source = ?', (source,)).fetchone()[0]
+    return num_after - num_before
+
+  def requeue_expired(self, source = None):
+    """
+    Puts tasks whose lease expired back in the queue
+
+    :param source: only requeue tasks of this source; all sources if None
+
+    :return number of requeued tasks
+    """
+    query = "UPDATE tasks SET status = 'pending', worker = NULL, lease_expires = NULL WHERE status = 'leased' AND lease_expires < ?"
+    params = (time.time(),)
+    if source:
+      query += ' AND source = ?'
+      params += (source,)
+    with self.transaction():
+      return self.conn.execute(query, params).rowcount
+
+  def get_next_lease_expiry(self, source):
+    """
+    :param source: source of the tasks
+
+    :return time at which the first lease of source expires; None if no task is leased
+    """
+    return self.conn.execute("SELECT MIN(lease_expires) FROM tasks WHERE source = ? AND status = 'leased'", (source,)).fetchone()[0]
+
+  def lease(self, source, worker_id, batch_size, lease_seconds = DEFAULT_LEASE_SECONDS):
+    """
+    Leases a batch of pending tasks, highest priority first
+
+    :param source: source to lease tasks of
+    :param worker_id: ID of the worker leasing the batch (see get_worker_id)
+    :param batch_size: maximum number of tasks to lease
+    :param lease_seconds: seconds after which the lease expires, unless the tasks are acked
+
+    :return list of leased mentions (empty if there is no pending task)
+    """
+    with self.transaction():
+      now = time.time()
+      self.conn.execute("UPDATE tasks SET status = 'pending', worker = NULL, lease_expires = NULL WHERE status = 'leased' AND lease_expires < ? AND source = ?",
+                        (now, source))
+      mentions = [row[0] for row in self.conn.execute("SELECT mention FROM tasks WHERE source = ? AND status = 'pending' ORDER BY priority DESC, rowid LIMIT ?",
+                                                      (source, batch_size))]
+      self.conn.executemany("UPDATE tasks SET status = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1 WHERE source = ? AND mention = ?",
+                            [(worker_id, now + lease_seconds, source, mention) for mention in mentions])
+    return mentions
+
+  def ack(self, source, results):
+    """
+    Commits the results of linked tasks and marks them as done, in a single transaction
+
+    :param source: source the mentions were linked to
+    :param results: dict mapping each linked mention to its list of raw records (dicts), empty if the mention wasn't linked
+    """
+    now = time.time()
+    with self.transaction():
+      self.conn.executemany('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)',
+                            [(source, mention, json.dumps(records), now) for mention, records in results.items()])
+      self.conn.executemany("UPDATE tasks SET status = 'done', worker = NULL, lease_expires = NULL WHERE source = ? AND mention = ?",
+                            [(source, mention) for mention in results])
+
+  def release(self, source, mentions):
+    """
+    Puts leased tasks back in the queue, e.g. when a worker stops before linking them
+
+    :param source: source of the tasks
+    :param mentions: list of leased mentions
+    """
+    with self.transaction():
+      self.conn.executemany("UPDATE tasks SET status = 'pending', worker = NULL, lease_expires = NULL WHERE source = ? AND mention = ? AND status = 'leased'",
+                            [(source, mention) for mention in mentions])
+
+  def counts(self, source):
+    """
+    :param source: source of the tasks
+
+    :return dict mapping status ('pending', 'leased', 'done') to number of tasks
+    """
+    counts = {'pending' : 0, 'leased' : 0, 'done' : 0}
+    for status, count in self.conn.execute('SELECT status, COUNT(*) FROM tasks WHERE source = ? GROUP BY status', (source,)):
+      counts[status] = count
+    return counts
+
+  def get_progress(self, source):
+    """
+    Measures how much of the work of a source is done, both in number of tasks and in total priority 
+    (e.g. number of mention occurrences, when tasks are prioritized by frequency)
+
+    :param source: source of the tasks
+
+    :return num_done, num_total, done_priority, total_priority
+    """
+    row = self.conn.execute("SELECT SUM(status = 'done'), COUNT(*), SUM(CASE WHEN status = 'done' THEN priority ELSE 0 END), SUM(priority) FROM tasks WHERE source = ?", 
+                            (source,)).fetchone()
+    return tuple(x if x is not None else 0 for x in row)
+
+  def get_results_df(self, source, columns = None):
+    """
+    Collects the results of all done tasks of a source
+
+    :param source: source of the tasks
+    :param columns: columns of the df, if known
+
+    :return raw metadata df, with one row per record
+    """
+    records = []
+    for (mention_records,) in self.conn.execute('SELECT records FROM results WHERE source = ? ORDER BY rowid', (source,)):
+      records.extend(json.loads(mention_records))
+    if len(records) == 0:
+      return pd.DataFrame(columns = columns)
+    df = pd.DataFrame.from_records(records)
+    if columns:
+      df = df.reindex(columns = list(columns) + [column for column in df.columns if column not in columns])
+    return df
+
+  def close(self):
+    self.conn.close()